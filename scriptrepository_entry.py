@@ -1,8 +1,13 @@
 #!/usr/bin/env python
 # WSGI entry point for the scriptrepository_server application
 # It requires a scriptrepository_server.settings module to be
+# alongside this file. The settings are read, and the clones prepared,
+# once when this file is imported. Preloading it in the parent process,
+# e.g. gunicorn --preload or WSGIImportScript with mod_wsgi, means forked
+# workers start warm.
 
 import os
+import runpy
 import sys
 
 
@@ -11,27 +16,29 @@ settings_file = os.path.join(os.path.dirname(__file__),
 if not os.path.exists(settings_file):
     sys.exit("Cannot find 'scriptrepository_server.settings' file.")
 try:
-    execfile(settings_file)
+    settings = runpy.run_path(settings_file)
 except Exception as exc:
     sys.exit("Error processing settings file '{0}'".format(str(exc)))
 
 # Find the application
-sys.path.append(SCRIPTREPOSITORY_SERVER_DIR)
+sys.path.append(settings["SCRIPTREPOSITORY_SERVER_DIR"])
+from scriptrepository_server.app import create_application
 
-# Wrapper application to update the WSGI environ dictionary
-def application(environ, start_response):
-    from scriptrepository_server.app import (\
-        application as _application,
-        initialise_logging)
-    # Define the location of the cloned repositories
-    environ["SCRIPT_REPOSITORY_PATH"] = SCRIPT_REPOSITORY_PATH
-    try:
-        environ["SCRIPT_REPOSITORY_PATH_DEBUG"] = SCRIPT_REPOSITORY_PATH_DEBUG
-    except NameError:
-        # Not mandatory to have the debug path
-        pass
+# The location of the cloned repositories. The debug path is not mandatory
+server_settings = {
+    "SCRIPT_REPOSITORY_PATH": settings.get("SCRIPT_REPOSITORY_PATH"),
+    "SCRIPT_REPOSITORY_PATH_DEBUG": settings.get("SCRIPT_REPOSITORY_PATH_DEBUG"),
+}
+# Optional tuning settings
+for name in ("GROUP_COMMIT_WINDOW", "SYNC_INTERVAL", "SYNC_MAX_AGE", "SPOOL_DIR",
+             "JOBS_DIR", "IDEMPOTENCY_DIR", "UPLOADS_DIR", "LOCK_TIMEOUT", "METRICS_DIR",
+             "TRACE_SAMPLE", "TRACE_SLOW", "MAINTENANCE_INTERVAL", "MAINTENANCE_IDLE",
+             "MAX_IN_FLIGHT", "LARGE_UPLOAD_BYTES", "LOG_FORMAT", "LOG_SAMPLE",
+             "ADMIN_TOKEN"):
+    server_settings["SCRIPT_REPOSITORY_" + name] = settings.get(name)
 
-    # Configure logging
-    initialise_logging(default_level=DEFAULT_LOGLEVEL)
-    # Hand off to "real" app
-    return _application(environ, start_response)
+try:
+    application = create_application(server_settings,
+                                     default_loglevel=settings["DEFAULT_LOGLEVEL"])
+except ValueError as exc:
+    sys.exit("Invalid settings: {0}".format(str(exc)))
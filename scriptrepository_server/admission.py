@@ -0,0 +1,214 @@
+"""Admission control for changes to each clone.
+
+Every change holds a place from the moment its request arrives until it is
+in the remote, or its asynchronous job has finished. Once a clone has as
+many changes in flight as it allows, counting those of every worker process
+using it, further requests are refused at once, before their body is read,
+with a 503 response. Its Retry-After header is the time the changes in
+flight are expected to take, worked out from how long recent changes took to
+commit and push.
+
+A place is a file in a directory within the git directory of the clone that
+its owner keeps locked with flock, so the places of a process that dies are
+given up with it. The places are counted, and the recent service times kept
+beside them, under an flock of a guard file.
+
+Optionally large uploads may only take some of the places, so that removals
+and small uploads, whose bodies are small, are still admitted during a burst
+of large ones.
+"""
+from contextlib import contextmanager
+import fcntl
+import json
+import math
+import os
+import threading
+import time
+import uuid
+
+from . import metrics
+from .errors import ServiceUnavailableException
+from .repository import _git_dir
+
+# Name of the directory, within the git directory, holding the places
+ADMISSION_DIRNAME = 'scriptrepository-admission'
+# Number of recent changes the service time is averaged over
+SERVICE_TIME_WINDOW = 20
+# Share of the places that large uploads may take
+LARGE_SHARE = 0.5
+# Bounds of the Retry-After given to refused requests
+MIN_RETRY_AFTER_SECS = 1
+MAX_RETRY_AFTER_SECS = 300
+
+_GUARD_FILENAME = 'guard'
+_STATE_FILENAME = 'state.json'
+_PLACE_PREFIX = 'place-'
+
+# One controller per repository, keyed by real path
+_CONTROLLERS = dict()
+_CONTROLLERS_LOCK = threading.Lock()
+
+
+def get_admission_controller(root):
+    """Return the AdmissionController for the clone at root"""
+    key = os.path.realpath(root)
+    with _CONTROLLERS_LOCK:
+        controller = _CONTROLLERS.get(key)
+        if controller is None:
+            controller = AdmissionController(os.path.join(_git_dir(root), ADMISSION_DIRNAME))
+            _CONTROLLERS[key] = controller
+    return controller
+
+
+# ------------------------------------------------------------------------------
+class AdmissionController(object):
+    """Counts the changes in flight for one clone in every process, through
+    the places in directory"""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    @property
+    def in_flight(self):
+        """Number of changes in flight"""
+        with self._guard():
+            return len(self._live_places())
+
+    def admit(self, size, max_in_flight, large_bytes=None):
+        """Take a place for a change whose request body is size bytes, or
+        None if unknown. If large_bytes is given, bodies larger than it may
+        only take LARGE_SHARE of the places.
+          :returns An Admission that must be released when the change is done
+          :raises ServiceUnavailableException if there is no place for it
+        """
+        large = large_bytes is not None and (size is None or size > large_bytes)
+        limit = max_in_flight * LARGE_SHARE if large else max_in_flight
+        with self._guard():
+            in_flight = len(self._live_places())
+            if in_flight >= limit:
+                admission = None
+                retry_after = self._retry_after(in_flight)
+            else:
+                admission = Admission(self, in_flight)
+        if admission is None:
+            metrics.increment('scriptrepository_admission_refusals_total',
+                              size='large' if large else 'small')
+            raise ServiceUnavailableException("Server busy.",
+                                              "Too many changes are waiting to be "
+                                              "published. Please try again later.",
+                                              retry_after=retry_after)
+        return admission
+
+    def _finished(self, admission, completed):
+        now = time.time()
+        with self._guard():
+            admission.give_up_place()
+            if not completed:
+                # Refused or failed changes say nothing about the throughput
+                return
+            state = self._load_state()
+            last_finish = state['last_finish']
+            if admission.queued_behind == 0:
+                # Nothing was ahead of it, so it took as long as a change takes
+                state['service_times'].append(now - admission.start)
+            elif last_finish is not None and last_finish > admission.start:
+                # It was waiting for the change that finished last
+                state['service_times'].append(now - last_finish)
+            state['service_times'] = state['service_times'][-SERVICE_TIME_WINDOW:]
+            state['last_finish'] = now
+            self._save_state(state)
+
+    def _retry_after(self, in_flight):
+        """Seconds until the changes in flight are expected to be done"""
+        service_times = self._load_state()['service_times']
+        if service_times:
+            service_time = sum(service_times) / len(service_times)
+        else:
+            service_time = 1.0
+        seconds = int(math.ceil(in_flight * service_time))
+        return min(max(seconds, MIN_RETRY_AFTER_SECS), MAX_RETRY_AFTER_SECS)
+
+    # ------------------------------------------------------------------------
+    @contextmanager
+    def _guard(self):
+        """Hold the guard of the places for the duration of the block"""
+        os.makedirs(self.directory, exist_ok=True)
+        fd = os.open(os.path.join(self.directory, _GUARD_FILENAME), os.O_CREAT | os.O_RDWR,
+                     0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            # Closing the file releases the lock
+            os.close(fd)
+
+    def _live_places(self):
+        """Return the names of the places held. Those left by a process that
+        has died are removed. The guard must be held"""
+        live = []
+        for name in os.listdir(self.directory):
+            if not name.startswith(_PLACE_PREFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                fd = os.open(path, os.O_RDWR)
+            except OSError:
+                continue
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                # Nobody holds it
+                os.remove(path)
+            except BlockingIOError:
+                live.append(name)
+            except OSError:
+                pass
+            finally:
+                os.close(fd)
+        return live
+
+    def _load_state(self):
+        try:
+            with open(os.path.join(self.directory, _STATE_FILENAME), 'r') as state_file:
+                state = json.load(state_file)
+            return dict(service_times=list(state['service_times']),
+                        last_finish=state['last_finish'])
+        except (OSError, ValueError, KeyError, TypeError):
+            return dict(service_times=[], last_finish=None)
+
+    def _save_state(self, state):
+        filename = os.path.join(self.directory, _STATE_FILENAME)
+        tmp_filename = '{0}.tmp-{1}'.format(filename, os.getpid())
+        try:
+            with open(tmp_filename, 'w') as state_file:
+                json.dump(state, state_file)
+            os.replace(tmp_filename, filename)
+        except OSError:
+            # Only the Retry-After estimate suffers
+            pass
+
+
+class Admission(object):
+    """A place held by a change. The guard must be held to create it"""
+
+    def __init__(self, controller, queued_behind):
+        self.controller = controller
+        self.queued_behind = queued_behind
+        self.start = time.time()
+        self._path = os.path.join(controller.directory, _PLACE_PREFIX + uuid.uuid4().hex)
+        self._fd = os.open(self._path, os.O_CREAT | os.O_RDWR, 0o644)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        self._released = False
+
+    def release(self, completed=False):
+        """Give up the place, saying whether the change reached the remote.
+        Only the first call has any effect"""
+        if not self._released:
+            self._released = True
+            self.controller._finished(self, completed)
+
+    def give_up_place(self):
+        try:
+            os.remove(self._path)
+        except OSError:
+            pass
+        os.close(self._fd)
@@ -14,32 +14,148 @@ to the central repository using:
   - git commit -m "<comment>" --author "<author> <<email>>"
   - git push
 
+Several files can be uploaded to the same folder in one request, and so one
+commit, by repeating the file field or by sending a tar or zip archive in an
+'archive' field instead. The members of an archive keep their relative paths
+below the folder. Each file has the same size limit as a single upload.
+
+Files larger than a single upload allows, up to 64MB, may be sent in chunks
+of up to 1MB with a resumable upload:
+ - POST ?upload=start with the author, mail, comment and path fields, and the
+   filename and size of the file. The 201 response has the 'upload' ID
+ - PUT ?upload=<id>&offset=<n> with the next chunk as the body and its SHA-1
+   in a Chunk-SHA1 header. A chunk not starting at the offset already reached
+   gets a 409 response
+ - GET ?upload=<id> returns the 'offset' reached, to resume after an error
+ - POST ?upload=<id> commits the file once every chunk is in, as for a normal
+   upload. debug=1 and async=1 may be given here
+Uploads that are not finished are removed after 24 hours.
+
+A change may carry an idempotency key, in an Idempotency-Key header or an
+idempotency_key field, so that it can be retried safely. A retry with the same
+key gets the response to the first attempt, with an Idempotent-Replayed header,
+rather than making the change again. A retry that arrives while the first
+attempt is running waits for it. Reusing a key for a different change is an
+error.
+
 The response body will be a json-encoded dictionary containing:
   - message: A string containing an information message on the outcome of the
              request. For success it is simply 'success'
   - detail: if an error occurred then further details are provided here
   - pub_date: the date and time of the upload in the format  %Y-%b-%d %H:%M:%S
+  - files: for a bulk upload only, a list with the path, pub_date and status
+           (committed or unchanged) of each file
+
+Only POST requests are accepted for changes, and PUT requests for the chunks
+of a resumable upload. A GET request reports the status of an asynchronous
+upload, see below. Any other request will result in a 405 error.
 
-Only POST requests are accepted, any other type will result in a 405 error.
+The request body, or any file part within it, may be compressed with gzip or
+deflate and sent with a Content-Encoding header. The size limits apply to the
+decompressed content. Responses of 1KB or more are gzipped for clients sending
+Accept-Encoding: gzip.
 
 Several query parameters are understood:
  - remove=1: if included the file will be removed rather than uploaded
  - debug=1: if included then the update will happen in the sandbox repository
+ - async=1: if included the form is validated and queued, and a 202 response
+            is returned at once. Its body includes a 'job' ID
+ - job=<id>: with a GET request, reports the status of an asynchronous upload.
+             The message is one of queued, committed, pushed or failed and
+             pub_date or detail are filled in once the job has finished. A job
+             left unfinished by a worker that died is reported as failed
+ - metrics=1: with a GET request, returns request counts and latency histograms
+              of each stage of an update and each git command, added up over
+              every worker, in the Prometheus text format
+ - manifest=1: with a GET request, returns the head commit of the clone and
+               the path, blob hash, author and pub_date of every file in it.
+               The ETag is the head commit so a poll with If-None-Match gets a
+               304 response if nothing has changed
+ - traces=1: with a GET request, returns the slow or failed requests recently
+             traced by the worker that answers, see SCRIPT_REPOSITORY_TRACE_SAMPLE.
+             Only for requests with an Authorization: Bearer header giving
+             SCRIPT_REPOSITORY_ADMIN_TOKEN
+
+The following environment variables configure the server:
+ - SCRIPT_REPOSITORY_PATH: location of the clone of the script repository
+ - SCRIPT_REPOSITORY_PATH_DEBUG: location of the clone of the sandbox repository
+ - SCRIPT_REPOSITORY_GROUP_COMMIT_WINDOW: if set, changes arriving within this
+   many seconds of each other are committed together and sent in one push
+ - SCRIPT_REPOSITORY_SYNC_INTERVAL: if set, a background thread syncs the clone
+   with the remote every this many seconds
+ - SCRIPT_REPOSITORY_SYNC_MAX_AGE: a request skips the sync with the remote if
+   the clone was synced less than this many seconds ago (default 0)
+ - SCRIPT_REPOSITORY_JOBS_DIR: directory holding the status of asynchronous
+   uploads. It must be shared by all worker processes
+ - SCRIPT_REPOSITORY_IDEMPOTENCY_DIR: directory holding the response to each
+   idempotency key for 24 hours. It must be shared by all worker processes
+ - SCRIPT_REPOSITORY_UPLOADS_DIR: directory holding resumable uploads until
+   they are committed. It must be shared by all worker processes and should be
+   on the same filesystem as the clones
+ - SCRIPT_REPOSITORY_SPOOL_DIR: directory that uploaded files are spooled to
+   while the request is read. It should be on the same filesystem as the clones
+   so that files can be moved into place without a copy
+ - SCRIPT_REPOSITORY_METRICS_DIR: directory that each worker process saves its
+   metrics to. It must be shared by all worker processes
+ - SCRIPT_REPOSITORY_LOCK_TIMEOUT: if set, a request that waits longer than
+   this many seconds for the lock on the clone is refused with a 503 response
+   and a Retry-After header. Asynchronous uploads always wait
+ - SCRIPT_REPOSITORY_MAX_IN_FLIGHT: if set, an integer. A change is refused
+   with a 503 response, before reading its body, while this many changes to the
+   same clone are in flight across every worker process. The Retry-After header
+   estimates when they will be done from the time recent changes took
+ - SCRIPT_REPOSITORY_LARGE_UPLOAD_BYTES: if set, an integer. Requests with a larger body
+   may only take half of the places, keeping the rest for removals and small
+   uploads
+ - SCRIPT_REPOSITORY_MAINTENANCE_INTERVAL: if set, a background thread repacks
+   the clone, prunes it and writes a commit-graph every this many seconds,
+   provided nobody has used it for SCRIPT_REPOSITORY_MAINTENANCE_IDLE seconds
+   (default 60). The metrics report the number of objects and packs in each clone
+ - SCRIPT_REPOSITORY_TRACE_SAMPLE: the fraction, between 0 and 1, of requests
+   that are traced (default 0). A trace records the duration of each stage and
+   git command of the request, and the output of any that fail
+ - SCRIPT_REPOSITORY_TRACE_SLOW: a traced request is kept if it takes at least
+   this many seconds (default 1) or fails with a server error
+ - SCRIPT_REPOSITORY_ADMIN_TOKEN: the token that admin requests, i.e. traces=1,
+   must give. If it is not set they are refused with a 403 response
+ - SCRIPT_REPOSITORY_LOG_FORMAT: text (default) or json, for one JSON object
+   per log record. Every record carries the ID of its request, which is taken
+   from an X-Request-ID header or made up, and returned in X-Request-ID
+ - SCRIPT_REPOSITORY_LOG_SAMPLE: the fraction of records kept at each level,
+   e.g. debug=0.01,info=0.5. Levels not given are kept in full
+
+The variables may be set in the WSGI environ of each request, or given once
+to create_application, which validates them and prepares the clones before
+the first request arrives.
 """
 
 
+import functools
+import gzip
+import hmac
 import http.client
+import json
 import logging
+import os
 import traceback
 from urllib.parse import parse_qs
 import sys
-
-from .base import ScriptFormFactory, ServerResponse
-from .errors import BadRequestException, InternalServerError, RequestException
-from .repository import GitCommitInfo, GitRepository
-
-# Global formatting object
-_log_formatter = None
+import time
+
+from . import logs, metrics, tracing
+from .admission import get_admission_controller
+from .base import MAX_FORM_OVERHEAD_BYTES, ContentResponse, ScriptFormFactory, ServerResponse
+from .errors import (BadRequestException, ForbiddenException, InternalServerError,
+                     RequestException, server_busy)
+from .groupcommit import get_group_committer
+from .idempotency import DEFAULT_IDEMPOTENCY_DIR, IdempotencyStore
+from .jobs import DEFAULT_JOBS_DIR, QUEUED, JobStore, queue_job
+from .locking import LockTimeout
+from .maintenance import DEFAULT_IDLE_SECS, object_counts, start_maintenance_daemon
+from .multipart import MultipartError, parse_form
+from .repository import GitCommitInfo, blob_id, format_published_date, open_repository
+from .resumable import DEFAULT_UPLOADS_DIR, UploadStore
+from .sync import mark_synced, start_sync_daemon, sync_if_stale
 
 # Map requests to handlers
 # Each handler should have the following structure:
@@ -49,37 +165,34 @@ _log_formatter = None
 #      ...
 #      return ServerResponse(status_code, ...)
 _REQUEST_HANDLERS = {
-    'POST': 'handle_post'
+    'GET': 'handle_get',
+    'POST': 'handle_post',
+    'PUT': 'handle_put'
 }
 
 # Maximum allowed file size
 MAX_FILESIZE_BYTES = 1*1024*1024
 
+# Smallest response body that is compressed
+MIN_COMPRESS_BYTES = 1024
+# gzip compression level of responses
+COMPRESS_LEVEL = 6
+
 # Comitter's name
 COMMITTER_NAME = "mantid-publisher"
 
+# Settings given as a number of seconds, or a fraction for TRACE_SAMPLE
+_NUMERIC_SETTINGS = ('GROUP_COMMIT_WINDOW', 'SYNC_INTERVAL', 'SYNC_MAX_AGE', 'LOCK_TIMEOUT',
+                     'TRACE_SAMPLE', 'TRACE_SLOW', 'MAINTENANCE_INTERVAL', 'MAINTENANCE_IDLE')
+_INTEGER_SETTINGS = ('MAX_IN_FLIGHT', 'LARGE_UPLOAD_BYTES')
 
-def initialise_logging(default_level=logging.DEBUG):
-    global _log_formatter
-    if _log_formatter is not None:
-        return
-    _log_formatter = logging.Formatter(
-            "%(asctime)s [%(name)s] %(levelname)s: %(message)s")
 
+def initialise_logging(default_level=logging.DEBUG, log_format='text', sample_rates=None):
+    """Send log records to stderr through a background writer thread. Only
+    the first call has any effect"""
     # Capture all warnings
     logging.captureWarnings(True)
-
-    # Remove default handlers
-    root_logger = logging.getLogger()
-    root_logger.handlers = []
-
-    # Stdout handler
-    console_handler = logging.StreamHandler(sys.stderr)
-    console_handler.setFormatter(_log_formatter)
-    root_logger.addHandler(console_handler)
-
-    # Default log level
-    root_logger.setLevel(default_level)
+    logs.start_logging(default_level, sys.stderr, log_format, sample_rates)
 
 
 # -----------------------------------------------------------------------------
@@ -90,11 +203,20 @@ def application(environ, start_response):
       :param environ A dictionary of context variables
       :start_response A callback function that will the response to the client
     """
-    # Find handler
-    logging.getLogger(__name__).info("Received request={}".format(environ['REQUEST_METHOD']))
-    handle_attr = _REQUEST_HANDLERS.get(environ['REQUEST_METHOD'],
-                                        'null_handler')
-    response = globals()[handle_attr](environ)
+    request_id, token = logs.begin_request(environ.get('HTTP_X_REQUEST_ID'))
+    try:
+        # Find handler
+        logging.getLogger(__name__).info("Received request=%s", environ['REQUEST_METHOD'])
+        start = time.monotonic()
+        handle_attr = _REQUEST_HANDLERS.get(environ['REQUEST_METHOD'],
+                                            'null_handler')
+        trace = start_trace(environ, handle_attr)
+        response = globals()[handle_attr](environ)
+        record_request(environ, response, time.monotonic() - start, trace)
+    finally:
+        logs.end_request(token)
+    response = compress_response(environ, response)
+    response.headers.append(('X-Request-ID', request_id))
     # Begin response
     start_response(response.status, response.headers)
     # It is important to return the content within another iterable.
@@ -103,6 +225,102 @@ def application(environ, start_response):
     return [response.content]
 
 
+def compress_response(environ, response):
+    """Return the response gzipped if the client accepts it and the body is
+    large enough to be worth compressing"""
+    if len(response.content) < MIN_COMPRESS_BYTES or \
+            any(name == 'Content-Encoding' for name, _ in response.headers):
+        return response
+    response.headers.append(('Vary', 'Accept-Encoding'))
+    if not _accepts_gzip(environ.get('HTTP_ACCEPT_ENCODING', '')):
+        return response
+    with metrics.timed("compress"):
+        response.content = gzip.compress(response.content, COMPRESS_LEVEL, mtime=0)
+    response.headers = [(name, value) for name, value in response.headers
+                        if name != 'Content-Length']
+    response.headers.extend([('Content-Encoding', 'gzip'),
+                             ('Content-Length', str(len(response.content)))])
+    return response
+
+
+def _accepts_gzip(accept_encoding):
+    """Return True if an Accept-Encoding header allows gzip"""
+    for coding in accept_encoding.split(','):
+        name, _, params = coding.partition(';')
+        if name.strip().lower() not in ('gzip', 'x-gzip', '*'):
+            continue
+        quality = params.strip().lower()
+        if quality.startswith('q='):
+            try:
+                return float(quality[2:]) > 0
+            except ValueError:
+                return False
+        return True
+    return False
+
+
+def create_application(settings, default_loglevel=None):
+    """Return a WSGI application configured from settings, a dictionary of
+    the SCRIPT_REPOSITORY_* variables described above. The settings are
+    checked, and each clone opened and its indexes built, once when this is
+    called. Calling it before the server forks its workers, e.g. with
+    gunicorn --preload, means every worker starts warm.
+      :param default_loglevel If given, logging is initialised at this level
+      :raises ValueError if the settings are invalid or a clone is unusable
+    """
+    settings = validate_settings(settings)
+    if default_loglevel is not None:
+        initialise_logging(default_loglevel,
+                           settings.get('SCRIPT_REPOSITORY_LOG_FORMAT', 'text'),
+                           logs.parse_sample_rates(settings.get('SCRIPT_REPOSITORY_LOG_SAMPLE')))
+    log = logging.getLogger(__name__)
+    for name in ('SCRIPT_REPOSITORY_PATH', 'SCRIPT_REPOSITORY_PATH_DEBUG'):
+        if name not in settings:
+            continue
+        git_repo = open_repository(settings[name])
+        try:
+            head = git_repo.warm()
+        except RuntimeError as exc:
+            raise ValueError("{0} '{1}' is not a clone tracking {2}/{3}: "
+                             "{4}".format(name, settings[name], git_repo.remote,
+                                          git_repo.branch, exc))
+        log.info("Repository %s is at %s", settings[name], head)
+
+    def configured_application(environ, start_response):
+        environ.update(settings)
+        return application(environ, start_response)
+
+    return configured_application
+
+
+def validate_settings(settings):
+    """Return a copy of settings with every value as a string, as in a WSGI
+    environ. Unset values, given as None, are dropped.
+      :raises ValueError if a required setting is missing or a value is invalid
+    """
+    validated = {name: str(value) for name, value in settings.items() if value is not None}
+    if 'SCRIPT_REPOSITORY_PATH' not in validated:
+        raise ValueError("SCRIPT_REPOSITORY_PATH must be set")
+    for name in _NUMERIC_SETTINGS:
+        name = 'SCRIPT_REPOSITORY_' + name
+        if name in validated and _get_seconds_setting(validated, name) is None:
+            raise ValueError("{0} must be a non-negative number, "
+                             "not '{1}'".format(name, validated[name]))
+    for name in _INTEGER_SETTINGS:
+        name = 'SCRIPT_REPOSITORY_' + name
+        if name in validated and _get_integer_setting(validated, name) is None:
+            raise ValueError("{0} must be a non-negative integer, "
+                             "not '{1}'".format(name, validated[name]))
+    if validated.get('SCRIPT_REPOSITORY_LOG_FORMAT', 'text') not in logs.FORMATS:
+        raise ValueError("SCRIPT_REPOSITORY_LOG_FORMAT must be one of "
+                         "{0}".format(', '.join(logs.FORMATS)))
+    try:
+        logs.parse_sample_rates(validated.get('SCRIPT_REPOSITORY_LOG_SAMPLE'))
+    except ValueError as exc:
+        raise ValueError("SCRIPT_REPOSITORY_LOG_SAMPLE is invalid: {0}".format(exc))
+    return validated
+
+
 # ------------------------------------------------------------------------------
 # Handler methods
 # ------------------------------------------------------------------------------
@@ -110,17 +328,227 @@ def handle_post(environ):
     log = logging.getLogger(__name__)
     log.info("Handling POST request")
 
+    if parse_qs(environ["QUERY_STRING"]).get("upload") == ["start"]:
+        return handle_upload_start(environ)
     err_stream = environ["wsgi.errors"]
+    script_form, admission, claim = None, None, None
     try:
-        script_form, debug = parse_request(environ)
+        # Refused before the body is read
+        admission = admit_change(environ)
+        with metrics.timed("parse"):
+            script_form, debug, asynchronous = parse_request(environ)
         log.debug("Request parsed:\n"
-                  "  debug={}\n"
-                  "  form={}\n".format(debug, str(script_form)))
+                  "  debug=%s\n"
+                  "  async=%s\n"
+                  "  form=%s\n", debug, asynchronous, script_form)
         local_repo_root = get_local_repo_path(environ, debug, err_stream)
-        log.debug("Repository root=" + local_repo_root)
-        return update_central_repo(local_repo_root, script_form, err_stream)
+        log.debug("Repository root=%s", local_repo_root)
+        max_sync_age = get_max_sync_age(environ, local_repo_root)
+        schedule_maintenance(environ, local_repo_root)
+        window = get_group_commit_window(environ)
+
+        def update(script_form, err_stream, lock_timeout=None, on_committed=None):
+            # A bulk upload is already a single commit
+            if window is not None and not script_form.is_bulk():
+                return group_update_central_repo(local_repo_root, script_form,
+                                                 err_stream, window, max_sync_age,
+                                                 on_committed, lock_timeout)
+            return update_central_repo(local_repo_root, script_form, err_stream,
+                                       max_sync_age, on_committed, lock_timeout)
+
+        # A retry with the same key waits for the first attempt and gets its response
+        claim = claim_idempotency_key(environ, script_form, local_repo_root)
+        if claim.response is not None:
+            return claim.response
+        try:
+            if asynchronous:
+                # The request will be gone by the time the job runs so errors
+                # go straight to the server log. Nobody is waiting on it so it
+                # waits for the lock as long as it takes
+                work = _holding(admission, functools.partial(update, script_form, sys.stderr))
+                job = queue_job(get_jobs_dir(environ), logs.bind_request_id(work), script_form)
+                # The job runner now owns the form and its place
+                script_form, admission = None, None
+                response = ServerResponse(http.client.ACCEPTED, message=QUEUED, job=job.job_id)
+            else:
+                response = _holding(admission, functools.partial(update, script_form, err_stream,
+                                                                 get_lock_timeout(environ)))()
+        except RequestException as err:
+            response = err.response()
+        finish_upload(environ, response)
+        return claim.record(response)
     except RequestException as err:
         return err.response()
+    finally:
+        if claim is not None:
+            claim.release()
+        if script_form is not None:
+            script_form.close()
+        if admission is not None:
+            admission.release()
+
+
+def handle_upload_start(environ):
+    """Start a resumable upload from a form with the fields of an upload,
+    except the file, and its filename and size"""
+    try:
+        request_fields = parse_form(environ, 0, max_body=MAX_FORM_OVERHEAD_BYTES)
+        upload = UploadStore(get_uploads_dir(environ)).start(request_fields)
+    except MultipartError as err:
+        return BadRequestException(err.summary, err.detail).response()
+    except RequestException as err:
+        return err.response()
+    logging.getLogger(__name__).debug("Started upload %s", upload.upload_id)
+    return upload_response(http.client.CREATED, upload)
+
+
+def handle_put(environ):
+    """Append the body to a resumable upload at the offset given"""
+    query_params = parse_qs(environ["QUERY_STRING"])
+    if "upload" not in query_params:
+        return null_handler(environ)
+    try:
+        offset = query_params.get("offset", [""])[0]
+        length = environ.get("CONTENT_LENGTH") or ""
+        sha1 = environ.get("HTTP_CHUNK_SHA1")
+        if not offset.isdigit() or not length.isdigit() or sha1 is None:
+            raise BadRequestException("Invalid chunk.",
+                                      "A chunk needs an offset, a Content-Length "
+                                      "and a Chunk-SHA1 header")
+        store = UploadStore(get_uploads_dir(environ))
+        # Abandoned uploads are cleared out as chunks arrive as well as when
+        # an upload starts
+        store.expire()
+        upload = store.load(query_params["upload"][0])
+        with metrics.timed("chunk"):
+            upload.append(int(offset), environ["wsgi.input"], int(length), sha1)
+    except RequestException as err:
+        return err.response()
+    return upload_response(http.client.OK, upload)
+
+
+def finish_upload(environ, response):
+    """Discard the resumable upload committed by the request, if any, once
+    the response shows it will not be retried"""
+    upload_ids = parse_qs(environ["QUERY_STRING"]).get("upload")
+    if upload_ids and int(response.status.split()[0]) < 500:
+        try:
+            UploadStore(get_uploads_dir(environ)).load(upload_ids[0]).discard()
+        except RequestException:
+            pass
+
+
+def upload_response(status_code, upload):
+    """Return the status of a resumable upload"""
+    content = json.dumps(upload.status())
+    return ContentResponse(status_code, content.encode('utf-8'),
+                           'application/json; charset=utf-8')
+
+
+def claim_idempotency_key(environ, script_form, local_repo_root):
+    """Claim the idempotency key of the request, from the Idempotency-Key
+    header or the idempotency_key field, within the clone it changes.
+      :returns A Claim that must be released once the response is recorded
+    """
+    key = environ.get('HTTP_IDEMPOTENCY_KEY') or script_form.idempotency_key
+    store = IdempotencyStore(get_idempotency_dir(environ))
+    return store.acquire(key, os.path.realpath(local_repo_root), script_form.fingerprint(),
+                         get_lock_timeout(environ))
+
+
+def _holding(admission, work):
+    """Wrap work, a callable (on_committed) making a change, so that the
+    change gives up its place once it is done"""
+    if admission is None:
+        return work
+
+    def held_work(on_committed=None):
+        completed = False
+        try:
+            response = work(on_committed=on_committed)
+            completed = True
+            return response
+        finally:
+            admission.release(completed)
+
+    return held_work
+
+
+def handle_get(environ):
+    """Reports the status of an asynchronous upload if a job is given, or of
+    a resumable upload, or the manifest, metrics or traces if they are asked
+    for, otherwise GET is not supported"""
+    query_params = parse_qs(environ["QUERY_STRING"])
+    if "traces" in query_params:
+        if not is_admin(environ):
+            return ForbiddenException("Forbidden.",
+                                      "Traces are only available to admin "
+                                      "requests").response()
+        content = json.dumps(dict(pid=os.getpid(), traces=tracing.recent()))
+        return ContentResponse(http.client.OK, content.encode('utf-8'),
+                               'application/json; charset=utf-8')
+    if "metrics" in query_params:
+        metrics.flush(get_metrics_dir(environ), force=True)
+        exposition = metrics.exposition(get_metrics_dir(environ), repository_gauges(environ))
+        return ContentResponse(http.client.OK, exposition.encode('utf-8'),
+                               'text/plain; version=0.0.4; charset=utf-8')
+    if "manifest" in query_params:
+        return handle_manifest(environ, debug=("debug" in query_params))
+    if "upload" in query_params:
+        try:
+            upload = UploadStore(get_uploads_dir(environ)).load(query_params["upload"][0])
+            return upload_response(http.client.OK, upload)
+        except RequestException as err:
+            return err.response()
+    if "job" not in query_params:
+        return null_handler(environ)
+    job_id = query_params["job"][0]
+    status = JobStore(get_jobs_dir(environ)).load(job_id)
+    if status is None:
+        return ServerResponse(http.client.NOT_FOUND, message='Unknown job.',
+                              detail='No job with ID {0}'.format(job_id))
+    return ServerResponse(http.client.OK, message=status['state'], detail=status['detail'],
+                          published_date=status['pub_date'], job=job_id)
+
+
+def handle_manifest(environ, debug=False):
+    """Return the manifest of the repository with an ETag naming the commit
+    it describes. A 304 is returned if the client already has it."""
+    try:
+        git_repo = open_repository(get_local_repo_path(environ, debug, environ["wsgi.errors"]))
+        head, entries = git_repo.manifest.snapshot()
+        if head is None:
+            # Built once, after which commits and syncs keep it up to date
+            try:
+                with git_repo.lock.hold(get_lock_timeout(environ)):
+                    git_repo.manifest.refresh()
+            except LockTimeout as exc:
+                raise server_busy(exc.timeout)
+            except RuntimeError:
+                environ["wsgi.errors"].write("Script repository upload: unable to build "
+                                             "manifest - {0}.".format(traceback.format_exc()))
+                raise InternalServerError()
+            head, entries = git_repo.manifest.snapshot()
+    except RequestException as err:
+        return err.response()
+
+    etag = '"{0}"'.format(head)
+    headers = [('ETag', etag), ('Cache-Control', 'no-cache')]
+    if _etag_matches(environ.get('HTTP_IF_NONE_MATCH'), etag):
+        return ContentResponse(http.client.NOT_MODIFIED, extra_headers=headers)
+    files = [dict(path=path, blob=blob, author=author,
+                  pub_date=format_published_date(timestamp))
+             for path, (blob, author, timestamp) in sorted(entries.items())]
+    content = json.dumps(dict(head=head, files=files)).encode('utf-8')
+    return ContentResponse(http.client.OK, content, 'application/json; charset=utf-8',
+                           extra_headers=headers)
+
+
+def _etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or etag in tags or 'W/' + etag in tags
 
 
 def null_handler(environ):
@@ -137,12 +565,18 @@ def parse_request(environ):
     """
     query_params = parse_qs(environ["QUERY_STRING"])
     debug = ("debug" in query_params)
-
-    script_form, error = ScriptFormFactory.create(environ)
+    asynchronous = ("async" in query_params)
+    if "upload" in query_params:
+        # Every chunk of a resumable upload is already in
+        upload = UploadStore(get_uploads_dir(environ)).load(query_params["upload"][0])
+        return upload.form(), debug, asynchronous
+
+    script_form, error = ScriptFormFactory.create(environ, MAX_FILESIZE_BYTES,
+                                                  environ.get('SCRIPT_REPOSITORY_SPOOL_DIR'))
     if error:
         raise BadRequestException(summary=error[0], detail='\n'.join(error[1:]))
 
-    return script_form, debug
+    return script_form, debug, asynchronous
 
 
 def get_local_repo_path(environ, debug, err_stream):
@@ -157,59 +591,267 @@ def get_local_repo_path(environ, debug, err_stream):
         raise InternalServerError()
 
 
+def start_trace(environ, handler_name):
+    """Begin tracing the request if it is sampled. Returns the trace to pass
+    to record_request or None"""
+    return tracing.begin(handler_name,
+                         _get_seconds_setting(environ, 'SCRIPT_REPOSITORY_TRACE_SAMPLE'),
+                         method=environ['REQUEST_METHOD'], query=environ['QUERY_STRING'])
+
+
+def admit_change(environ):
+    """Take a place for the change requested if admission control has been
+    configured, judging its size from the Content-Length.
+      :returns The Admission to release when the change is done, or None
+      :raises ServiceUnavailableException if the clone has too many changes in flight
+    """
+    max_in_flight = _get_integer_setting(environ, 'SCRIPT_REPOSITORY_MAX_IN_FLIGHT')
+    if not max_in_flight:
+        return None
+    debug = "debug" in parse_qs(environ["QUERY_STRING"])
+    local_repo_root = get_local_repo_path(environ, debug, environ["wsgi.errors"])
+    content_length = environ.get('CONTENT_LENGTH', '')
+    size = int(content_length) if content_length.isdigit() else None
+    return get_admission_controller(local_repo_root).admit(
+        size, max_in_flight,
+        _get_integer_setting(environ, 'SCRIPT_REPOSITORY_LARGE_UPLOAD_BYTES'))
+
+
+def record_request(environ, response, seconds, trace=None):
+    """Count a finished request, keep its trace if it is slow or failed and
+    save the figures of this worker"""
+    method = environ['REQUEST_METHOD']
+    code = response.status.split()[0]
+    slow = _get_seconds_setting(environ, 'SCRIPT_REPOSITORY_TRACE_SLOW')
+    tracing.end(trace, int(code), slow if slow is not None else tracing.DEFAULT_SLOW_SECS)
+    metrics.increment('scriptrepository_requests_total', method=method, code=code)
+    metrics.observe('scriptrepository_request_seconds', seconds, method=method)
+    metrics.flush(get_metrics_dir(environ))
+
+
+def get_metrics_dir(environ):
+    """Return the directory that each worker saves its metrics to"""
+    return environ.get('SCRIPT_REPOSITORY_METRICS_DIR', metrics.DEFAULT_METRICS_DIR)
+
+
+def is_admin(environ):
+    """Return True if the request gives the admin token as a bearer token.
+    No request is an admin request if the token is not set"""
+    token = environ.get('SCRIPT_REPOSITORY_ADMIN_TOKEN')
+    if not token:
+        return False
+    scheme, _, credentials = environ.get('HTTP_AUTHORIZATION', '').partition(' ')
+    return scheme.lower() == 'bearer' and \
+        hmac.compare_digest(credentials.strip().encode('utf-8'), token.encode('utf-8'))
+
+
+def get_jobs_dir(environ):
+    """Return the directory holding the status of asynchronous jobs"""
+    return environ.get('SCRIPT_REPOSITORY_JOBS_DIR', DEFAULT_JOBS_DIR)
+
+
+def get_uploads_dir(environ):
+    """Return the directory holding the resumable uploads in progress"""
+    return environ.get('SCRIPT_REPOSITORY_UPLOADS_DIR', DEFAULT_UPLOADS_DIR)
+
+
+def get_idempotency_dir(environ):
+    """Return the directory holding the responses to idempotency keys"""
+    return environ.get('SCRIPT_REPOSITORY_IDEMPOTENCY_DIR', DEFAULT_IDEMPOTENCY_DIR)
+
+
+def get_group_commit_window(environ):
+    """Return the group commit window in seconds or None if group commits
+    have not been enabled
+    """
+    return _get_seconds_setting(environ, 'SCRIPT_REPOSITORY_GROUP_COMMIT_WINDOW')
+
+
+def get_max_sync_age(environ, local_repo_root):
+    """Return the number of seconds a clone may go without a sync before a
+    request syncs it inline. Starts the background sync daemon for the clone
+    if one has been configured.
+    """
+    interval = _get_seconds_setting(environ, 'SCRIPT_REPOSITORY_SYNC_INTERVAL')
+    if interval is not None and interval > 0:
+        start_sync_daemon(local_repo_root, interval)
+    max_age = _get_seconds_setting(environ, 'SCRIPT_REPOSITORY_SYNC_MAX_AGE')
+    return max_age if max_age is not None else 0
+
+
+def schedule_maintenance(environ, local_repo_root):
+    """Start the maintenance daemon for the clone if one has been configured"""
+    interval = _get_seconds_setting(environ, 'SCRIPT_REPOSITORY_MAINTENANCE_INTERVAL')
+    if interval is None or interval <= 0:
+        return
+    idle_secs = _get_seconds_setting(environ, 'SCRIPT_REPOSITORY_MAINTENANCE_IDLE')
+    start_maintenance_daemon(open_repository(local_repo_root), interval,
+                             idle_secs if idle_secs is not None else DEFAULT_IDLE_SECS)
+
+
+def repository_gauges(environ):
+    """Return the object and pack counts of each configured clone as gauges
+    for the metrics"""
+    gauges = []
+    for envvar in ('SCRIPT_REPOSITORY_PATH', 'SCRIPT_REPOSITORY_PATH_DEBUG'):
+        root = environ.get(envvar)
+        if root is None or not os.path.isdir(root):
+            continue
+        counts = object_counts(open_repository(root).git_dir)
+        for name in ('loose_objects', 'packs', 'packed_objects'):
+            gauges.append(('scriptrepository_' + name, dict(repository=root), counts[name]))
+    return gauges
+
+
+def get_lock_timeout(environ):
+    """Return the number of seconds a request may wait for the repository
+    lock or None to wait indefinitely
+    """
+    return _get_seconds_setting(environ, 'SCRIPT_REPOSITORY_LOCK_TIMEOUT')
+
+
+def _get_seconds_setting(environ, name):
+    """Return a non-negative number of seconds from the environment
+    or None if it is not set"""
+    try:
+        value = float(environ.get(name, ''))
+    except ValueError:
+        return None
+    return value if value >= 0 else None
+
+
+def _get_integer_setting(environ, name):
+    """Return a non-negative integer from the environment or None if it is
+    not set"""
+    try:
+        value = int(environ.get(name, ''))
+    except ValueError:
+        return None
+    return value if value >= 0 else None
+
+
 # ------------------------------------------------------------------------------
 # Repository update
 # ------------------------------------------------------------------------------
-def update_central_repo(local_repo_root, script_form, err_stream):
+def update_central_repo(local_repo_root, script_form, err_stream, max_sync_age=0,
+                        on_committed=None, lock_timeout=None):
     """This assumes that the script is running as a user who has permissions
-    to push to the central github repository
+    to push to the central github repository. The sync with the remote is
+    skipped if the clone was synced less than max_sync_age seconds ago.
+    on_committed is called, if given, between the commit and the push.
+    A ServiceUnavailableException is raised if the clone cannot be locked
+    within lock_timeout seconds.
     """
     log = logging.getLogger(__name__)
 
-    git_repo = GitRepository(local_repo_root)
-    # Ensure we are up to date with the remote and any local
-    # changes are thrown away
-    log.debug("Syncing with remote")
-    git_repo.sync_with_remote()
+    git_repo = open_repository(local_repo_root)
+    try:
+        with tracing.span("update_central_repo"), git_repo.lock.hold(lock_timeout):
+            # Ensure we are up to date with the remote and any local
+            # changes are thrown away
+            log.debug("Syncing with remote")
+            sync_if_stale(git_repo, max_sync_age)
+            commit_info = prepare_commit(git_repo, script_form, err_stream)
+            pub_dates = dict()
+            if commit_info.filelist:
+                try:
+                    pub_dates = git_repo.commit_all_and_push([commit_info],
+                                                             on_committed=on_committed)
+                except RuntimeError as exc:
+                    err_stream.write("Script repository upload: git error "
+                                     "- {0}.".format(traceback.format_exc()))
+                    raise InternalServerError()
+                # The clone now matches the remote
+                mark_synced(local_repo_root)
+    except LockTimeout as exc:
+        raise server_busy(exc.timeout)
+
+    return change_response(git_repo, script_form, commit_info, pub_dates)
+
+
+def group_update_central_repo(local_repo_root, script_form, err_stream, window,
+                              max_sync_age=0, on_committed=None, lock_timeout=None):
+    """Hand the change to the group committer for the repository. Changes
+    arriving within window seconds of each other share a single sync, commit
+    chain and push.
+    """
+    committer = get_group_committer(local_repo_root, window,
+                                    prepare=prepare_commit,
+                                    committer_name=COMMITTER_NAME,
+                                    max_sync_age=max_sync_age)
+    published_date = committer.submit(script_form, err_stream, on_committed, lock_timeout)
+    return ServerResponse(http.client.OK, message="success",
+                          published_date=published_date)
+
+
+def prepare_commit(git_repo, script_form, err_stream):
+    """Apply the change requested by the form to the working tree of
+    git_repo and describe the commit required to record it. The repository
+    is assumed to be synchronised with the remote already. Uploaded files
+    identical to those already committed are not written and are listed in
+    the existing_dates of the result instead.
+    """
+    log = logging.getLogger(__name__)
+    local_repo_root = git_repo.worktree
+    existing_dates = dict()
     if script_form.is_upload():
         log.debug("Processing script upload")
-        # size limit
-        if script_form.filesize > MAX_FILESIZE_BYTES:
-            raise BadRequestException("File is too large.",
-                                      "Maximum filesize is "
-                                      "{0} bytes".format(MAX_FILESIZE_BYTES))
-        filepath, error = script_form.write_script_to_disk(local_repo_root)
-        if error:
-            detail = '\n'.join(error)
-            err_stream.write("Script repository upload: error writing"
-                             " script to disk - {0}.".format(detail))
-            raise InternalServerError()
-        log.debug("Wrote new file content to '{}'".format(filepath))
-        with open(filepath, 'rb') as uploaded:
-            content = uploaded.read()
-        log.debug("New content:\n{}".format(uploaded))
+        filelist = []
+        for fileitem, filepath in script_form.uploads(local_repo_root):
+            existing_date = git_repo.published_date_if_unchanged(
+                filepath, blob_id(fileitem.sha1, fileitem.size, fileitem.path))
+            if existing_date is not None:
+                log.debug("Content of '%s' is unchanged, skipping it", filepath)
+                existing_dates[filepath] = existing_date
+                continue
+            # The size limit has been enforced while parsing the form
+            with metrics.timed("write"):
+                error = script_form.write_file_to_disk(fileitem, filepath)
+            if error:
+                detail = '\n'.join(error)
+                err_stream.write("Script repository upload: error writing"
+                                 " script to disk - {0}.".format(detail))
+                raise InternalServerError()
+            log.debug("Wrote %s bytes with sha1 %s to '%s'", fileitem.size, fileitem.sha1,
+                      filepath)
+            filelist.append(filepath)
     else:
         # Treated as a remove request
         filepath = script_form.filepath(local_repo_root)
-        if not git_repo.user_can_delete(filepath, script_form.author,
-                                        script_form.mail):
+        with metrics.timed("check_owner"):
+            can_delete = git_repo.user_can_delete(filepath, script_form.author,
+                                                  script_form.mail)
+        if not can_delete:
             raise BadRequestException('Permissions error.',
                                       'You are not allowed to remove this file'
                                       ' as it belongs to another user')
+        filelist = [filepath]
+
+    return GitCommitInfo(author=script_form.author,
+                         email=script_form.mail,
+                         comment=script_form.comment,
+                         filelist=filelist,
+                         committer=COMMITTER_NAME,
+                         add=script_form.is_upload(),
+                         existing_dates=existing_dates)
 
-    commit_info = GitCommitInfo(author=script_form.author,
-                                email=script_form.mail,
-                                comment=script_form.comment,
-                                filelist=[filepath],
-                                committer=COMMITTER_NAME,
-                                add=script_form.is_upload())
-    try:
-        published_date = git_repo.commit_and_push(commit_info,
-                                                  add_changes=script_form.is_upload())
-    except RuntimeError as exc:
-        err_stream.write("Script repository upload: git error "
-                         "- {0}.".format(traceback.format_exc()))
-        raise InternalServerError()
 
+def change_response(git_repo, script_form, commit_info, pub_dates):
+    """Return the response to a change once it is in the repository.
+      :param pub_dates A dictionary mapping each file committed for the change
+                       to its published date
+    """
+    dates = dict(commit_info.existing_dates)
+    dates.update(pub_dates)
+    if not script_form.is_bulk():
+        published_date = next(iter(dates.values()), '')
+        return ServerResponse(http.client.OK, message="success",
+                              published_date=published_date)
+    files = []
+    for filepath in script_form.filepaths(git_repo.worktree):
+        files.append(dict(path=os.path.relpath(filepath, git_repo.worktree).replace(os.sep, '/'),
+                          pub_date=dates[filepath],
+                          status='unchanged' if filepath in commit_info.existing_dates
+                          else 'committed'))
     return ServerResponse(http.client.OK, message="success",
-                          published_date=published_date)
+                          published_date=files[0]['pub_date'], files=files)
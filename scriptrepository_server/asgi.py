@@ -0,0 +1,334 @@
+"""Defines the ASGI application entry point for the upload server
+
+It accepts the same requests and gives the same responses as the WSGI
+application in app.py, reusing its form validation and responses. The
+difference is that git runs in asyncio subprocesses so a single event loop
+can hold many uploads in flight while they wait on the network. The git
+work for each repository is serialised by an asyncio.Lock, so that only one
+task per event loop waits in a thread for the repository lock shared with
+other processes.
+
+Configuration is read from the SCRIPT_REPOSITORY_* variables of the process
+environment. Group commits, asynchronous jobs and the background sync daemon
+are features of the WSGI application and are not used here, and a clone
+should not be shared between this application and WSGI workers in the same
+process.
+
+Bare clones are supported by running the plumbing backend in a worker thread.
+"""
+import asyncio
+import logging
+import os
+import tempfile
+import time
+import traceback
+from urllib.parse import parse_qs
+import weakref
+
+from . import app, logs, metrics, tracing
+from .app import (MAX_FILESIZE_BYTES, _get_seconds_setting, admit_change, change_response,
+                  claim_idempotency_key, compress_response, finish_upload,
+                  get_local_repo_path, get_lock_timeout, handle_get, handle_upload_start,
+                  null_handler, parse_request, prepare_commit, record_request, start_trace)
+from .base import MAX_BULK_BYTES, MAX_FORM_OVERHEAD_BYTES
+from .errors import BadRequestException, InternalServerError, RequestException, server_busy
+from .locking import LockTimeout
+from .repository import BareGitRepository, _git_args, open_repository
+from .sync import mark_synced, sync_age
+
+# Request bodies are held in memory up to this size before going to disk
+BODY_SPOOL_BYTES = 256*1024
+
+# One asyncio.Lock per repository and event loop, keyed by real path
+_LOCKS = weakref.WeakKeyDictionary()
+
+
+def _repository_lock(root):
+    locks = _LOCKS.setdefault(asyncio.get_running_loop(), dict())
+    key = os.path.realpath(root)
+    lock = locks.get(key)
+    if lock is None:
+        lock = asyncio.Lock()
+        locks[key] = lock
+    return lock
+
+
+# -----------------------------------------------------------------------------
+# Entry point
+# -----------------------------------------------------------------------------
+async def application(scope, receive, send):
+    """Called by the ASGI server for each connection
+      :param scope A dictionary describing the connection
+      :param receive An awaitable returning the next event from the client
+      :param send An awaitable sending an event to the client
+    """
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+    environ = _create_environ(scope)
+    # Each connection is handled in a task of its own, with its own context
+    request_id, _ = logs.begin_request(environ.get('HTTP_X_REQUEST_ID'))
+    logging.getLogger(__name__).info("Received request=%s", scope['method'])
+    start = time.monotonic()
+    trace = start_trace(environ, 'handle_' + scope['method'].lower())
+    if scope['method'] == 'POST':
+        response = await handle_post(environ, receive)
+    elif scope['method'] == 'GET':
+        response = await asyncio.to_thread(handle_get, environ)
+    elif scope['method'] == 'PUT':
+        response = await handle_put(environ, receive)
+    else:
+        response = null_handler(environ)
+    await asyncio.to_thread(record_request, environ, response, time.monotonic() - start,
+                            trace)
+    response = await asyncio.to_thread(compress_response, environ, response)
+    response.headers.append(('X-Request-ID', request_id))
+
+    await send({'type': 'http.response.start',
+                'status': int(response.status.split()[0]),
+                'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                            for name, value in response.headers]})
+    await send({'type': 'http.response.body', 'body': response.content})
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+def _create_environ(scope):
+    """Build the subset of a WSGI environment used by the request handlers"""
+    headers = {name.decode('latin-1').lower(): value.decode('latin-1')
+               for name, value in scope.get('headers', [])}
+    environ = {key: value for key, value in os.environ.items()
+               if key.startswith('SCRIPT_REPOSITORY_')}
+    environ.update({
+        'REQUEST_METHOD': scope['method'],
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'CONTENT_TYPE': headers.get('content-type', ''),
+        'CONTENT_LENGTH': headers.get('content-length', ''),
+        'wsgi.errors': _LogStream(),
+    })
+    for name, value in headers.items():
+        if name not in ('content-type', 'content-length'):
+            environ['HTTP_' + name.upper().replace('-', '_')] = value
+    return environ
+
+
+class _LogStream(object):
+    """Stands in for wsgi.errors by writing to the log"""
+
+    def write(self, msg):
+        logging.getLogger(__name__).error(msg)
+
+
+# ------------------------------------------------------------------------------
+# Handler methods
+# ------------------------------------------------------------------------------
+async def handle_post(environ, receive):
+    log = logging.getLogger(__name__)
+    log.info("Handling POST request")
+
+    if parse_qs(environ["QUERY_STRING"]).get("upload") == ["start"]:
+        return await _with_body(environ, receive, handle_upload_start)
+    err_stream = environ["wsgi.errors"]
+    script_form, admission, claim = None, None, None
+    try:
+        admission = admit_change(environ)
+        environ['wsgi.input'] = await _read_body(environ, receive)
+        try:
+            with metrics.timed("parse"):
+                script_form, debug, _ = await asyncio.to_thread(parse_request, environ)
+        finally:
+            environ['wsgi.input'].close()
+        local_repo_root = get_local_repo_path(environ, debug, err_stream)
+        max_sync_age = _get_seconds_setting(environ, 'SCRIPT_REPOSITORY_SYNC_MAX_AGE') or 0
+        # Waiting for an attempt with the same key must not block the loop
+        claim = await asyncio.to_thread(claim_idempotency_key, environ, script_form,
+                                        local_repo_root)
+        if claim.response is not None:
+            return claim.response
+        try:
+            with tracing.span("update_central_repo"):
+                response = await update_central_repo(local_repo_root, script_form, err_stream,
+                                                     max_sync_age, get_lock_timeout(environ))
+            if admission is not None:
+                admission.release(completed=True)
+        except RequestException as err:
+            response = err.response()
+        await asyncio.to_thread(finish_upload, environ, response)
+        return claim.record(response)
+    except RequestException as err:
+        return err.response()
+    finally:
+        if claim is not None:
+            claim.release()
+        if script_form is not None:
+            script_form.close()
+        if admission is not None:
+            admission.release()
+
+
+async def handle_put(environ, receive):
+    """Append a chunk to a resumable upload"""
+    return await _with_body(environ, receive, app.handle_put)
+
+
+async def _with_body(environ, receive, handler):
+    """Read the body and pass the request to a blocking handler in a thread"""
+    try:
+        environ['wsgi.input'] = await _read_body(environ, receive)
+    except RequestException as err:
+        return err.response()
+    try:
+        return await asyncio.to_thread(handler, environ)
+    finally:
+        environ['wsgi.input'].close()
+
+
+async def _read_body(environ, receive):
+    """Read the request body into a temporary file, stopping as soon as it
+    is too large to hold an acceptable form"""
+    limit = max(MAX_FILESIZE_BYTES, MAX_BULK_BYTES) + MAX_FORM_OVERHEAD_BYTES
+    too_large = BadRequestException("File is too large.",
+                                    "Maximum filesize is {0} bytes".format(MAX_FILESIZE_BYTES))
+    if environ['CONTENT_LENGTH'].isdigit() and int(environ['CONTENT_LENGTH']) > limit:
+        raise too_large
+    body = tempfile.SpooledTemporaryFile(max_size=BODY_SPOOL_BYTES)
+    size, more_body = 0, True
+    while more_body:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if size > limit:
+            body.close()
+            raise too_large
+        body.write(chunk)
+        more_body = message.get('more_body', False)
+    body.seek(0)
+    return body
+
+
+# ------------------------------------------------------------------------------
+# Repository update
+# ------------------------------------------------------------------------------
+async def update_central_repo(local_repo_root, script_form, err_stream, max_sync_age=0,
+                              lock_timeout=None):
+    """The asyncio equivalent of app.update_central_repo"""
+    git_repo = AsyncGitRepository(open_repository(local_repo_root))
+    # The timeout covers the wait for both locks
+    deadline = None if lock_timeout is None else time.monotonic() + lock_timeout
+    try:
+        await asyncio.wait_for(git_repo.lock.acquire(), lock_timeout)
+    except asyncio.TimeoutError:
+        git_repo.repo.lock.record_wait(lock_timeout, timed_out=True)
+        raise server_busy(lock_timeout)
+    try:
+        remaining = None if deadline is None else max(0, deadline - time.monotonic())
+        async with git_repo.repo.lock.hold_async(remaining):
+            age = sync_age(local_repo_root)
+            if age is None or age >= max_sync_age:
+                await git_repo.sync_with_remote()
+                mark_synced(local_repo_root)
+            # Writing the file or checking ownership does not wait on the network
+            commit_info = await asyncio.to_thread(prepare_commit, git_repo.repo,
+                                                  script_form, err_stream)
+            pub_dates = dict()
+            if commit_info.filelist:
+                try:
+                    pub_dates = await git_repo.commit_all_and_push([commit_info])
+                except RuntimeError:
+                    err_stream.write("Script repository upload: git error "
+                                     "- {0}.".format(traceback.format_exc()))
+                    raise InternalServerError()
+                mark_synced(local_repo_root)
+    except LockTimeout:
+        raise server_busy(lock_timeout)
+    finally:
+        git_repo.lock.release()
+
+    return change_response(git_repo.repo, script_form, commit_info, pub_dates)
+
+
+# ------------------------------------------------------------------------------
+class AsyncGitRepository(object):
+    """Runs the commands of a GitRepository as asyncio subprocesses. A push
+    runs GitRepository.push_with_rebase in a thread so that its retries are
+    handled in one place. Bare clones fall back to running the synchronous
+    backend in a thread."""
+
+    def __init__(self, repo):
+        self.repo = repo
+        self.lock = _repository_lock(repo.root)
+        self._in_thread = isinstance(repo, BareGitRepository)
+
+    async def sync_with_remote(self):
+        if self._in_thread:
+            return await asyncio.to_thread(self.repo.sync_with_remote)
+        with metrics.timed("sync"):
+            await self._git("reset", ["--hard", self.repo.remote + "/" + self.repo.branch])
+            await self._git("pull", ["--rebase"])
+        await asyncio.to_thread(self.repo._refresh_indexes)
+
+    async def commit_all_and_push(self, commits):
+        """Transactional like GitRepository.commit_all_and_push"""
+        if self._in_thread:
+            return await asyncio.to_thread(self.repo.commit_all_and_push, commits)
+        pub_dates = dict()
+        sha1_at_begin = (await self._git("rev-parse", ["HEAD"])).rstrip()
+        try:
+            with metrics.timed("commit"):
+                for commit in commits:
+                    if commit.add:
+                        for filepath in commit.filelist:
+                            pub_dates[filepath] = self.repo._published_date(filepath)
+                        await self._git("add", commit.filelist)
+                    else:
+                        await self._git("rm", commit.filelist)
+                    await self._git("commit", ['--author="{0} <{1}>"'.format(commit.author,
+                                                                             commit.email),
+                                               '-m {0}'.format(commit.comment)],
+                                    username=commit.author, email=commit.email)
+            with metrics.timed("push"):
+                # The retries, their backoff and the recovery from a failed
+                # rebase are those of the synchronous backend
+                await asyncio.to_thread(self.repo.push_with_rebase, commits[-1].author,
+                                        commits[-1].email)
+        except Exception:
+            await self._git("reset", ["--hard", sha1_at_begin])
+            raise
+        await asyncio.to_thread(self.repo._refresh_indexes)
+        return pub_dates
+
+    async def _git(self, cmd, args, username=None, email=None):
+        """Run a git command in a subprocess without blocking the event loop.
+        Errors are reported in the same way as repository._shellcmd"""
+        start = time.monotonic()
+        try:
+            with tracing.span('git', command=cmd, args=list(args)):
+                return await self._run_git(cmd, args, username, email)
+        finally:
+            metrics.observe('scriptrepository_git_seconds', time.monotonic() - start,
+                            command=cmd)
+
+    async def _run_git(self, cmd, args, username, email):
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                "git", *_git_args(cmd, args, username, email), cwd=self.repo.root,
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        except (OSError, ValueError) as err:
+            raise RuntimeError(err)
+        stdout, stderr = await proc.communicate()
+        if proc.returncode == 0:
+            return str(stdout, encoding='utf-8')
+        else:
+            raise RuntimeError(stdout + stderr)
@@ -2,31 +2,48 @@
 """
 
 
-import cgi
+import hashlib
 import http.client
 import json
 from logging import getLogger
 import os
+import posixpath
 import re
+import tarfile
+import zipfile
+
+from .multipart import MultipartError, SpooledFileField, parse_form
 
 # Email regex
 MAIL_RE = re.compile(r'[^@]+@[^@]+\.[^@]+')
+# Allowance for the non-file fields and multipart framing of a request
+MAX_FORM_OVERHEAD_BYTES = 64*1024
+# Maximum number of files in a bulk upload
+MAX_BULK_FILES = 100
+# Maximum combined size of the files, or the archive, in a bulk upload
+MAX_BULK_BYTES = 8*1024*1024
+# Size of each block copied out of an archive
+_ARCHIVE_BLOCK_BYTES = 64*1024
 
 
 # ------------------------------------------------------------------------------
 class ScriptForm(object):
 
     required_fields = ("author", "mail", "comment")
+    # Set if the client sent an idempotency_key field
+    idempotency_key = None
 
     @classmethod
-    def create(cls, request_fields):
+    def create(cls, request_fields, max_filesize=None, spool_dir=None):
         # sanity check
         data = dict()
         missing, invalid = [], []
         for name in cls.required_fields:
             if name in request_fields:
-                value = request_fields[name].value
-                if cls.validate_field(name, value):
+                field = request_fields[name]
+                # Validate files by name so the content is never loaded here
+                value = field.filename if name == "file" else field.value
+                if value is not None and cls.validate_field(name, value):
                     data[name] = value
                 else:
                     invalid.append(name)
@@ -38,7 +55,7 @@ class ScriptForm(object):
             # if we have it
             if "file" in data:
                 del data["file"]
-                data["fileitem"] = request_fields[name]
+                data["fileitem"] = request_fields["file"]
             return cls(**data), None
         else:
             summary = 'Incomplete form information supplied.'
@@ -63,6 +80,27 @@ class ScriptForm(object):
         self.mail = mail
         self.comment = comment
 
+    def close(self):
+        """Release any resources held by the form"""
+        pass
+
+    def is_bulk(self):
+        return False
+
+    def owns(self, field):
+        """Return True if the form has taken ownership of the given field"""
+        return False
+
+    def fingerprint(self):
+        """Return a digest identifying the change the form asks for"""
+        parts = [type(self).__name__, self.author, self.mail, self.comment]
+        if self.is_upload():
+            for fileitem, filepath in self.uploads(''):
+                parts.extend((filepath, fileitem.sha1))
+        else:
+            parts.append(self.filepath(''))
+        return hashlib.sha1('\0'.join(parts).encode('utf-8')).hexdigest()
+
 
 # ------------------------------------------------------------------------------
 class ScriptUploadForm(ScriptForm):
@@ -79,7 +117,18 @@ class ScriptUploadForm(ScriptForm):
 
     @property
     def filesize(self):
-        return len(self.fileitem.value)
+        return self.fileitem.size
+
+    @property
+    def sha1(self):
+        """SHA-1 of the uploaded content, computed as it was received"""
+        return self.fileitem.sha1
+
+    def close(self):
+        self.fileitem.close()
+
+    def owns(self, field):
+        return field is self.fileitem
 
     def is_upload(self):
         return True
@@ -90,26 +139,211 @@ class ScriptUploadForm(ScriptForm):
         return os.path.join(root, self.rel_path, filename)
 
     def write_script_to_disk(self, root):
-        """Dumps the uploaded file contents to disk. The location is
+        """Moves the uploaded file contents into place on disk. The location is
         formed by os.path.join(root, self.rel_path), where rel_path is
-        the path specified by the form
+        the path specified by the form. The content was spooled to disk when
+        the form was parsed so it is not copied through memory here.
         """
         filepath = self.filepath(root)
-        if os.path.isdir(filepath):
-            return None, ("Cannot replace directory with a file.",
-                          "{0} already exists as a directory.".format(filepath))
-        try:
-            # Make sure the directory exists
-            dirpath = os.path.dirname(filepath)
-            if not os.path.exists(dirpath):
-                os.makedirs(dirpath)
-            with open(filepath, 'wb') as uploaded:
-                uploaded.write(self.fileitem.file.read())
-        except Exception as err:
-            return None, ("Unable to write script to disk.", str(err))
+        error = self.write_file_to_disk(self.fileitem, filepath)
+        if error is not None:
+            return None, error
 
         return filepath, None
 
+    def uploads(self, root):
+        """Return (fileitem, filepath) for each uploaded file"""
+        return [(self.fileitem, self.filepath(root))]
+
+    def write_file_to_disk(self, fileitem, filepath):
+        """Moves the contents of an uploaded file to filepath. Returns an error or None"""
+        return _move_into_place(fileitem, filepath)
+
+
+def _move_into_place(fileitem, filepath):
+    """Move a spooled file to filepath, creating its directory if required.
+    Returns an error or None"""
+    if os.path.isdir(filepath):
+        return ("Cannot replace directory with a file.",
+                "{0} already exists as a directory.".format(filepath))
+    try:
+        # Make sure the directory exists
+        dirpath = os.path.dirname(filepath)
+        if not os.path.exists(dirpath):
+            os.makedirs(dirpath)
+        fileitem.move_to(filepath)
+    except Exception as err:
+        return ("Unable to write script to disk.", str(err))
+    return None
+
+
+class ScriptBulkUploadForm(ScriptForm):
+    """Several files uploaded to the same folder in one request. They arrive
+    either as repeated file parts or as a single tar or zip archive, whose
+    members keep their relative paths below the folder.
+    """
+    required_fields = ScriptForm.required_fields + ("path",)
+    archive_field = "archive"
+
+    @classmethod
+    def create(cls, request_fields, max_filesize=None, spool_dir=None):
+        form, error = super(ScriptBulkUploadForm, cls).create(
+            _without_files(request_fields))
+        if form is None:
+            return None, error
+        if cls.archive_field in request_fields:
+            fileitems, error = _extract_archive(request_fields[cls.archive_field],
+                                                max_filesize, spool_dir)
+        else:
+            fileitems, error = _bulk_file_parts(request_fields.getlist("file"))
+        if error is None:
+            error = _check_bulk_names(fileitems)
+        if error is not None:
+            for fileitem in fileitems:
+                if fileitem.name == cls.archive_field:
+                    fileitem.close()
+            return None, error
+        form.fileitems = fileitems
+        return form, None
+
+    def __init__(self, author, mail, comment, path):
+        super(ScriptBulkUploadForm, self).__init__(author, mail, comment)
+        self.rel_path = path
+        self.fileitems = []
+
+    def close(self):
+        for fileitem in self.fileitems:
+            fileitem.close()
+
+    def owns(self, field):
+        return any(field is fileitem for fileitem in self.fileitems)
+
+    def is_upload(self):
+        return True
+
+    def is_bulk(self):
+        return True
+
+    def filepaths(self, root):
+        """Return the location of each file below os.path.join(root, self.rel_path)"""
+        return [os.path.join(root, self.rel_path, *_bulk_name(fileitem).split('/'))
+                for fileitem in self.fileitems]
+
+    def uploads(self, root):
+        """Return (fileitem, filepath) for each uploaded file"""
+        return list(zip(self.fileitems, self.filepaths(root)))
+
+    def write_file_to_disk(self, fileitem, filepath):
+        """Moves the contents of one of the uploaded files to filepath.
+        Returns an error or None"""
+        return _move_into_place(fileitem, filepath)
+
+
+def _without_files(request_fields):
+    return {name: field for name, field in request_fields.items()
+            if name not in ("file", ScriptBulkUploadForm.archive_field)}
+
+
+def _bulk_name(fileitem):
+    """Return the path of a bulk file relative to the upload folder"""
+    if fileitem.name == ScriptBulkUploadForm.archive_field:
+        return fileitem.filename
+    # strip leading path from filename to avoid directory traversal attacks
+    return os.path.basename(fileitem.filename)
+
+
+def _bulk_file_parts(fields):
+    for field in fields:
+        if not field.filename or not _bulk_name(field) or field.file is None:
+            return fields, ('Incomplete form information supplied.',
+                            'Invalid fields: file')
+    return fields, None
+
+
+def _check_bulk_names(fileitems):
+    if not fileitems:
+        return ('Incomplete form information supplied.', 'Missing fields: file')
+    if len(fileitems) > MAX_BULK_FILES:
+        return ('Too many files.',
+                'Maximum number of files is {0}'.format(MAX_BULK_FILES))
+    names = [_bulk_name(fileitem) for fileitem in fileitems]
+    duplicates = sorted(set(name for name in names if names.count(name) > 1))
+    if duplicates:
+        return ('Duplicate files.', 'Files uploaded more than once: ' + ','.join(duplicates))
+    return None
+
+
+def _archive_member_name(name):
+    """Return the normalised relative path of an archive member or None if it
+    would be written outside of the upload folder"""
+    name = posixpath.normpath(name.replace('\\', '/'))
+    if name.startswith('/') or name == '.' or name == '..' or name.startswith('../'):
+        return None
+    return name
+
+
+def _extract_archive(archive, max_filesize, spool_dir):
+    """Spool every regular file in a tar or zip archive.
+      :returns (list of SpooledFileField, error)
+    """
+    if archive.file is None:
+        return [], ('Incomplete form information supplied.', 'Invalid fields: archive')
+    members = []
+    try:
+        if zipfile.is_zipfile(archive.path):
+            with zipfile.ZipFile(archive.path) as zip_archive:
+                for info in zip_archive.infolist():
+                    if info.is_dir():
+                        continue
+                    with zip_archive.open(info) as source:
+                        error = _spool_member(members, info.filename, source,
+                                              max_filesize, spool_dir)
+                    if error is not None:
+                        break
+        elif tarfile.is_tarfile(archive.path):
+            with tarfile.open(archive.path) as tar_archive:
+                error = None
+                for info in tar_archive:
+                    if info.isdir():
+                        continue
+                    if not info.isfile():
+                        error = ('Invalid archive.',
+                                 'Only regular files are allowed: {0}'.format(info.name))
+                        break
+                    error = _spool_member(members, info.name,
+                                          tar_archive.extractfile(info),
+                                          max_filesize, spool_dir)
+                    if error is not None:
+                        break
+        else:
+            error = ('Invalid archive.', 'Archives must be tar or zip files')
+    except (OSError, tarfile.TarError, zipfile.BadZipFile) as err:
+        error = ('Invalid archive.', str(err))
+    if error is not None:
+        for member in members:
+            member.close()
+        return [], error
+    return members, None
+
+
+def _spool_member(members, name, source, max_filesize, spool_dir):
+    """Copy an archive member to a spool file, appending it to members.
+    Returns an error if it is not acceptable"""
+    member_name = _archive_member_name(name)
+    if member_name is None:
+        return ('Invalid archive.', 'Path outside of the upload folder: {0}'.format(name))
+    if len(members) >= MAX_BULK_FILES:
+        return ('Too many files.', 'Maximum number of files is {0}'.format(MAX_BULK_FILES))
+    member = SpooledFileField(ScriptBulkUploadForm.archive_field, member_name, spool_dir)
+    members.append(member)
+    for block in iter(lambda: source.read(_ARCHIVE_BLOCK_BYTES), b''):
+        if max_filesize is not None and member.size + len(block) > max_filesize:
+            return ("File is too large.",
+                    "Maximum filesize is {0} bytes: {1}".format(max_filesize, member_name))
+        member.write(block)
+    member.file.flush()
+    return None
+
 
 class ScriptRemovalForm(ScriptForm):
 
@@ -130,45 +364,101 @@ class ScriptRemovalForm(ScriptForm):
 class ScriptFormFactory(object):
 
     @staticmethod
-    def create(environ):
-        """Create an appropriate scriptform for the environment
+    def create(environ, max_filesize, spool_dir=None):
+        """Create an appropriate scriptform for the environment. The body is
+        parsed, and decompressed if it is encoded, as it streams in and parsing
+        stops as soon as the file goes over max_filesize bytes. Files are
+        spooled to spool_dir, which should be on the same filesystem as the
+        repositories.
         """
-        request_fields = cgi.FieldStorage(fp=environ['wsgi.input'],
-                                          environ=environ, keep_blank_values=1)
+        too_large = ("File is too large.",
+                     "Maximum filesize is {0} bytes".format(max_filesize))
+        try:
+            content_length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            content_length = 0
+        # A bulk upload may be larger than a single file. A compressed body
+        # is held to the same limit once it is decompressed
+        max_body = max(max_filesize, MAX_BULK_BYTES) + MAX_FORM_OVERHEAD_BYTES
+        if content_length > max_body:
+            return None, too_large
+        try:
+            request_fields = parse_form(environ, max_filesize, spool_dir,
+                                        field_limits={ScriptBulkUploadForm.archive_field:
+                                                      MAX_BULK_BYTES},
+                                        max_total=MAX_BULK_BYTES,
+                                        max_body=max_body, max_files=MAX_BULK_FILES)
+        except MultipartError as err:
+            return None, (err.summary, err.detail)
         # This kind of breaks the encapsulation of ScriptRemovalForm and should
         # probably be a chain of responsibility...
-        if ScriptRemovalForm.extra_fields[0] not in request_fields:
+        if ScriptRemovalForm.extra_fields[0] in request_fields:
+            cls = ScriptRemovalForm
+        elif ScriptBulkUploadForm.archive_field in request_fields or \
+                len(request_fields.getlist("file")) > 1:
+            cls = ScriptBulkUploadForm
+        else:
             # Most of the time users upload things.
             cls = ScriptUploadForm
-        else:
-            cls = ScriptRemovalForm
         # end
 
-        return cls.create(request_fields)
+        script_form, error = cls.create(request_fields, max_filesize, spool_dir)
+        if script_form is not None and "idempotency_key" in request_fields:
+            script_form.idempotency_key = request_fields["idempotency_key"].value
+        # Anything not taken by the form is no longer needed
+        for field in request_fields.all_fields():
+            if script_form is None or not script_form.owns(field):
+                field.close()
+        return script_form, error
 
 
 class ServerResponse(object):
 
     def __init__(self, status_code, message, detail=None,
-                 published_date=None, shell=None):
+                 published_date=None, shell=None, job=None, extra_headers=None,
+                 files=None):
         self._create_status(status_code)
         self._create_body(message, detail,
-                          published_date, shell)
-        self._create_headers()
+                          published_date, shell, job, files)
+        self._create_headers(extra_headers)
 
     def _create_status(self, code):
         self.status = f"{code} {http.client.responses[code]}"
 
-    def _create_headers(self):
+    def _create_headers(self, extra_headers):
         self.headers = [
             ('Content-Type', 'application/json; charset=utf-8'),
             ('Content-Length', str(len(self.content)))
         ]
+        if extra_headers is not None:
+            self.headers.extend(extra_headers)
 
-    def _create_body(self, message, detail, published_date, shell):
+    def _create_body(self, message, detail, published_date, shell, job, files):
         detail = detail if detail is not None else ""
         pub_date = published_date if published_date is not None else ""
         shell = shell if shell is not None else ""
         data = dict(message=message, detail=detail,
                     pub_date=pub_date, shell=shell)
+        # Only asynchronous requests refer to a job
+        if job is not None:
+            data['job'] = job
+        # Only bulk uploads list their files
+        if files is not None:
+            data['files'] = files
+        self.published_date = pub_date
         self.content = json.dumps(data).encode('utf-8')
+
+
+class ContentResponse(object):
+    """A response whose body is given as it is rather than built from a
+    message, e.g. for the read-only endpoints"""
+
+    def __init__(self, status_code, content=b'', content_type=None, extra_headers=None):
+        self.status = f"{status_code} {http.client.responses[status_code]}"
+        self.content = content
+        self.headers = []
+        if content_type is not None:
+            self.headers.append(('Content-Type', content_type))
+        self.headers.append(('Content-Length', str(len(content))))
+        if extra_headers is not None:
+            self.headers.extend(extra_headers)
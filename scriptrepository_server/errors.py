@@ -2,6 +2,7 @@
 error scenarios
 """
 import http.client
+import math
 from .base import ServerResponse
 
 
@@ -29,6 +30,34 @@ class BadRequestException(RequestException):
         self.http_error_code = http.client.BAD_REQUEST
 
 
+class ForbiddenException(RequestException):
+    """Indicates a 403 error - the client may not see the resource
+    """
+
+    def __init__(self, summary, detail):
+        super(ForbiddenException, self).__init__(summary, detail)
+        self.http_error_code = http.client.FORBIDDEN
+
+
+class NotFoundException(RequestException):
+    """Indicates a 404 error - the resource asked for does not exist
+    """
+
+    def __init__(self, summary, detail):
+        super(NotFoundException, self).__init__(summary, detail)
+        self.http_error_code = http.client.NOT_FOUND
+
+
+class ConflictException(RequestException):
+    """Indicates a 409 error - the request conflicts with the state of the
+    resource
+    """
+
+    def __init__(self, summary, detail):
+        super(ConflictException, self).__init__(summary, detail)
+        self.http_error_code = http.client.CONFLICT
+
+
 class InternalServerError(RequestException):
     """Indicates a 500 error - internal server problem
     """
@@ -37,3 +66,28 @@ class InternalServerError(RequestException):
         super(InternalServerError,
               self).__init__(summary='Server Error. Please contact Mantid support.', detail='')
         self.http_error_code = http.client.INTERNAL_SERVER_ERROR
+
+
+class ServiceUnavailableException(RequestException):
+    """Indicates a 503 error - the server is too busy to handle the request
+    now. The client is asked to retry after the given number of seconds
+    """
+
+    def __init__(self, summary, detail, retry_after):
+        super(ServiceUnavailableException, self).__init__(summary, detail)
+        self.http_error_code = http.client.SERVICE_UNAVAILABLE
+        self.retry_after = retry_after
+
+    def response(self):
+        return ServerResponse(self.http_error_code, message=self.summary,
+                              detail=self.detail,
+                              extra_headers=[('Retry-After', str(self.retry_after))])
+
+
+def server_busy(timeout):
+    """Return the error reported when the repository lock could not be
+    acquired within timeout seconds"""
+    return ServiceUnavailableException("Server busy.",
+                                       "Timed out waiting for other changes to the "
+                                       "repository. Please try again later.",
+                                       retry_after=max(1, int(math.ceil(timeout))))
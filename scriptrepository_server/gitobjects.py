@@ -0,0 +1,486 @@
+"""Reads and writes the objects and refs of a git repository directly, so
+that building a commit needs no git processes at all.
+
+Objects are read from loose object files or from pack files, resolving
+deltas, and new objects are always written loose, compressed with zlib and
+named by their SHA-1 exactly as git names them. A ref is updated the way git
+updates it: under a '<ref>.lock' file that git itself respects, and only if it
+still points at the expected commit.
+
+Only what the server needs is supported: SHA-1 repositories without
+alternates or replacement objects.
+"""
+import bisect
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+# Pack object types
+_PACK_TYPES = {1: 'commit', 2: 'tree', 3: 'blob', 4: 'tag'}
+_OFS_DELTA = 6
+_REF_DELTA = 7
+# Compressed bytes read from a pack at a time
+_READ_BYTES = 64*1024
+# Header of a version 2 pack index
+_IDX_MAGIC = b'\377tOc'
+# Stands for a missing commit, e.g. the old value of a new ref
+_NULL_SHA1 = '0' * 40
+# Characters git removes from either end of a name or email
+_CRUD = ' .,:;<>"\\\''
+
+
+def hash_object(kind, data):
+    """Return the SHA-1 git gives an object of the given kind and content"""
+    return hashlib.sha1(_header(kind, len(data)) + data).hexdigest()
+
+
+def read_config_value(git_dir, section, key):
+    """Return the value of section.key in the config file of the repository,
+    or None if it is not set. Only plain 'key = value' entries are understood"""
+    current, value = None, None
+    try:
+        with open(os.path.join(git_dir, 'config'), 'r') as config_file:
+            lines = config_file.readlines()
+    except OSError:
+        return None
+    for line in lines:
+        line = line.split('#', 1)[0].split(';', 1)[0].strip()
+        if line.startswith('['):
+            current = line.strip('[]').strip().lower()
+        elif current == section.lower() and '=' in line:
+            name, setting = line.split('=', 1)
+            if name.strip().lower() == key.lower():
+                value = setting.strip().strip('"')
+    return value
+
+
+def read_ref(git_dir, ref):
+    """Return the commit that ref, e.g. HEAD or refs/heads/master, points at
+    in the repository, or None if it does not exist"""
+    try:
+        with open(os.path.join(git_dir, ref), 'r') as ref_file:
+            value = ref_file.read().strip()
+    except (FileNotFoundError, NotADirectoryError):
+        return _read_packed_ref(git_dir, ref)
+    if value.startswith('ref: '):
+        return read_ref(git_dir, value[5:])
+    return value
+
+
+def identity(name, email, role):
+    """Return the 'name <email> timestamp timezone' line git would record for
+    role, 'author' or 'committer', when configured with name and email. The
+    GIT_<ROLE>_NAME, _EMAIL and, in raw form, _DATE variables take precedence"""
+    prefix = 'GIT_' + role.upper() + '_'
+    name = os.environ.get(prefix + 'NAME', name)
+    email = os.environ.get(prefix + 'EMAIL', email)
+    date = os.environ.get(prefix + 'DATE', '').lstrip('@').split()
+    if len(date) == 2 and date[0].isdigit():
+        timestamp, zone = date
+    else:
+        timestamp = int(time.time())
+        offset = time.localtime(timestamp).tm_gmtoff // 60
+        zone = '{0}{1:02d}{2:02d}'.format('-' if offset < 0 else '+', abs(offset) // 60,
+                                          abs(offset) % 60)
+    return '{0} <{1}> {2} {3}'.format(_without_crud(name), _without_crud(email),
+                                      timestamp, zone)
+
+
+def _read_packed_ref(git_dir, ref):
+    try:
+        with open(os.path.join(git_dir, 'packed-refs'), 'r') as packed_file:
+            for line in packed_file:
+                if line.startswith(('#', '^')):
+                    continue
+                sha1, _, name = line.strip().partition(' ')
+                if name == ref:
+                    return sha1
+    except FileNotFoundError:
+        pass
+    return None
+
+
+def _without_crud(value):
+    return ''.join(c for c in value if c not in '\n<>').strip(_CRUD)
+
+
+def _header(kind, size):
+    return '{0} {1}\0'.format(kind, size).encode('ascii')
+
+
+# ------------------------------------------------------------------------------
+class ObjectStore(object):
+    """The object database and refs of the repository in git_dir"""
+
+    def __init__(self, git_dir):
+        self.git_dir = git_dir
+        self.objects_dir = os.path.join(git_dir, 'objects')
+        self._packs = dict()
+        self._lock = threading.Lock()
+
+    # ------------------------------------------------------------------------
+    # Objects
+    # ------------------------------------------------------------------------
+    def read(self, sha1):
+        """Return (kind, data) for the object with the given SHA-1. Raises
+        KeyError if the repository does not have it"""
+        loose = self._loose_path(sha1)
+        try:
+            with open(loose, 'rb') as loose_file:
+                raw = zlib.decompress(loose_file.read())
+        except FileNotFoundError:
+            return self._read_packed(sha1)
+        header, data = raw.split(b'\0', 1)
+        return header.split(b' ')[0].decode('ascii'), data
+
+    def write(self, kind, data):
+        """Store an object, if it is not already stored, and return its SHA-1"""
+        sha1 = hash_object(kind, data)
+        path = self._loose_path(sha1)
+        if os.path.exists(path) or self._find_packed(sha1) is not None:
+            return sha1
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '{0}.tmp-{1}-{2}'.format(path, os.getpid(), threading.get_ident())
+        with open(tmp_path, 'wb') as object_file:
+            object_file.write(zlib.compress(_header(kind, len(data)) + data))
+        os.chmod(tmp_path, 0o444)
+        os.replace(tmp_path, path)
+        return sha1
+
+    def write_stream(self, kind, stream, size):
+        """Store an object of size bytes read from stream and return its
+        SHA-1. The content is hashed and compressed a block at a time, so it
+        is never held in memory as a whole"""
+        header = _header(kind, size)
+        digest, compressor = hashlib.sha1(header), zlib.compressobj()
+        tmp_path = os.path.join(self.objects_dir, 'tmp_obj_{0}_{1}'.format(
+            os.getpid(), threading.get_ident()))
+        try:
+            with open(tmp_path, 'wb') as object_file:
+                object_file.write(compressor.compress(header))
+                remaining = size
+                while remaining > 0:
+                    block = stream.read(min(_READ_BYTES, remaining))
+                    if not block:
+                        raise RuntimeError("Object is shorter than {0} bytes".format(size))
+                    digest.update(block)
+                    object_file.write(compressor.compress(block))
+                    remaining -= len(block)
+                object_file.write(compressor.flush())
+            sha1 = digest.hexdigest()
+            path = self._loose_path(sha1)
+            if os.path.exists(path) or self._find_packed(sha1) is not None:
+                return sha1
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.chmod(tmp_path, 0o444)
+            os.replace(tmp_path, path)
+            return sha1
+        finally:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    def read_tree(self, sha1):
+        """Return the entries of a tree as a dictionary of
+        name: (mode, type, sha1), as listed by git ls-tree"""
+        kind, data = self.read(sha1)
+        if kind != 'tree':
+            raise RuntimeError("{0} is a {1} not a tree".format(sha1, kind))
+        entries, start = dict(), 0
+        while start < len(data):
+            space = data.index(b' ', start)
+            nul = data.index(b'\0', space)
+            mode = data[start:space].decode('ascii').zfill(6)
+            name = data[space + 1:nul].decode('utf-8')
+            entries[name] = (mode, _entry_kind(mode), data[nul + 1:nul + 21].hex())
+            start = nul + 21
+        return entries
+
+    def write_tree(self, entries):
+        """Store a tree with the entries given as read_tree returns them"""
+        # Git orders a subtree as if its name ended with a slash
+        names = sorted(entries, key=lambda name: name.encode('utf-8') +
+                       (b'/' if entries[name][1] == 'tree' else b''))
+        data = b''.join(entries[name][0].lstrip('0').encode('ascii') + b' ' +
+                        name.encode('utf-8') + b'\0' + bytes.fromhex(entries[name][2])
+                        for name in names)
+        return self.write('tree', data)
+
+    def tree_of(self, commit):
+        """Return the tree of a commit"""
+        kind, data = self.read(commit)
+        if kind != 'commit' or not data.startswith(b'tree '):
+            raise RuntimeError("{0} is not a commit".format(commit))
+        return data[5:45].decode('ascii')
+
+    def write_commit(self, tree, parents, author, committer, message):
+        """Store a commit. author and committer are identity lines"""
+        lines = ['tree ' + tree] + ['parent ' + parent for parent in parents]
+        lines += ['author ' + author, 'committer ' + committer, '', message]
+        data = '\n'.join(lines)
+        if not data.endswith('\n'):
+            data += '\n'
+        return self.write('commit', data.encode('utf-8'))
+
+    def lookup_path(self, commit, path):
+        """Return the SHA-1 of the entry at path in the tree of a commit,
+        or None if there is no such entry"""
+        entries = self.read_tree(self.tree_of(commit))
+        parts = path.split('/')
+        for name in parts[:-1]:
+            entry = entries.get(name)
+            if entry is None or entry[1] != 'tree':
+                return None
+            entries = self.read_tree(entry[2])
+        entry = entries.get(parts[-1])
+        return entry[2] if entry is not None else None
+
+    # ------------------------------------------------------------------------
+    # Refs
+    # ------------------------------------------------------------------------
+    def read_ref(self, ref):
+        """Return the commit that ref points at, or None if it does not exist"""
+        return read_ref(self.git_dir, ref)
+
+    def update_ref(self, ref, new, old=None, committer=None, message=''):
+        """Point ref at new, provided it still points at old if that is given.
+        Raises RuntimeError if it does not or git is updating it. The update
+        is recorded in the reflog as git would record it, by committer, an
+        identity line, with the given message"""
+        path = os.path.join(self.git_dir, ref)
+        lock_path = path + '.lock'
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            raise RuntimeError("Unable to lock ref '{0}'".format(ref))
+        try:
+            try:
+                current = self.read_ref(ref)
+                if old is not None and current != old:
+                    raise RuntimeError("Ref '{0}' is at {1}, expected {2}".format(ref, current,
+                                                                                  old))
+                os.write(fd, (new + '\n').encode('ascii'))
+            finally:
+                os.close(fd)
+            self._log_ref_update(ref, current, new, committer, message)
+            os.replace(lock_path, path)
+        except BaseException:
+            # Never leave the ref locked
+            try:
+                os.unlink(lock_path)
+            except OSError:
+                pass
+            raise
+
+    # ------------------------------------------------------------------------
+    def _log_ref_update(self, ref, old, new, committer, message):
+        """Append to the reflog of ref, and of HEAD if it points at ref, when
+        git would, see _is_logged"""
+        if committer is None:
+            committer = identity(read_config_value(self.git_dir, 'user', 'name') or 'unknown',
+                                 read_config_value(self.git_dir, 'user', 'email') or '',
+                                 'committer')
+        entry = '{0} {1} {2}\t{3}\n'.format(old or _NULL_SHA1, new, committer,
+                                             ' '.join(message.split()))
+        logged = [ref]
+        try:
+            with open(os.path.join(self.git_dir, 'HEAD'), 'r') as head_file:
+                if head_file.read().strip() == 'ref: ' + ref:
+                    logged.append('HEAD')
+        except OSError:
+            pass
+        for name in logged:
+            log_path = os.path.join(self.git_dir, 'logs', name)
+            if self._is_logged(name, log_path):
+                os.makedirs(os.path.dirname(log_path), exist_ok=True)
+                with open(log_path, 'a') as log_file:
+                    log_file.write(entry)
+
+    def _is_logged(self, ref, log_path):
+        """Git logs the updates of a ref that already has a reflog, or if
+        core.logAllRefUpdates asks for one, which is the default for branches
+        of a repository with a working tree"""
+        if os.path.exists(log_path):
+            return True
+        setting = read_config_value(self.git_dir, 'core', 'logAllRefUpdates')
+        if setting is None:
+            bare = read_config_value(self.git_dir, 'core', 'bare')
+            setting = 'false' if bare == 'true' else 'true'
+        if setting == 'always':
+            return True
+        return setting == 'true' and (ref == 'HEAD' or
+                                      ref.startswith(('refs/heads/', 'refs/remotes/',
+                                                      'refs/notes/')))
+
+    def _loose_path(self, sha1):
+        return os.path.join(self.objects_dir, sha1[:2], sha1[2:])
+
+    def _find_packed(self, sha1):
+        """Return (pack, offset) for an object in a pack, or None. The pack
+        directory is scanned again if the object is not in a known pack"""
+        binary = bytes.fromhex(sha1)
+        with self._lock:
+            for attempt in range(2):
+                if attempt:
+                    self._scan_packs()
+                for pack in self._packs.values():
+                    offset = pack.find(binary)
+                    if offset is not None:
+                        return pack, offset
+        return None
+
+    def refresh_packs(self):
+        """Read the list of packs again, e.g. after a repack"""
+        with self._lock:
+            self._scan_packs()
+
+    def _scan_packs(self):
+        pack_dir = os.path.join(self.objects_dir, 'pack')
+        try:
+            names = [name[:-4] for name in os.listdir(pack_dir) if name.endswith('.idx')]
+        except FileNotFoundError:
+            names = []
+        # Packs that have been removed are forgotten
+        self._packs = {name: self._packs.get(name) or _Pack(os.path.join(pack_dir, name))
+                       for name in names}
+
+    def _read_packed(self, sha1):
+        found = self._find_packed(sha1)
+        if found is None:
+            raise KeyError(sha1)
+        pack, offset = found
+        return pack.read(offset, self)
+
+
+class _Pack(object):
+    """A pack file and its version 2 index, both mapped into memory"""
+
+    def __init__(self, path):
+        with open(path + '.idx', 'rb') as idx_file:
+            self._idx = mmap.mmap(idx_file.fileno(), 0, access=mmap.ACCESS_READ)
+        with open(path + '.pack', 'rb') as pack_file:
+            self._pack = mmap.mmap(pack_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._idx[:4] != _IDX_MAGIC or struct.unpack('>I', self._idx[4:8])[0] != 2:
+            raise RuntimeError("Unsupported pack index '{0}.idx'".format(path))
+        self._fanout = struct.unpack('>256I', self._idx[8:8 + 1024])
+        self._count = self._fanout[255]
+        self._names = _NameTable(self._idx, 8 + 1024)
+        self._offsets = 8 + 1024 + self._count * 24
+        self._large_offsets = self._offsets + self._count * 4
+
+    def find(self, binary):
+        """Return the offset of an object in the pack or None"""
+        first = binary[0]
+        low = self._fanout[first - 1] if first else 0
+        index = bisect.bisect_left(self._names, binary, low, self._fanout[first])
+        if index == self._fanout[first] or self._names[index] != binary:
+            return None
+        at = self._offsets + index * 4
+        offset = struct.unpack('>I', self._idx[at:at + 4])[0]
+        if offset & 0x80000000:
+            at = self._large_offsets + (offset & 0x7fffffff) * 8
+            offset = struct.unpack('>Q', self._idx[at:at + 8])[0]
+        return offset
+
+    def read(self, offset, store):
+        """Return (kind, data) for the object at offset, resolving deltas
+        against objects in this pack or, by name, elsewhere in store"""
+        pack = self._pack
+        entry_start = offset
+        byte = pack[offset]
+        kind, size, shift = (byte >> 4) & 7, byte & 15, 4
+        offset += 1
+        while byte & 0x80:
+            byte = pack[offset]
+            size |= (byte & 0x7f) << shift
+            shift += 7
+            offset += 1
+        if kind == _OFS_DELTA:
+            byte = pack[offset]
+            distance = byte & 0x7f
+            offset += 1
+            while byte & 0x80:
+                byte = pack[offset]
+                distance = ((distance + 1) << 7) | (byte & 0x7f)
+                offset += 1
+            base_kind, base = self.read(entry_start - distance, store)
+        elif kind == _REF_DELTA:
+            base_kind, base = store.read(pack[offset:offset + 20].hex())
+            offset += 20
+        decompressor, data = zlib.decompressobj(), b''
+        while not decompressor.eof:
+            chunk = pack[offset:offset + _READ_BYTES]
+            if not chunk:
+                raise RuntimeError("Truncated pack entry")
+            data += decompressor.decompress(chunk)
+            offset += _READ_BYTES
+        if kind in _PACK_TYPES:
+            return _PACK_TYPES[kind], data
+        return base_kind, _apply_delta(base, data)
+
+
+class _NameTable(object):
+    """The sorted object names of a pack index as a sequence for bisect"""
+
+    def __init__(self, idx, start):
+        self._idx = idx
+        self._start = start
+
+    def __getitem__(self, index):
+        at = self._start + index * 20
+        return self._idx[at:at + 20]
+
+
+def _entry_kind(mode):
+    if mode == '040000':
+        return 'tree'
+    return 'commit' if mode == '160000' else 'blob'
+
+
+def _apply_delta(base, delta):
+    """Return the result of applying a git delta to base"""
+    position = 0
+
+    def varint():
+        nonlocal position
+        value, shift = 0, 0
+        while True:
+            byte = delta[position]
+            position += 1
+            value |= (byte & 0x7f) << shift
+            shift += 7
+            if not byte & 0x80:
+                return value
+
+    base_size, result_size = varint(), varint()
+    if base_size != len(base):
+        raise RuntimeError("Delta does not match its base")
+    result = bytearray()
+    while position < len(delta):
+        opcode = delta[position]
+        position += 1
+        if opcode & 0x80:
+            copy_offset, copy_size = 0, 0
+            for bit in range(4):
+                if opcode & (1 << bit):
+                    copy_offset |= delta[position] << (8 * bit)
+                    position += 1
+            for bit in range(3):
+                if opcode & (0x10 << bit):
+                    copy_size |= delta[position] << (8 * bit)
+                    position += 1
+            result += base[copy_offset:copy_offset + (copy_size or 0x10000)]
+        elif opcode:
+            result += delta[position:position + opcode]
+            position += opcode
+        else:
+            raise RuntimeError("Invalid delta opcode")
+    if len(result) != result_size:
+        raise RuntimeError("Delta produced the wrong size")
+    return bytes(result)
@@ -0,0 +1,279 @@
+"""Merges changes that arrive at around the same time into a single
+update of the central repository ("group commit").
+
+The first request to arrive becomes the leader of a batch. It waits for the
+configured window, collects every change submitted in the meantime and then:
+  - syncs with the remote once
+  - writes each change to the working tree
+  - creates one commit per run of consecutive changes by the same author
+  - pushes the whole chain once
+Every other request in the batch simply waits for its own outcome.
+A change to a path that an earlier change in the batch has already written
+is held back for the next batch, where it is compared with what has been
+committed. A batch holds the repository lock while it runs so the next batch
+gathers changes while the previous one is still pushing.
+
+If the leader gives up waiting for the lock, every change in the batch that
+has a lock timeout is refused as busy. Any change without one, e.g. from an
+asynchronous upload, is kept and its request becomes the next leader.
+"""
+import logging
+import threading
+import time
+import traceback
+
+from .errors import InternalServerError, RequestException, server_busy
+from .repository import GitCommitInfo, open_repository
+from .sync import mark_synced, sync_if_stale
+
+# One committer per repository root
+_GROUP_COMMITTERS = dict()
+_GROUP_COMMITTERS_LOCK = threading.Lock()
+
+
+def get_group_committer(root, window, prepare, committer_name, max_sync_age=0):
+    """Return the GroupCommitter for the given repository, creating it
+    if required
+    """
+    with _GROUP_COMMITTERS_LOCK:
+        committer = _GROUP_COMMITTERS.get(root)
+        if committer is None:
+            committer = GroupCommitter(open_repository(root), window, prepare,
+                                       committer_name, max_sync_age)
+            _GROUP_COMMITTERS[root] = committer
+        else:
+            committer.window = window
+            committer.max_sync_age = max_sync_age
+    return committer
+
+
+# ------------------------------------------------------------------------------
+class PendingChange(object):
+    """A single request waiting to be committed as part of a batch"""
+
+    def __init__(self, script_form, err_stream, on_committed=None, lock_timeout=None):
+        self.script_form = script_form
+        self.err_stream = err_stream
+        self.on_committed = on_committed
+        self.lock_timeout = lock_timeout
+        self.arrival = time.monotonic()
+        self.commit_info = None
+        self.published_date = None
+        self.error = None
+        self._promoted = False
+        self._done = threading.Event()
+
+    def succeed(self, published_date):
+        self.published_date = published_date
+        self._done.set()
+
+    def fail(self, error):
+        self.error = error
+        self._done.set()
+
+    def promote(self):
+        """Wake the request to lead the next batch"""
+        self._promoted = True
+        self._done.set()
+
+    def is_done(self):
+        return self._done.is_set() and not self._promoted
+
+    def wait(self):
+        """Block until the change is complete or has been promoted. Returns
+        True if the caller must lead the next batch"""
+        self._done.wait()
+        if self._promoted:
+            self._promoted = False
+            self._done.clear()
+            return True
+        return False
+
+    def result(self):
+        if self.error is not None:
+            raise self.error
+        return self.published_date
+
+
+class GroupCommitter(object):
+    """Collects changes to a single repository and commits them in batches.
+      :param git_repo The GitRepository to update
+      :param window Number of seconds the leader of a batch waits for other changes
+      :param prepare A callable (git_repo, script_form, err_stream) that applies
+                     a change to the working tree and returns a GitCommitInfo
+      :param committer_name Name of the committer used for each commit
+      :param max_sync_age Skip the sync with the remote if the clone was synced
+                          less than this many seconds ago
+    """
+
+    def __init__(self, git_repo, window, prepare, committer_name, max_sync_age=0):
+        self.git_repo = git_repo
+        self.window = window
+        self.prepare = prepare
+        self.committer_name = committer_name
+        self.max_sync_age = max_sync_age
+        self._queue = []
+        self._queue_lock = threading.Lock()
+        self._have_leader = False
+
+    def submit(self, script_form, err_stream, on_committed=None, lock_timeout=None):
+        """Add a change to the next batch and block until it has been pushed.
+        Returns the published date or raises a RequestException. If given,
+        on_committed is called once the batch has been committed locally.
+        A ServiceUnavailableException is raised if the change has to wait more
+        than lock_timeout seconds for the repository lock.
+        """
+        change = PendingChange(script_form, err_stream, on_committed, lock_timeout)
+        with self._queue_lock:
+            self._queue.append(change)
+            lead = not self._have_leader
+            if lead:
+                self._have_leader = True
+
+        if lead:
+            self._lead_batch(change)
+        while change.wait():
+            self._lead_batch(change)
+        return change.result()
+
+    def _lead_batch(self, leader):
+        try:
+            acquired = self.git_repo.lock.acquire(leader.lock_timeout)
+        except BaseException:
+            self._abandon_batch(leader)
+            raise
+        if not acquired:
+            self._refuse_batch(leader.lock_timeout)
+            return
+        try:
+            # Any time spent waiting for the previous batch counts towards the window
+            remaining = leader.arrival + self.window - time.monotonic()
+            if remaining > 0:
+                time.sleep(remaining)
+            with self._queue_lock:
+                batch, self._queue = self._queue, []
+                self._have_leader = False
+            self._commit_batch(batch)
+        finally:
+            self.git_repo.lock.release()
+
+    def _refuse_batch(self, timeout):
+        """Refuse the changes that cannot wait any longer for the lock and
+        promote one of the others, if any, to lead them"""
+        with self._queue_lock:
+            batch = self._queue
+            self._queue = [change for change in batch if change.lock_timeout is None]
+            self._have_leader = bool(self._queue)
+            if self._have_leader:
+                self._queue[0].promote()
+        for change in batch:
+            if change.lock_timeout is not None:
+                change.fail(server_busy(timeout))
+
+    def _abandon_batch(self, leader):
+        """Fail every other change queued when the leader could not take the
+        lock at all, so that nobody waits for a batch that will never run"""
+        with self._queue_lock:
+            batch, self._queue = self._queue, []
+            self._have_leader = False
+        detail = traceback.format_exc()
+        for change in batch:
+            if change is not leader:
+                change.err_stream.write("Script repository upload: unable to lock "
+                                        "repository - {0}.".format(detail))
+                change.fail(InternalServerError())
+
+    def _commit_batch(self, batch):
+        log = logging.getLogger(__name__)
+        log.debug("Committing batch of %s change(s)", len(batch))
+        deferred = []
+        try:
+            sync_if_stale(self.git_repo, self.max_sync_age)
+            accepted, deferred = self._prepare_batch(batch)
+            if accepted:
+                commits = self._group_by_author(accepted)
+                pub_dates = self.git_repo.commit_all_and_push(
+                    commits, on_committed=lambda: self._notify_committed(accepted))
+                mark_synced(self.git_repo.root)
+                for change in accepted:
+                    if change.commit_info.add:
+                        change.succeed(pub_dates[change.commit_info.filelist[0]])
+                    else:
+                        change.succeed('')
+        except Exception:
+            detail = traceback.format_exc()
+            for change in batch:
+                if not change.is_done() and change not in deferred:
+                    change.err_stream.write("Script repository upload: git error "
+                                            "- {0}.".format(detail))
+                    change.fail(InternalServerError())
+        if deferred:
+            log.debug("Holding back %s change(s) for the next batch", len(deferred))
+            self._defer(deferred)
+
+    def _defer(self, changes):
+        """Put changes back at the front of the queue, in order, and make sure
+        the next batch has a leader"""
+        with self._queue_lock:
+            self._queue = changes + self._queue
+            if not self._have_leader:
+                self._have_leader = True
+                self._queue[0].promote()
+
+    def _notify_committed(self, changes):
+        for change in changes:
+            if change.on_committed is not None:
+                change.on_committed()
+
+    def _prepare_batch(self, batch):
+        """Write each change into the working tree. Changes that are rejected,
+        or uploads identical to what is already committed, are completed
+        immediately. Returns (accepted, deferred) where deferred are the
+        changes held back for the next batch"""
+        accepted, deferred = [], []
+        # The working tree only holds the last content written to a path, and
+        # an upload can only be compared with the committed file, so a path
+        # is changed at most once per batch
+        touched = set()
+        for change in batch:
+            filepaths = set(self._filepaths(change.script_form))
+            if filepaths & touched:
+                touched.update(filepaths)
+                deferred.append(change)
+                continue
+            try:
+                change.commit_info = self.prepare(self.git_repo, change.script_form,
+                                                  change.err_stream)
+            except RequestException as err:
+                change.fail(err)
+            else:
+                if not change.commit_info.filelist:
+                    change.succeed(next(iter(change.commit_info.existing_dates.values())))
+                else:
+                    touched.update(change.commit_info.filelist)
+                    accepted.append(change)
+        return accepted, deferred
+
+    def _filepaths(self, script_form):
+        """Return the paths in the working tree that a change may write"""
+        if script_form.is_upload():
+            return [filepath for _, filepath in script_form.uploads(self.git_repo.worktree)]
+        return [script_form.filepath(self.git_repo.worktree)]
+
+    def _group_by_author(self, changes):
+        """Merge consecutive changes by the same author into a single commit"""
+        commits = []
+        for change in changes:
+            info = change.commit_info
+            previous = commits[-1] if commits else None
+            if previous is not None and (previous.author, previous.email, previous.add) == \
+                    (info.author, info.email, info.add):
+                previous.filelist.extend(info.filelist)
+                previous.comment += "\n" + info.comment
+            else:
+                commits.append(GitCommitInfo(author=info.author, email=info.email,
+                                             comment=info.comment,
+                                             filelist=list(info.filelist),
+                                             committer=self.committer_name,
+                                             add=info.add))
+        return commits
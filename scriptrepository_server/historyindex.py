@@ -0,0 +1,126 @@
+"""The common part of the indexes that describe every path of a repository
+from its history, i.e. the ownership index and the manifest.
+
+An index is built once from the full history and stored in the git
+directory of the clone alongside the commit it describes. Whenever HEAD
+moves, through a commit made by this server or a sync with the remote, only
+the new commits are read. If the stored commit is no longer an ancestor of
+HEAD, e.g. the remote was rewritten, the index is rebuilt from scratch. The
+stored file is shared by the worker processes and is only read again when
+another worker has changed it.
+"""
+import json
+import logging
+import os
+import threading
+
+# One index of each type per repository, keyed by (type, real path)
+_INDEXES = dict()
+_INDEXES_LOCK = threading.Lock()
+
+
+def get_index(index_type, git_repo):
+    """Return the index of the given HistoryIndex subclass for the given
+    repository, creating it if required"""
+    key = (index_type, os.path.realpath(git_repo.root))
+    with _INDEXES_LOCK:
+        index = _INDEXES.get(key)
+        if index is None:
+            index = index_type(git_repo)
+            _INDEXES[key] = index
+    return index
+
+
+# ------------------------------------------------------------------------------
+class HistoryIndex(object):
+    """Maps each path to what the log says about it. Subclasses give the
+    name of the file the index is stored in and read the log, see _apply_log"""
+
+    # Name of the file holding the index within the git directory
+    FILENAME = None
+    # Name of the index in log messages
+    DESCRIPTION = 'index'
+    # Key of the entries in the stored JSON
+    ENTRIES_KEY = 'entries'
+
+    def __init__(self, git_repo):
+        self.git_repo = git_repo
+        self.filename = os.path.join(git_repo.git_dir, self.FILENAME)
+        self._head = None
+        self._entries = None
+        self._stamp = None
+        self._lock = threading.Lock()
+
+    def snapshot(self):
+        """Return (head, entries) as last stored, or (None, None) if the
+        index has never been built. entries must not be modified."""
+        with self._lock:
+            self._reload_if_changed()
+            return self._head, self._entries
+
+    def refresh(self):
+        """Bring the index up to date with the repository"""
+        with self._lock:
+            self._refresh()
+
+    # ------------------------------------------------------------------------
+    def _apply_log(self, entries, revisions):
+        """Read the log for revisions and update entries from it"""
+        raise NotImplementedError()
+
+    def _entry(self, saved):
+        """Return an entry as it was loaded from the stored JSON"""
+        return saved
+
+    def _refresh(self):
+        self._reload_if_changed()
+        head = self.git_repo.current_head()
+        if head == self._head:
+            return
+        log = logging.getLogger(__name__)
+        if self._head is not None and self._is_ancestor(self._head, head):
+            log.debug("Updating %s %s..%s", self.DESCRIPTION, self._head, head)
+            entries = dict(self._entries)
+            self._apply_log(entries, self._head + '..' + head)
+        else:
+            log.debug("Rebuilding %s at %s", self.DESCRIPTION, head)
+            entries = dict()
+            self._apply_log(entries, head)
+        self._head, self._entries = head, entries
+        self._save()
+
+    def _is_ancestor(self, old, new):
+        try:
+            self.git_repo.git("merge-base", ["--is-ancestor", old, new])
+        except RuntimeError:
+            return False
+        return True
+
+    def _reload_if_changed(self):
+        try:
+            stat = os.stat(self.filename)
+        except OSError:
+            return
+        stamp = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        if stamp == self._stamp:
+            return
+        try:
+            with open(self.filename, 'r') as index_file:
+                saved = json.load(index_file)
+            self._head = saved['head']
+            self._entries = {path: self._entry(entry)
+                             for path, entry in saved[self.ENTRIES_KEY].items()}
+            self._stamp = stamp
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def _save(self):
+        tmp_filename = '{0}.tmp-{1}'.format(self.filename, os.getpid())
+        try:
+            with open(tmp_filename, 'w') as index_file:
+                json.dump({'head': self._head, self.ENTRIES_KEY: self._entries}, index_file)
+            os.replace(tmp_filename, self.filename)
+            stat = os.stat(self.filename)
+            self._stamp = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        except OSError as exc:
+            logging.getLogger(__name__).warning("Unable to save %s: %s", self.DESCRIPTION, exc)
@@ -0,0 +1,227 @@
+"""Idempotency keys let a client retry a change safely. A request carrying a
+key, in an Idempotency-Key header or an idempotency_key form field, claims
+the key before any git work is done. The final response is stored under the
+key, so a retry receives it again without the change being made twice.
+
+A key is claimed by locking a file named after it with flock, so a retry
+that arrives while the first attempt is still running, in any worker
+process, waits for that attempt to finish. If the first attempt failed
+with a server error, or its process died, nothing is stored and the retry
+makes the change itself.
+
+Responses are kept for KEY_EXPIRY_SECS and at most MAX_KEYS are kept.
+"""
+import base64
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from .base import ContentResponse
+from .errors import BadRequestException, server_busy
+
+# Stored responses are removed after this many seconds
+KEY_EXPIRY_SECS = 24*60*60
+# Most responses kept, the oldest are removed first
+MAX_KEYS = 10000
+# Longest key accepted
+MAX_KEY_LENGTH = 255
+# Default location of the stored responses
+DEFAULT_IDEMPOTENCY_DIR = os.path.join(tempfile.gettempdir(), 'scriptrepository-idempotency')
+# Header added to a response that is replayed
+REPLAYED_HEADER = 'Idempotent-Replayed'
+# Number of responses saved by a process between clear outs of old ones
+_EXPIRE_EVERY = 100
+# Bounds of the interval between attempts to claim a busy key
+_POLL_MIN_SECS = 0.005
+_POLL_MAX_SECS = 0.25
+
+_SAVES = 0
+_SAVES_LOCK = threading.Lock()
+
+
+class IdempotencyStore(object):
+    """Claims keys and stores the responses to them in a directory"""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def acquire(self, key, scope, fingerprint, timeout=None):
+        """Claim key, waiting at most timeout seconds for an attempt already
+        using it. The Claim has the stored response set if the change has
+        already been made, otherwise the caller must make the change and pass
+        the response to Claim.record. The Claim must be released afterwards.
+          :param key The key sent by the client or None for a request without one
+          :param scope Keys are only matched within the same scope, e.g. repository
+          :param fingerprint Identifies the change. A key may not be reused for another
+        """
+        if key is None:
+            return Claim(None, None)
+        if len(key) > MAX_KEY_LENGTH or not key.isprintable():
+            raise BadRequestException("Invalid idempotency key.",
+                                      "Keys must be at most {0} printable "
+                                      "characters".format(MAX_KEY_LENGTH))
+        name = hashlib.sha256('{0}\0{1}'.format(scope, key).encode('utf-8')).hexdigest()
+        os.makedirs(self.directory, exist_ok=True)
+        lock_filename = os.path.join(self.directory, name + '.lock')
+        while True:
+            fd = os.open(lock_filename, os.O_CREAT | os.O_RDWR, 0o644)
+            claim = Claim(self, name, fingerprint, fd)
+            try:
+                if not _lock(fd, timeout):
+                    raise server_busy(timeout)
+            except BaseException:
+                claim.release()
+                raise
+            if _is_same_file(fd, lock_filename):
+                break
+            # The file was expired while we waited for it, lock the new one
+            claim.release()
+        try:
+            stored = self._load(name)
+            if stored is not None:
+                if stored['fingerprint'] != fingerprint:
+                    raise BadRequestException("Idempotency key reused.",
+                                              "The key was first used for a different change")
+                logging.getLogger(__name__).debug("Replaying response for key %s", key)
+                claim.response = _replay(stored)
+        except BaseException:
+            claim.release()
+            raise
+        return claim
+
+    def save(self, name, fingerprint, response):
+        global _SAVES
+        filename = os.path.join(self.directory, name + '.json')
+        tmp_filename = '{0}.tmp-{1}-{2}'.format(filename, os.getpid(), threading.get_ident())
+        with open(tmp_filename, 'w') as stored_file:
+            json.dump(dict(fingerprint=fingerprint, status=response.status,
+                           headers=response.headers,
+                           content=base64.b64encode(response.content).decode('ascii')),
+                      stored_file)
+        os.replace(tmp_filename, filename)
+        with _SAVES_LOCK:
+            _SAVES += 1
+            due = _SAVES % _EXPIRE_EVERY == 1
+        if due:
+            self.expire()
+
+    def expire(self, max_age=KEY_EXPIRY_SECS, max_keys=MAX_KEYS):
+        """Remove stored responses older than max_age seconds and then the
+        oldest until at most max_keys remain. A key file older than max_age
+        is only removed if no attempt holds it"""
+        oldest = time.time() - max_age
+        stored = []
+        try:
+            entries = list(os.scandir(self.directory))
+        except OSError:
+            return
+        for entry in entries:
+            try:
+                mtime = entry.stat().st_mtime
+                if entry.name.endswith('.lock'):
+                    if mtime < oldest:
+                        _remove_if_unlocked(entry.path)
+                elif mtime < oldest:
+                    os.remove(entry.path)
+                elif entry.name.endswith('.json'):
+                    stored.append((mtime, entry.path))
+            except OSError:
+                pass
+        stored.sort()
+        for _, path in stored[:max(0, len(stored) - max_keys)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _load(self, name):
+        try:
+            with open(os.path.join(self.directory, name + '.json'), 'r') as stored_file:
+                return json.load(stored_file)
+        except (OSError, ValueError):
+            return None
+
+
+class Claim(object):
+    """The right to make the change for a key"""
+
+    def __init__(self, store, name, fingerprint=None, fd=None):
+        self.store = store
+        self.name = name
+        self.fingerprint = fingerprint
+        self._fd = fd
+        # The stored response if the change has already been made
+        self.response = None
+
+    def record(self, response):
+        """Store the final response for the key and return it. Server errors
+        are not stored so that a retry tries again"""
+        if self.store is not None and int(response.status.split()[0]) < 500:
+            try:
+                self.store.save(self.name, self.fingerprint, response)
+            except OSError as exc:
+                logging.getLogger(__name__).warning("Unable to store response: %s", exc)
+        return response
+
+    def release(self):
+        """Let the next attempt with the key go ahead. Only the first call
+        has any effect"""
+        if self._fd is not None:
+            # Closing the file releases the lock
+            os.close(self._fd)
+            self._fd = None
+
+
+def _lock(fd, timeout):
+    """Lock fd exclusively, waiting at most timeout seconds if it is given.
+    Returns True if the lock was taken"""
+    start, poll = time.monotonic(), _POLL_MIN_SECS
+    while True:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            pass
+        if timeout is not None and time.monotonic() - start >= timeout:
+            return False
+        time.sleep(poll)
+        poll = min(poll * 2, _POLL_MAX_SECS)
+
+
+def _is_same_file(fd, path):
+    """Return True if fd is open on the file now at path"""
+    try:
+        return os.fstat(fd).st_ino == os.stat(path).st_ino
+    except OSError:
+        return False
+
+
+def _remove_if_unlocked(path):
+    """Remove the key file at path unless an attempt holds its lock"""
+    try:
+        fd = os.open(path, os.O_RDWR)
+    except OSError:
+        return
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        # Holding the lock, nobody can claim the key until it is gone
+        if _is_same_file(fd, path):
+            os.remove(path)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _replay(stored):
+    headers = [(name, value) for name, value in stored['headers']
+               if name not in ('Content-Type', 'Content-Length')]
+    content_type = dict(stored['headers']).get('Content-Type')
+    return ContentResponse(int(stored['status'].split()[0]),
+                           base64.b64decode(stored['content']), content_type,
+                           extra_headers=headers + [(REPLAYED_HEADER, 'true')])
@@ -0,0 +1,257 @@
+"""Support for asynchronous uploads. A request that asks for asynchronous
+processing is validated and its form queued as a job. The client receives
+the job ID at once, the git work is done by a worker thread and the client
+polls the status of the job.
+
+The status of every job is written to a small JSON file so that it can be
+read by any worker process, not just the one running the job. A job moves
+through the states:
+  - queued: accepted but not yet started
+  - committed: the commit has been made locally and is being pushed
+  - pushed: finished successfully, pub_date is available
+  - failed: finished unsuccessfully, see detail
+
+The work itself is only held in memory by the process that accepted it. Each
+job runner holds a lock on a file of its own in the directory while its
+process lives, so when a runner starts using the directory it can tell the
+jobs left unfinished by a process that has since died, e.g. a recycled
+worker, and marks them failed rather than leaving them queued forever.
+"""
+import fcntl
+import json
+import logging
+import os
+import queue
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+from .errors import RequestException
+
+# Job states
+QUEUED, COMMITTED, PUSHED, FAILED = 'queued', 'committed', 'pushed', 'failed'
+# Status files of finished jobs are removed after this many seconds
+JOB_EXPIRY_SECS = 24*60*60
+# Default location of the status files
+DEFAULT_JOBS_DIR = os.path.join(tempfile.gettempdir(), 'scriptrepository-jobs')
+# Detail of a job whose process died before it finished
+ORPHANED_DETAIL = 'The server restarted before the job finished. Please upload again.'
+
+_RUNNER = None
+_RUNNER_LOCK = threading.Lock()
+
+
+def queue_job(jobs_dir, work, script_form):
+    """Queue work to be done by the job runner
+      :param jobs_dir Directory holding the job status files
+      :param work A callable (on_committed) returning a ServerResponse
+      :param script_form The form for the job. It is closed when the job finishes
+      :returns The new Job
+    """
+    global _RUNNER
+    store = JobStore(jobs_dir)
+    with _RUNNER_LOCK:
+        if _RUNNER is None or not _RUNNER.is_alive():
+            if _RUNNER is not None:
+                # Its jobs are lost with it and will be failed as orphans
+                _RUNNER.release()
+            _RUNNER = JobRunner()
+            _RUNNER.start()
+        _RUNNER.register(store)
+        job = Job(store, uuid.uuid4().hex, _RUNNER.runner_id)
+        job.update(QUEUED)
+        _RUNNER.queue.put((job, work, script_form))
+    return job
+
+
+def _forget_runner():
+    """The lock files of the runner of a parent process must not be held on
+    to by its forked children"""
+    if _RUNNER is not None:
+        _RUNNER.release()
+
+
+os.register_at_fork(after_in_child=_forget_runner)
+
+
+# ------------------------------------------------------------------------------
+class JobStore(object):
+    """Reads and writes job status files in a directory"""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def save(self, job_id, status):
+        os.makedirs(self.directory, exist_ok=True)
+        filename = self._filename(job_id)
+        tmp_filename = '{0}.tmp-{1}'.format(filename, os.getpid())
+        with open(tmp_filename, 'w') as status_file:
+            json.dump(status, status_file)
+        os.replace(tmp_filename, filename)
+
+    def load(self, job_id):
+        """Return the status of a job as a dictionary or None if it is unknown"""
+        if not job_id.isalnum():
+            return None
+        try:
+            with open(self._filename(job_id), 'r') as status_file:
+                return json.load(status_file)
+        except (OSError, ValueError):
+            return None
+
+    def expire(self, max_age=JOB_EXPIRY_SECS):
+        """Remove the status files of jobs that finished more than max_age seconds ago"""
+        oldest = time.time() - max_age
+        try:
+            entries = list(os.scandir(self.directory))
+        except OSError:
+            return
+        for entry in entries:
+            try:
+                if entry.name.endswith('.json') and entry.stat().st_mtime < oldest:
+                    os.remove(entry.path)
+            except OSError:
+                pass
+
+    def fail_orphaned(self, live_runner_id):
+        """Mark the unfinished jobs of runners whose processes have died as
+        failed and remove their lock files"""
+        try:
+            entries = list(os.scandir(self.directory))
+        except OSError:
+            return
+        alive = {live_runner_id: True}
+        for entry in entries:
+            if not entry.name.endswith('.json'):
+                continue
+            job_id = entry.name[:-len('.json')]
+            status = self.load(job_id)
+            if status is None or status['state'] not in (QUEUED, COMMITTED):
+                continue
+            runner_id = status.get('runner')
+            if runner_id not in alive:
+                alive[runner_id] = self._is_runner_alive(runner_id)
+            if not alive[runner_id]:
+                logging.getLogger(__name__).warning("Job %s was left %s by a process that "
+                                                    "has died", job_id, status['state'])
+                Job(self, job_id, runner_id).update(FAILED, detail=ORPHANED_DETAIL)
+        for entry in entries:
+            if entry.name.endswith('.runner') and entry.name != live_runner_id + '.runner':
+                _remove_if_unlocked(entry.path)
+
+    def runner_filename(self, runner_id):
+        return os.path.join(self.directory, runner_id + '.runner')
+
+    def _is_runner_alive(self, runner_id):
+        """A runner is alive while its process holds the lock on its file"""
+        if runner_id is None or not runner_id.isalnum():
+            return False
+        try:
+            fd = os.open(self.runner_filename(runner_id), os.O_RDWR)
+        except OSError:
+            return False
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        finally:
+            # Closing the file releases any lock taken
+            os.close(fd)
+        return False
+
+    def _filename(self, job_id):
+        return os.path.join(self.directory, job_id + '.json')
+
+
+class Job(object):
+    """A single asynchronous request"""
+
+    def __init__(self, store, job_id, runner_id=None):
+        self.store = store
+        self.job_id = job_id
+        self.runner_id = runner_id
+
+    def update(self, state, published_date='', detail=''):
+        self.store.save(self.job_id, dict(state=state, pub_date=published_date,
+                                          detail=detail, runner=self.runner_id))
+
+
+class JobRunner(threading.Thread):
+    """Runs queued jobs one at a time"""
+
+    def __init__(self):
+        super(JobRunner, self).__init__(name="job-runner", daemon=True)
+        self.queue = queue.Queue()
+        self.runner_id = uuid.uuid4().hex
+        # Locked runner files, keyed by the directory holding them
+        self._runner_files = dict()
+
+    def register(self, store):
+        """Lock the file marking this runner alive in the directory of store,
+        failing the jobs orphaned there, if not done already"""
+        if store.directory in self._runner_files:
+            return
+        os.makedirs(store.directory, exist_ok=True)
+        self._runner_files[store.directory] = _lock_new_file(
+            store.runner_filename(self.runner_id))
+        store.fail_orphaned(self.runner_id)
+
+    def release(self):
+        for fd in self._runner_files.values():
+            os.close(fd)
+        self._runner_files.clear()
+
+    def run(self):
+        while True:
+            job, work, script_form = self.queue.get()
+            try:
+                self._run_job(job, work)
+            finally:
+                script_form.close()
+                job.store.expire()
+
+    def _run_job(self, job, work):
+        try:
+            response = work(on_committed=lambda: job.update(COMMITTED))
+        except RequestException as err:
+            detail = err.summary if not err.detail else "{0}\n{1}".format(err.summary,
+                                                                          err.detail)
+            job.update(FAILED, detail=detail)
+        except Exception as exc:
+            logging.getLogger(__name__).exception("Job %s failed", job.job_id)
+            sys.stderr.write("Script repository upload: job error - {0}.".format(exc))
+            job.update(FAILED, detail='Server Error. Please contact Mantid support.')
+        else:
+            job.update(PUSHED, published_date=response.published_date)
+
+
+def _lock_new_file(path):
+    """Create the file at path and lock it. Returns the locked descriptor"""
+    while True:
+        fd = os.open(path, os.O_CREAT | os.O_RDWR, 0o644)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(fd).st_ino == os.stat(path).st_ino:
+                return fd
+        except OSError:
+            pass
+        # Removed as dead by another process before it was locked, try again
+        os.close(fd)
+
+
+def _remove_if_unlocked(path):
+    """Remove the file at path unless another process holds a lock on it"""
+    try:
+        fd = os.open(path, os.O_RDWR)
+    except OSError:
+        return
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        if os.fstat(fd).st_ino == os.stat(path).st_ino:
+            os.remove(path)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
@@ -0,0 +1,288 @@
+"""A lock around the critical section of a clone that is shared by every
+thread and process using it, granted in the order it was requested.
+
+Each request for the lock takes a numbered ticket. A ticket is a file in
+the lock directory that its owner keeps locked with flock for as long as it
+is waiting or holding the lock. The owner of the lowest live ticket holds
+the lock. A ticket whose file can be locked by someone else belongs to a
+process that has died, so it is removed and the queue moves on.
+
+The lock is re-entrant within a thread, or an asyncio task, using a context
+variable to track how deeply it is held. The time spent waiting for the lock
+is recorded so that the number of workers can be sized from the contention
+actually seen.
+"""
+from contextlib import asynccontextmanager, contextmanager
+import asyncio
+import bisect
+import contextvars
+import errno
+import fcntl
+import logging
+import os
+import threading
+import time
+
+from . import metrics, tracing
+
+# Upper bounds, in seconds, of the buckets of the wait time histogram
+WAIT_BUCKETS = (0.001, 0.01, 0.1, 0.5, 1.0, 5.0, 30.0, float('inf'))
+# Bounds of the interval between checks of the queue while waiting
+_POLL_MIN_SECS = 0.001
+_POLL_MAX_SECS = 0.02
+
+_COUNTER_FILENAME = 'counter'
+_TICKET_PREFIX = 'ticket-'
+
+
+class LockTimeout(Exception):
+    """Raised when the lock could not be acquired within the timeout"""
+
+    def __init__(self, timeout):
+        super(LockTimeout, self).__init__("Timed out after {0}s waiting for the "
+                                          "repository lock".format(timeout))
+        self.timeout = timeout
+
+
+# ------------------------------------------------------------------------------
+class LockWaitStats(object):
+    """Histogram of the time spent waiting for a lock"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+        self.timeouts = 0
+        self.buckets = [0] * len(WAIT_BUCKETS)
+
+    def record(self, wait, timed_out=False):
+        with self._lock:
+            self.count += 1
+            self.total += wait
+            self.maximum = max(self.maximum, wait)
+            self.buckets[bisect.bisect_left(WAIT_BUCKETS, wait)] += 1
+            if timed_out:
+                self.timeouts += 1
+
+    def snapshot(self):
+        """Return a copy of the statistics as a dictionary"""
+        with self._lock:
+            return dict(count=self.count, total=self.total, maximum=self.maximum,
+                        timeouts=self.timeouts,
+                        buckets=list(zip(WAIT_BUCKETS, self.buckets)))
+
+
+class RepositoryLock(object):
+    """A FIFO lock shared between processes through files in lock_dir"""
+
+    def __init__(self, lock_dir):
+        self.lock_dir = lock_dir
+        self.stats = LockWaitStats()
+        # (depth, ticket) of the current thread or task
+        self._held = contextvars.ContextVar('repository_lock_' + lock_dir,
+                                            default=(0, None))
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    @contextmanager
+    def hold(self, timeout=None):
+        """Hold the lock for the duration of the block. Raises LockTimeout if it
+        cannot be acquired within timeout seconds"""
+        if not self.acquire(timeout):
+            raise LockTimeout(timeout)
+        try:
+            yield self
+        finally:
+            self.release()
+
+    @asynccontextmanager
+    async def hold_async(self, timeout=None):
+        """As hold but waits in a worker thread. The lock is then held by the
+        calling task and any worker threads it starts"""
+        depth, ticket = self._held.get()
+        if depth == 0:
+            waiter = asyncio.ensure_future(asyncio.to_thread(self._wait_for_turn, timeout))
+            try:
+                ticket = await asyncio.shield(waiter)
+            except asyncio.CancelledError:
+                # The thread cannot be stopped so give up the ticket once it has one
+                waiter.add_done_callback(_discard_waited_ticket)
+                raise
+            if ticket is None:
+                raise LockTimeout(timeout)
+        self._held.set((depth + 1, ticket))
+        try:
+            yield self
+        finally:
+            self.release()
+
+    def acquire(self, timeout=None):
+        """Acquire the lock, waiting at most timeout seconds if it is given.
+        Returns True if the lock was acquired"""
+        depth, ticket = self._held.get()
+        if depth == 0:
+            ticket = self._wait_for_turn(timeout)
+            if ticket is None:
+                return False
+        self._held.set((depth + 1, ticket))
+        return True
+
+    def acquire_if_free(self):
+        """Acquire the lock only if nobody holds or is waiting for it.
+        Returns True if the lock was acquired"""
+        depth, ticket = self._held.get()
+        if depth == 0:
+            ticket = _Ticket.take(self.lock_dir)
+            if not ticket.is_first():
+                ticket.discard()
+                return False
+        self._held.set((depth + 1, ticket))
+        return True
+
+    def release(self):
+        depth, ticket = self._held.get()
+        if depth == 0:
+            raise RuntimeError("Release of an unheld repository lock")
+        if depth == 1:
+            self._held.set((0, None))
+            ticket.discard()
+        else:
+            self._held.set((depth - 1, ticket))
+
+    def is_held(self):
+        """Return True if the current thread or task holds the lock"""
+        return self._held.get()[0] > 0
+
+    def idle_seconds(self):
+        """Return the number of seconds since anyone, in any process, last
+        asked for the lock"""
+        try:
+            last = os.stat(os.path.join(self.lock_dir, _COUNTER_FILENAME)).st_mtime
+        except OSError:
+            return float('inf')
+        return max(0.0, time.time() - last)
+
+    # ------------------------------------------------------------------------
+    def _wait_for_turn(self, timeout):
+        """Take a ticket and wait until it is at the front of the queue.
+        Returns the ticket or None if the timeout expired"""
+        start = time.monotonic()
+        with tracing.span('lock_wait', timeout=timeout):
+            ticket = _Ticket.take(self.lock_dir)
+            poll = _POLL_MIN_SECS
+            while not ticket.is_first():
+                waited = time.monotonic() - start
+                if timeout is not None and waited >= timeout:
+                    ticket.discard()
+                    self.record_wait(waited, timed_out=True)
+                    return None
+                time.sleep(poll)
+                poll = min(poll * 2, _POLL_MAX_SECS)
+        self.record_wait(time.monotonic() - start)
+        return ticket
+
+    def record_wait(self, wait, timed_out=False):
+        """Record the time spent waiting for the lock"""
+        self.stats.record(wait, timed_out)
+        metrics.observe('scriptrepository_lock_wait_seconds', wait)
+        if timed_out:
+            metrics.increment('scriptrepository_lock_timeouts_total')
+        log = logging.getLogger(__name__)
+        if timed_out:
+            log.warning("Gave up after %.3fs waiting for lock %s", wait, self.lock_dir)
+        else:
+            log.debug("Waited %.3fs for lock %s", wait, self.lock_dir)
+
+
+class _Ticket(object):
+    """A place in the queue for the lock"""
+
+    def __init__(self, lock_dir, number, fd):
+        self.lock_dir = lock_dir
+        self.number = number
+        self.path = os.path.join(lock_dir, _ticket_name(number))
+        self._fd = fd
+
+    @classmethod
+    def take(cls, lock_dir):
+        os.makedirs(lock_dir, exist_ok=True)
+        counter_fd = os.open(os.path.join(lock_dir, _COUNTER_FILENAME),
+                             os.O_CREAT | os.O_RDWR, 0o644)
+        try:
+            # The number is only handed on once the ticket is visible so that a
+            # later ticket can never be ahead of an earlier one
+            fcntl.flock(counter_fd, fcntl.LOCK_EX)
+            content = os.read(counter_fd, 32)
+            number = int(content) if content else 0
+            # Lock the file before it becomes visible so it is never mistaken for
+            # the ticket of a dead process
+            tmp_path = os.path.join(lock_dir, 'new-{0}-{1}'.format(os.getpid(),
+                                                                   threading.get_ident()))
+            fd = os.open(tmp_path, os.O_CREAT | os.O_RDWR, 0o644)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            ticket = cls(lock_dir, number, fd)
+            os.rename(tmp_path, ticket.path)
+            os.lseek(counter_fd, 0, os.SEEK_SET)
+            os.ftruncate(counter_fd, 0)
+            os.write(counter_fd, str(number + 1).encode('ascii'))
+        finally:
+            os.close(counter_fd)
+        return ticket
+
+    def is_first(self):
+        """Return True if no live ticket is ahead of this one"""
+        mine = _ticket_name(self.number)
+        for name in sorted(os.listdir(self.lock_dir)):
+            if not name.startswith(_TICKET_PREFIX):
+                continue
+            if name >= mine:
+                break
+            if _is_alive(os.path.join(self.lock_dir, name)):
+                return False
+        return True
+
+    def discard(self):
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+        os.close(self._fd)
+
+
+def _discard_waited_ticket(waiter):
+    if not waiter.cancelled() and waiter.exception() is None and waiter.result() is not None:
+        waiter.result().discard()
+
+
+def _ticket_name(number):
+    return '{0}{1:020d}'.format(_TICKET_PREFIX, number)
+
+
+def _is_alive(path):
+    """Return True if the ticket at path is still locked by its owner. The
+    tickets of dead owners are removed"""
+    try:
+        fd = os.open(path, os.O_RDWR)
+    except OSError as err:
+        if err.errno == errno.ENOENT:
+            return False
+        raise
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        # Nobody holds it
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        return False
+    finally:
+        os.close(fd)
@@ -0,0 +1,201 @@
+"""Logging that stays off the request path.
+
+Records are put on a bounded queue by the thread that logs them and written
+out by a background thread, so a request never waits on the log stream. If
+the writer falls behind and the queue fills up, records are dropped rather
+than blocking and counted in the metrics.
+
+Every record carries the ID of the request being handled when it was made.
+Records may be written as text or as one JSON object per line, and each level
+may be sampled so that only a fraction of, say, debug records are kept. The
+message is only formatted by the writer thread, so callers should pass
+arguments rather than a preformatted message, e.g.
+log.debug("Wrote %s bytes", size), to pay nothing for records that are
+filtered out.
+"""
+from contextvars import ContextVar
+import atexit
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import threading
+import uuid
+
+from . import metrics
+
+# Most records waiting to be written
+QUEUE_SIZE = 10000
+# Longest request ID accepted from an X-Request-ID header
+MAX_REQUEST_ID_LENGTH = 64
+# Text format of a record
+TEXT_FORMAT = "%(asctime)s [%(name)s] %(levelname)s %(request_id)s: %(message)s"
+# Formats understood by start_logging
+FORMATS = ('text', 'json')
+
+# The ID of the request being handled
+_REQUEST_ID = ContextVar('scriptrepository_request_id', default=None)
+
+_PIPELINE = None
+_PIPELINE_LOCK = threading.Lock()
+
+
+def start_logging(level=logging.DEBUG, stream=None, log_format='text', sample_rates=None):
+    """Send the records of the root logger through a LogPipeline writing to
+    stream, stderr by default. Calling it again has no effect"""
+    global _PIPELINE
+    with _PIPELINE_LOCK:
+        if _PIPELINE is not None:
+            return _PIPELINE
+        _PIPELINE = LogPipeline(stream, log_format, sample_rates)
+        root_logger = logging.getLogger()
+        root_logger.handlers = [_PIPELINE.handler]
+        root_logger.setLevel(level)
+        atexit.register(_PIPELINE.stop)
+        # The writer thread does not survive a fork, e.g. of preloaded workers
+        os.register_at_fork(after_in_child=_PIPELINE.restart)
+    return _PIPELINE
+
+
+def parse_sample_rates(value):
+    """Parse sample rates given as e.g. "debug=0.01,info=0.5" into a
+    dictionary of level number to the fraction of records kept.
+      :raises ValueError if the value is invalid
+    """
+    rates = dict()
+    for item in (value or '').split(','):
+        if not item.strip():
+            continue
+        name, _, rate = item.partition('=')
+        level = logging.getLevelName(name.strip().upper())
+        if not isinstance(level, int):
+            raise ValueError("Unknown log level '{0}'".format(name.strip()))
+        rate = float(rate)
+        if not 0 <= rate <= 1:
+            raise ValueError("Log sample rate for {0} must be between 0 and 1".format(name))
+        rates[level] = rate
+    return rates
+
+
+def begin_request(request_id=None):
+    """Make request_id, or a new ID if it is missing or unsuitable, the ID of
+    the request being handled in this context. Returns the ID and a token to
+    pass to end_request"""
+    if not request_id or len(request_id) > MAX_REQUEST_ID_LENGTH or \
+            not request_id.replace('-', '').isalnum():
+        request_id = uuid.uuid4().hex[:16]
+    return request_id, _REQUEST_ID.set(request_id)
+
+
+def end_request(token):
+    _REQUEST_ID.reset(token)
+
+
+def request_id():
+    """Return the ID of the request being handled or None"""
+    return _REQUEST_ID.get()
+
+
+def bind_request_id(work):
+    """Wrap work, a callable, so that it logs with the current request ID
+    wherever it runs, e.g. in the job runner"""
+    bound_id = request_id()
+
+    def bound_work(*args, **kwargs):
+        token = _REQUEST_ID.set(bound_id)
+        try:
+            return work(*args, **kwargs)
+        finally:
+            _REQUEST_ID.reset(token)
+
+    return bound_work
+
+
+# ------------------------------------------------------------------------------
+class LogPipeline(object):
+    """A queue of records and the thread writing them to a stream"""
+
+    def __init__(self, stream=None, log_format='text', sample_rates=None):
+        if log_format not in FORMATS:
+            raise ValueError("Log format must be one of {0}".format(', '.join(FORMATS)))
+        self.stream_handler = logging.StreamHandler(stream)
+        self.stream_handler.setFormatter(JsonFormatter() if log_format == 'json'
+                                         else logging.Formatter(TEXT_FORMAT))
+        # The queue is made by restart
+        self.handler = _QueueHandler(None)
+        self.handler.addFilter(RequestFilter(sample_rates))
+        self._listener = None
+        self.restart()
+
+    def restart(self):
+        """Start a new writer thread with a new queue"""
+        self.handler.queue = queue.Queue(QUEUE_SIZE)
+        self._listener = logging.handlers.QueueListener(self.handler.queue,
+                                                        self.stream_handler,
+                                                        respect_handler_level=True)
+        self._listener.start()
+
+    def stop(self):
+        """Write out the records waiting on the queue and stop the writer"""
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+        try:
+            self.stream_handler.flush()
+        except (OSError, ValueError):
+            # The stream may already be closed at exit
+            pass
+
+
+class RequestFilter(logging.Filter):
+    """Adds the request ID to records and drops a share of the records at
+    the levels being sampled"""
+
+    def __init__(self, sample_rates=None):
+        super(RequestFilter, self).__init__()
+        self.sample_rates = sample_rates or dict()
+
+    def filter(self, record):
+        rate = self.sample_rates.get(record.levelno)
+        if rate is not None and random.random() >= rate:
+            metrics.increment('scriptrepository_log_records_dropped_total',
+                              level=record.levelname.lower(), reason='sampled')
+            return False
+        record.request_id = _REQUEST_ID.get() or '-'
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as a single line JSON object"""
+
+    def format(self, record):
+        data = dict(time=datetime.datetime.fromtimestamp(record.created).isoformat(),
+                    level=record.levelname, logger=record.name,
+                    message=record.getMessage(),
+                    request_id=getattr(record, 'request_id', '-'),
+                    pid=record.process, thread=record.threadName)
+        if record.exc_text:
+            data['exception'] = record.exc_text
+        return json.dumps(data)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Queues records without formatting them and never blocks"""
+
+    def prepare(self, record):
+        # The message is formatted by the writer. Exceptions are rendered now,
+        # while their frames are still intact
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.increment('scriptrepository_log_records_dropped_total',
+                              level=record.levelname.lower(), reason='full')
@@ -0,0 +1,135 @@
+"""Keeps clones compact so that git does not slow down as single file
+commits pile up as loose objects and small packs.
+
+A daemon per clone wakes up regularly and, once the last maintenance is more
+than an interval old and the clone has been idle for a while, repacks its
+objects into a single pack, prunes old unreachable objects, packs its refs
+and writes a commit-graph to speed up walks of the history. It holds the
+repository lock throughout but only takes it if nobody else holds or is
+waiting for it, so maintenance never overlaps with, or delays, an upload.
+
+The time of the last maintenance is stored in the git directory so that the
+workers sharing a clone take turns rather than each maintaining it.
+"""
+import logging
+import os
+import struct
+import threading
+import time
+
+# Name of the file, within the git directory, marking the last maintenance
+MAINTENANCE_FILENAME = 'scriptrepository-maintenance'
+# Seconds a clone must go without taking the lock before it is maintained
+DEFAULT_IDLE_SECS = 60.0
+# Bounds of the interval between checks of whether maintenance is due
+_POLL_MIN_SECS = 1.0
+_POLL_MAX_SECS = 60.0
+
+# One daemon per repository root
+_MAINTENANCE_DAEMONS = dict()
+_MAINTENANCE_LOCK = threading.Lock()
+
+
+def object_counts(git_dir):
+    """Return the number of loose objects, packs and packed objects in the
+    repository, counted from the object directory without running git"""
+    objects_dir = os.path.join(git_dir, 'objects')
+    loose = 0
+    for name in _listdir(objects_dir):
+        if len(name) == 2:
+            loose += len([entry for entry in _listdir(os.path.join(objects_dir, name))
+                          if len(entry) == 38])
+    packs, packed = 0, 0
+    pack_dir = os.path.join(objects_dir, 'pack')
+    for name in _listdir(pack_dir):
+        if not name.endswith('.idx'):
+            continue
+        packs += 1
+        try:
+            with open(os.path.join(pack_dir, name), 'rb') as idx_file:
+                # The last entry of the fan-out table of a version 2 index
+                idx_file.seek(8 + 255 * 4)
+                packed += struct.unpack('>I', idx_file.read(4))[0]
+        except (OSError, struct.error):
+            pass
+    return dict(loose_objects=loose, packs=packs, packed_objects=packed)
+
+
+def maintain_if_due(git_repo, interval, idle_secs=DEFAULT_IDLE_SECS):
+    """Maintain git_repo if it was last maintained at least interval seconds
+    ago and has been idle for idle_secs.
+      :returns True if maintenance was performed
+    """
+    if not _is_due(git_repo, interval) or git_repo.lock.idle_seconds() < idle_secs:
+        return False
+    if not git_repo.lock.acquire_if_free():
+        return False
+    try:
+        # Another worker may have just finished
+        if not _is_due(git_repo, interval):
+            return False
+        log = logging.getLogger(__name__)
+        log.info("Maintaining %s: %s", git_repo.root, object_counts(git_repo.git_dir))
+        try:
+            git_repo.maintain()
+        finally:
+            # A failure is not retried until the next interval
+            with open(os.path.join(git_repo.git_dir, MAINTENANCE_FILENAME), 'w'):
+                pass
+        log.info("Maintained %s: %s", git_repo.root, object_counts(git_repo.git_dir))
+    finally:
+        git_repo.lock.release()
+    return True
+
+
+def start_maintenance_daemon(git_repo, interval, idle_secs=DEFAULT_IDLE_SECS):
+    """Start a MaintenanceDaemon for git_repo if one is not already running
+    and return it"""
+    key = os.path.realpath(git_repo.root)
+    with _MAINTENANCE_LOCK:
+        daemon = _MAINTENANCE_DAEMONS.get(key)
+        if daemon is None or not daemon.is_alive():
+            daemon = MaintenanceDaemon(git_repo, interval, idle_secs)
+            _MAINTENANCE_DAEMONS[key] = daemon
+            daemon.start()
+    return daemon
+
+
+def _is_due(git_repo, interval):
+    try:
+        last = os.stat(os.path.join(git_repo.git_dir, MAINTENANCE_FILENAME)).st_mtime
+    except OSError:
+        return True
+    return time.time() - last >= interval
+
+
+def _listdir(path):
+    try:
+        return os.listdir(path)
+    except OSError:
+        return []
+
+
+# ------------------------------------------------------------------------------
+class MaintenanceDaemon(threading.Thread):
+    """Maintains a clone every interval seconds, when it is idle"""
+
+    def __init__(self, git_repo, interval, idle_secs=DEFAULT_IDLE_SECS):
+        super(MaintenanceDaemon, self).__init__(name="maintenance-" + git_repo.root,
+                                                daemon=True)
+        self.git_repo = git_repo
+        self.interval = interval
+        self.idle_secs = idle_secs
+        self._stopped = threading.Event()
+
+    def run(self):
+        log = logging.getLogger(__name__)
+        poll = min(max(min(self.interval, self.idle_secs) / 2, _POLL_MIN_SECS), _POLL_MAX_SECS)
+        while not self._stopped.wait(poll):
+            try:
+                maintain_if_due(self.git_repo, self.interval, self.idle_secs)
+            except Exception as exc:
+                log.warning("Maintenance of '%s' failed: %s", self.git_repo.root, exc)
+
+    def stop(self):
+        self._stopped.set()
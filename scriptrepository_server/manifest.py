@@ -0,0 +1,57 @@
+"""A manifest of every file in a repository with its blob hash, last author
+and the time of the last commit that changed it. Clients use it to find out
+what the repository holds without fetching the whole tree.
+
+Like the ownership index, the manifest is stored in the git directory of the
+clone and kept up to date from the new commits whenever the server commits
+or syncs, see historyindex. Reading it needs no git commands at all.
+"""
+from .historyindex import HistoryIndex, get_index
+
+# Name of the file holding the manifest within the git directory
+MANIFEST_FILENAME = 'scriptrepository-manifest.json'
+# Marks the header line of each commit in the log output
+_COMMIT_MARK = '\x1f'
+
+
+def get_manifest(git_repo):
+    """Return the Manifest for the given repository, creating it if required"""
+    return get_index(Manifest, git_repo)
+
+
+# ------------------------------------------------------------------------------
+class Manifest(HistoryIndex):
+    """Maps each path to (blob sha1, 'author <email>', commit timestamp)"""
+
+    FILENAME = MANIFEST_FILENAME
+    DESCRIPTION = 'manifest'
+
+    # ------------------------------------------------------------------------
+    def _apply_log(self, entries, revisions):
+        """Read the log for revisions, newest first, and record the latest
+        state of each path that appears. Merges are read as a change to
+        their first parent."""
+        output = self.git_repo.git("log", ["--no-renames", "--raw", "--no-abbrev", "-z",
+                                           "-m", "--first-parent",
+                                           "--format=" + _COMMIT_MARK + "%an <%ae>" +
+                                           _COMMIT_MARK + "%ct", revisions])
+        seen = set()
+        author, timestamp = None, None
+        tokens = iter(output.split('\0'))
+        for token in tokens:
+            token = token.lstrip('\n')
+            if token.startswith(_COMMIT_MARK):
+                author, timestamp = token[len(_COMMIT_MARK):].split(_COMMIT_MARK)
+            elif token.startswith(':'):
+                path = next(tokens)
+                if path in seen:
+                    continue
+                seen.add(path)
+                _, _, _, blob, status = token.split()
+                if status == 'D':
+                    entries.pop(path, None)
+                else:
+                    entries[path] = (blob, author, int(timestamp))
+
+    def _entry(self, saved):
+        return tuple(saved)
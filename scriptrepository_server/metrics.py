@@ -0,0 +1,341 @@
+"""In-process latency histograms and counters, exported in the Prometheus
+text format.
+
+Every request is timed from end to end and through each of its stages:
+parsing the form, waiting for the repository lock, syncing with the remote,
+writing files, committing and pushing. Every git subcommand is timed as
+well. Requests are counted by method and status code.
+
+Each worker process keeps its own figures and writes them to a file of its
+own in the metrics directory at the end of a request, at most once every
+FLUSH_INTERVAL_SECS. A worker keeps a lock file of its own locked with flock
+while it is alive. The endpoint first folds the files of the workers that
+have exited into a single aggregate file, removing theirs, and then adds
+together the aggregate and the files of the live workers, so the totals keep
+growing across restarts as Prometheus expects.
+"""
+from contextlib import contextmanager
+import bisect
+import fcntl
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from . import tracing
+
+# Upper bounds, in seconds, of the buckets of every latency histogram
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+                   float('inf'))
+# Default location of the per-worker files
+DEFAULT_METRICS_DIR = os.path.join(tempfile.gettempdir(), 'scriptrepository-metrics')
+# Least time between two writes of the figures of a worker
+FLUSH_INTERVAL_SECS = 1.0
+# Name of the file holding the figures of the workers that have exited
+AGGREGATE_FILENAME = 'aggregate.json'
+# Suffix of the file each live worker keeps locked
+_ALIVE_SUFFIX = '.alive'
+# Name of the file locked while the files of the workers are read or folded
+_GUARD_FILENAME = 'guard'
+
+# Descriptions of each metric, in the order they are exported
+_HELP = (
+    ('scriptrepository_requests_total', 'counter', 'Requests handled by method and status code'),
+    ('scriptrepository_request_seconds', 'histogram', 'Time taken to handle a request'),
+    ('scriptrepository_stage_seconds', 'histogram', 'Time spent in each stage of an update'),
+    ('scriptrepository_git_seconds', 'histogram', 'Time taken by each git subcommand'),
+    ('scriptrepository_lock_wait_seconds', 'histogram', 'Time spent waiting for the '
+                                                        'repository lock'),
+    ('scriptrepository_lock_timeouts_total', 'counter', 'Requests that gave up waiting '
+                                                        'for the repository lock'),
+    ('scriptrepository_push_retries_total', 'counter', 'Pushes rejected because the remote '
+                                                       'had moved on and then retried'),
+    ('scriptrepository_pushes_total', 'counter', 'Successful pushes by the number of '
+                                                 'attempts they took'),
+    ('scriptrepository_admission_refusals_total', 'counter', 'Changes refused because too '
+                                                             'many were in flight, by size'),
+    ('scriptrepository_loose_objects', 'gauge', 'Loose objects in each clone'),
+    ('scriptrepository_packs', 'gauge', 'Pack files in each clone'),
+    ('scriptrepository_packed_objects', 'gauge', 'Objects in the packs of each clone'),
+    ('scriptrepository_log_records_dropped_total', 'counter', 'Log records dropped by '
+                                                              'sampling or a full queue'),
+)
+
+_REGISTRY = None
+_REGISTRY_LOCK = threading.Lock()
+
+
+def registry():
+    """Return the Registry of this process"""
+    global _REGISTRY
+    with _REGISTRY_LOCK:
+        # A forked worker starts a registry of its own
+        if _REGISTRY is None or _REGISTRY.pid != os.getpid():
+            if _REGISTRY is not None:
+                # The parent process still holds its lock files
+                _REGISTRY.release()
+            _REGISTRY = Registry()
+    return _REGISTRY
+
+
+def observe(name, seconds, **labels):
+    registry().observe(name, seconds, labels)
+
+
+def increment(name, amount=1, **labels):
+    registry().increment(name, amount, labels)
+
+
+@contextmanager
+def timed(stage):
+    """Record the time spent in the block as the given stage of an update"""
+    start = time.monotonic()
+    try:
+        with tracing.span(stage):
+            yield
+    finally:
+        observe('scriptrepository_stage_seconds', time.monotonic() - start, stage=stage)
+
+
+# ------------------------------------------------------------------------------
+class Registry(object):
+    """The counters and histograms of a single process"""
+
+    def __init__(self):
+        self.pid = os.getpid()
+        # Identifies this process even if its pid is reused later
+        self.worker_id = '{0}-{1}'.format(self.pid, int(time.time() * 1000))
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._counters = dict()
+        self._histograms = dict()
+        # When the figures were last written to each directory, the timers of
+        # the flushes put off and the descriptors of the lock files
+        self._last_flush = dict()
+        self._timers = dict()
+        self._alive = dict()
+
+    def observe(self, name, seconds, labels):
+        key = _series_key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = dict(buckets=[0] * len(LATENCY_BUCKETS), sum=0.0, count=0)
+                self._histograms[key] = histogram
+            histogram['buckets'][bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            histogram['sum'] += seconds
+            histogram['count'] += 1
+
+    def increment(self, name, amount, labels):
+        key = _series_key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return dict(counters=dict(self._counters),
+                        histograms={key: dict(buckets=list(value['buckets']),
+                                              sum=value['sum'], count=value['count'])
+                                    for key, value in self._histograms.items()})
+
+    def flush(self, directory, force=False):
+        """Write the figures of this process to its file in directory. Unless
+        force is given, a flush within FLUSH_INTERVAL_SECS of the last one is
+        put off until the end of the interval"""
+        # Threads of the same worker share the file
+        with self._flush_lock:
+            last_flush = self._last_flush.get(directory)
+            if not force and last_flush is not None:
+                delay = last_flush + FLUSH_INTERVAL_SECS - time.monotonic()
+                if delay > 0:
+                    if directory not in self._timers:
+                        timer = threading.Timer(delay, self._flush_later, (directory,))
+                        timer.daemon = True
+                        timer.start()
+                        self._timers[directory] = timer
+                    return
+            self._write(directory)
+
+    def release(self):
+        """Close the lock files, e.g. in a forked child"""
+        for fd in self._alive.values():
+            os.close(fd)
+        self._alive = dict()
+
+    def _flush_later(self, directory):
+        with self._flush_lock:
+            self._timers.pop(directory, None)
+            self._write(directory)
+
+    def _write(self, directory):
+        self._last_flush[directory] = time.monotonic()
+        try:
+            os.makedirs(directory, exist_ok=True)
+            if directory not in self._alive:
+                fd = os.open(os.path.join(directory, self.worker_id + _ALIVE_SUFFIX),
+                             os.O_CREAT | os.O_RDWR, 0o644)
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                self._alive[directory] = fd
+            filename = os.path.join(directory, self.worker_id + '.json')
+            with open(filename + '.tmp', 'w') as metrics_file:
+                json.dump(self.snapshot(), metrics_file)
+            os.replace(filename + '.tmp', filename)
+        except OSError as exc:
+            logging.getLogger(__name__).warning("Unable to save metrics: %s", exc)
+
+
+def flush(directory, force=False):
+    registry().flush(directory, force)
+
+
+def merged(directory):
+    """Return the sum of the figures of every worker that has written to
+    directory. Those of the workers that have exited are folded into the
+    aggregate first"""
+    figures = dict(counters=dict(), histograms=dict())
+    try:
+        with _guard(directory):
+            _fold_exited_workers(directory)
+            filenames = [name for name in os.listdir(directory) if name.endswith('.json')]
+            for name in filenames:
+                worker = _load(os.path.join(directory, name))
+                if worker is not None:
+                    _add(figures, worker)
+    except OSError as exc:
+        logging.getLogger(__name__).warning("Unable to read metrics: %s", exc)
+    return figures
+
+
+def exposition(directory, gauges=None):
+    """Return the merged figures in the Prometheus text format.
+      :param gauges A list of (name, labels, value) measured at the time of asking
+    """
+    figures = merged(directory)
+    gauges = {_series_key(name, labels): value for name, labels, value in gauges or []}
+    lines = []
+    for name, kind, description in _HELP:
+        lines.append('# HELP {0} {1}'.format(name, description))
+        lines.append('# TYPE {0} {1}'.format(name, kind))
+        if kind in ('counter', 'gauge'):
+            values = figures['counters'] if kind == 'counter' else gauges
+            for key in sorted(values):
+                series, labels = _split_key(key)
+                if series == name:
+                    lines.append('{0}{1} {2}'.format(name, _labels(labels), values[key]))
+        else:
+            for key in sorted(figures['histograms']):
+                series, labels = _split_key(key)
+                if series != name:
+                    continue
+                histogram = figures['histograms'][key]
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS, histogram['buckets']):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('{0}_bucket{1} {2}'.format(name, _labels(labels + [('le', le)]),
+                                                            cumulative))
+                lines.append('{0}_sum{1} {2!r}'.format(name, _labels(labels), histogram['sum']))
+                lines.append('{0}_count{1} {2}'.format(name, _labels(labels),
+                                                       histogram['count']))
+    return '\n'.join(lines) + '\n'
+
+
+# ------------------------------------------------------------------------------
+@contextmanager
+def _guard(directory):
+    os.makedirs(directory, exist_ok=True)
+    fd = os.open(os.path.join(directory, _GUARD_FILENAME), os.O_CREAT | os.O_RDWR, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        # Closing the file releases the lock
+        os.close(fd)
+
+
+def _fold_exited_workers(directory):
+    """Add the figures of the workers whose lock file is free to the
+    aggregate and remove their files. The guard must be held"""
+    aggregate_path = os.path.join(directory, AGGREGATE_FILENAME)
+    aggregate = _load(aggregate_path) or dict(counters=dict(), histograms=dict())
+    exited = []
+    for name in os.listdir(directory):
+        if not name.endswith('.json') or name == AGGREGATE_FILENAME:
+            continue
+        worker_id = name[:-len('.json')]
+        alive_fd = _lock_if_exited(os.path.join(directory, worker_id + _ALIVE_SUFFIX))
+        if alive_fd is False:
+            continue
+        worker = _load(os.path.join(directory, name))
+        if worker is not None:
+            _add(aggregate, worker)
+        exited.append((worker_id, alive_fd))
+    if not exited:
+        return
+    with open(aggregate_path + '.tmp', 'w') as aggregate_file:
+        json.dump(aggregate, aggregate_file)
+    os.replace(aggregate_path + '.tmp', aggregate_path)
+    for worker_id, alive_fd in exited:
+        for suffix in ('.json', _ALIVE_SUFFIX):
+            try:
+                os.remove(os.path.join(directory, worker_id + suffix))
+            except OSError:
+                pass
+        if alive_fd is not None:
+            os.close(alive_fd)
+
+
+def _lock_if_exited(path):
+    """Return False if the worker holding the lock file at path is alive,
+    otherwise the descriptor of the file, now locked, or None if there is none"""
+    try:
+        fd = os.open(path, os.O_RDWR)
+    except FileNotFoundError:
+        return None
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return False
+    return fd
+
+
+def _load(path):
+    try:
+        with open(path, 'r') as metrics_file:
+            return json.load(metrics_file)
+    except (OSError, ValueError):
+        return None
+
+
+def _add(figures, worker):
+    """Add the figures of a worker to figures"""
+    counters, histograms = figures['counters'], figures['histograms']
+    for key, value in worker.get('counters', {}).items():
+        counters[key] = counters.get(key, 0) + value
+    for key, value in worker.get('histograms', {}).items():
+        total = histograms.setdefault(key, dict(buckets=[0] * len(LATENCY_BUCKETS),
+                                                sum=0.0, count=0))
+        total['buckets'] = [a + b for a, b in zip(total['buckets'], value['buckets'])]
+        total['sum'] += value['sum']
+        total['count'] += value['count']
+
+
+def _series_key(name, labels):
+    """A JSON friendly key for a series: name followed by its sorted labels"""
+    return '\t'.join([name] + ['{0}={1}'.format(key, labels[key]) for key in sorted(labels)])
+
+
+def _split_key(key):
+    parts = key.split('\t')
+    return parts[0], [tuple(part.split('=', 1)) for part in parts[1:]]
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(key, value.replace('\\', '\\\\')
+                                             .replace('"', '\\"'))
+                          for key, value in labels) + '}'
@@ -0,0 +1,480 @@
+"""A streaming parser for form submissions. It replaces cgi.FieldStorage,
+which is not available from Python 3.13.
+
+Both multipart/form-data and application/x-www-form-urlencoded bodies are
+understood. The body is read from wsgi.input in fixed size blocks and file
+parts are written out as they arrive so that an oversized file is rejected
+as soon as it goes over the limit, without reading the rest of the request.
+
+A body with a gzip or deflate Content-Encoding, and file parts with a gzip
+or deflate Content-Encoding header of their own, are decompressed a block at
+a time as they are read. The limits apply to the decompressed sizes so a
+small compressed request cannot expand into a large one.
+"""
+from email.message import Message
+import hashlib
+import os
+import shutil
+import tempfile
+from urllib.parse import parse_qs
+import zlib
+
+# Size of each read from the input stream
+READ_BLOCK_BYTES = 64*1024
+# Maximum size of a single non-file field
+MAX_FIELD_BYTES = 64*1024
+# Maximum size of the headers of a single part
+MAX_PART_HEADER_BYTES = 16*1024
+# Prefix of the temporary files holding file parts
+SPOOL_PREFIX = 'scriptupload-'
+# Content encodings that are decompressed
+ENCODINGS = ('gzip', 'deflate')
+
+
+# ------------------------------------------------------------------------------
+class MultipartError(ValueError):
+    """Raised when the body of a request cannot be parsed"""
+
+    def __init__(self, summary, detail):
+        super(MultipartError, self).__init__(summary)
+        self.summary = summary
+        self.detail = detail
+
+
+class PartTooLarge(MultipartError):
+    """Raised as soon as a part goes over its size limit"""
+    pass
+
+
+class FormFields(dict):
+    """Maps each field name to the first field with that name. Fields that
+    appear more than once are all available through getlist, as with
+    cgi.FieldStorage"""
+
+    def __init__(self):
+        super(FormFields, self).__init__()
+        self._lists = dict()
+
+    def add(self, field):
+        self._lists.setdefault(field.name, []).append(field)
+        self.setdefault(field.name, field)
+
+    def getlist(self, name):
+        """Return every field with the given name in the order received"""
+        return list(self._lists.get(name, []))
+
+    def all_fields(self):
+        """Return every field, including repeats"""
+        return [field for fields in self._lists.values() for field in fields]
+
+
+class FormField(object):
+    """A single field of a form. File fields have a filename and their
+    content is available through the file attribute"""
+
+    def __init__(self, name, value=None, filename=None, file=None):
+        self.name = name
+        self._value = value
+        self.filename = filename
+        self.file = file
+
+    @property
+    def value(self):
+        """The value of a plain field. None for files, use file instead"""
+        return self._value
+
+    def close(self):
+        pass
+
+
+class SpooledFileField(FormField):
+    """A file field whose content has been written to a temporary file as it
+    was received. The size and SHA-1 of the content are computed in the same
+    pass so the content never needs to be read back to find them."""
+
+    def __init__(self, name, filename, spool_dir=None, path=None):
+        """If path is given the field takes ownership of the existing file
+        there, which is read once to find its size and SHA-1"""
+        if path is None:
+            fd, path = tempfile.mkstemp(prefix=SPOOL_PREFIX, dir=spool_dir)
+            spooled = os.fdopen(fd, 'w+b')
+        else:
+            spooled = open(path, 'r+b')
+        self.path = path
+        super(SpooledFileField, self).__init__(name, filename=filename, file=spooled)
+        self.size = 0
+        self._sha1 = hashlib.sha1()
+        for block in iter(lambda: spooled.read(READ_BLOCK_BYTES), b''):
+            self.size += len(block)
+            self._sha1.update(block)
+
+    @property
+    def sha1(self):
+        """Hex digest of the SHA-1 of the content"""
+        return self._sha1.hexdigest()
+
+    def write(self, chunk):
+        self.file.write(chunk)
+        self.size += len(chunk)
+        self._sha1.update(chunk)
+
+    def move_to(self, target):
+        """Move the content to target, replacing it atomically. The content is
+        only copied if target is on a different filesystem to the spool. A
+        file that is replaced keeps its mode, e.g. an executable bit."""
+        self.file.close()
+        mode = _file_mode(target)
+        os.chmod(self.path, mode)
+        try:
+            os.replace(self.path, target)
+        except OSError:
+            # Copy to a temporary file beside the target so the replace is still atomic
+            fd, tmp_target = tempfile.mkstemp(prefix=SPOOL_PREFIX,
+                                              dir=os.path.dirname(target))
+            with os.fdopen(fd, 'wb') as dest, open(self.path, 'rb') as source:
+                shutil.copyfileobj(source, dest, READ_BLOCK_BYTES)
+            os.chmod(tmp_target, mode)
+            os.replace(tmp_target, target)
+            os.remove(self.path)
+        self.path = None
+
+    def close(self):
+        """Discard the spooled content if it has not been moved into place"""
+        self.file.close()
+        if self.path is not None:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+            self.path = None
+
+
+# ------------------------------------------------------------------------------
+def parse_form(environ, max_filesize, spool_dir=None, field_limits=None, max_total=None,
+               max_body=None, max_files=None):
+    """Parse the body of the request described by environ.
+      :param environ The WSGI environment
+      :param max_filesize The maximum number of bytes allowed in a file part
+      :param spool_dir Directory for the temporary files holding file parts.
+                       Defaults to the system temporary directory
+      :param field_limits An optional dictionary of field name to the maximum
+                          number of bytes in file parts of that name, overriding
+                          max_filesize
+      :param max_total If given, the maximum number of bytes across all file parts
+      :param max_body If given, the maximum number of bytes in a compressed body
+                      once it is decompressed
+      :param max_files If given, the maximum number of file parts
+      :returns A FormFields mapping of field name to FormField
+    """
+    limits = _PartLimits(max_filesize, field_limits, max_total, max_files)
+    content_type, params = _parse_header(environ.get('CONTENT_TYPE', ''))
+    reader = _BodyReader(environ['wsgi.input'], _content_length(environ))
+    encoding = _content_encoding(environ.get('HTTP_CONTENT_ENCODING'))
+    if encoding is not None:
+        reader = _BodyReader(_DecodedStream(reader.iter_blocks(), encoding, max_body), -1)
+    if content_type == 'multipart/form-data':
+        boundary = params.get('boundary')
+        if not boundary:
+            raise MultipartError('Invalid form encoding.', 'Missing multipart boundary')
+        return _parse_multipart(reader, boundary.encode('latin-1'), limits, spool_dir)
+    elif content_type in ('application/x-www-form-urlencoded', ''):
+        return _parse_urlencoded(reader)
+    else:
+        raise MultipartError('Invalid form encoding.',
+                             'Unsupported content type {0}'.format(content_type))
+
+
+def _file_mode(path):
+    """Return the permission bits of the file at path, or those of a new
+    file, rw-r--r--, if there is none"""
+    try:
+        return os.stat(path).st_mode & 0o7777
+    except OSError:
+        return 0o644
+
+
+def _content_length(environ):
+    try:
+        return int(environ.get('CONTENT_LENGTH') or -1)
+    except ValueError:
+        raise MultipartError('Invalid form encoding.', 'Invalid Content-Length header')
+
+
+def _parse_header(line):
+    """Split a header value into its main value and a dictionary of parameters"""
+    msg = Message()
+    msg['content-type'] = line
+    params = msg.get_params(failobj=[])
+    if not params:
+        return '', dict()
+    value = params[0][0].lower()
+    return value, {key.lower(): val for key, val in params[1:]}
+
+
+def _parse_urlencoded(reader):
+    body = reader.read_all(MAX_FIELD_BYTES * 4)
+    if body is None:
+        raise PartTooLarge('Form is too large.',
+                           'Maximum form size is {0} bytes'.format(MAX_FIELD_BYTES * 4))
+    fields = FormFields()
+    query = parse_qs(body.decode('utf-8', 'replace'), keep_blank_values=True)
+    for name, values in query.items():
+        for value in values:
+            fields.add(FormField(name, value=value))
+    return fields
+
+
+def _content_encoding(value):
+    """Return the encoding named by a Content-Encoding header, or None if
+    the content is not encoded"""
+    encoding = (value or 'identity').strip().lower()
+    if encoding == 'identity':
+        return None
+    if encoding not in ENCODINGS:
+        raise MultipartError('Invalid form encoding.',
+                             'Unsupported content encoding {0}'.format(encoding))
+    return encoding
+
+
+def _parse_multipart(reader, boundary, limits, spool_dir):
+    fields = FormFields()
+    try:
+        _read_parts(reader, boundary, limits, spool_dir, fields)
+    except BaseException:
+        for field in fields.all_fields():
+            field.close()
+        raise
+    return fields
+
+
+class _PartLimits(object):
+    """Tracks the size limits of file parts and their number"""
+
+    def __init__(self, max_filesize, field_limits, max_total, max_files=None):
+        self.max_filesize = max_filesize
+        self.field_limits = field_limits if field_limits is not None else dict()
+        self.max_total = max_total
+        self.max_files = max_files
+        self.total = 0
+        self.files = 0
+
+    def add_file(self):
+        """Raise MultipartError if another file part goes over the limit on
+        their number"""
+        self.files += 1
+        if self.max_files is not None and self.files > self.max_files:
+            raise MultipartError('Too many files.',
+                                 'Maximum number of files is {0}'.format(self.max_files))
+
+    def check(self, name, size, chunk_size):
+        """Raise PartTooLarge if adding chunk_size bytes to a part of the
+        given name and size goes over a limit"""
+        limit = self.field_limits.get(name, self.max_filesize)
+        if size + chunk_size > limit:
+            raise PartTooLarge('File is too large.',
+                               'Maximum filesize is {0} bytes'.format(limit))
+        self.total += chunk_size
+        if self.max_total is not None and self.total > self.max_total:
+            raise PartTooLarge('Files are too large.',
+                               'Maximum total size is {0} bytes'.format(self.max_total))
+
+
+def _read_parts(reader, boundary, limits, spool_dir, fields):
+    delimiter = b'--' + boundary
+    # Skip the preamble
+    reader.skip_until(delimiter)
+    while True:
+        ending = reader.read_exact(2)
+        if ending == b'--':
+            break
+        if ending != b'\r\n':
+            raise MultipartError('Invalid form encoding.', 'Malformed multipart boundary')
+        headers = reader.read_until(b'\r\n\r\n', MAX_PART_HEADER_BYTES)
+        if headers is None:
+            raise MultipartError('Invalid form encoding.', 'Malformed part headers')
+        name, filename = _part_disposition(headers)
+        encoding = _content_encoding(_part_header(headers, 'content-encoding'))
+        separator = b'\r\n' + delimiter
+        if filename is None:
+            value = bytearray()
+            for chunk in reader.iter_until(separator):
+                value.extend(chunk)
+                if len(value) > MAX_FIELD_BYTES:
+                    raise PartTooLarge('Form field is too large.',
+                                       'Maximum size of the {0} field is {1} '
+                                       'bytes'.format(name, MAX_FIELD_BYTES))
+            field = FormField(name, value=bytes(value).decode('utf-8', 'replace'))
+        else:
+            limits.add_file()
+            field = SpooledFileField(name, filename, spool_dir)
+            chunks = reader.iter_until(separator)
+            if encoding is not None:
+                chunks = _decode(chunks, encoding)
+            try:
+                for chunk in chunks:
+                    limits.check(name, field.size, len(chunk))
+                    field.write(chunk)
+                field.file.flush()
+            except BaseException:
+                field.close()
+                raise
+        if name is not None:
+            fields.add(field)
+        else:
+            field.close()
+
+
+def _part_disposition(headers):
+    """Return the (name, filename) from the Content-Disposition of a part.
+    filename is None if the part is not a file"""
+    disposition = _part_header(headers, 'content-disposition')
+    if disposition is None:
+        raise MultipartError('Invalid form encoding.', 'Part without Content-Disposition')
+    _, params = _parse_header(disposition)
+    return params.get('name'), params.get('filename')
+
+
+def _part_header(headers, name):
+    """Return the value of the named header of a part or None"""
+    for line in headers.decode('utf-8', 'replace').split('\r\n'):
+        key, _, value = line.partition(':')
+        if key.strip().lower() == name:
+            return value.strip()
+    return None
+
+
+def _decode(blocks, encoding):
+    """Yield the decompressed content of the encoded blocks, at most
+    READ_BLOCK_BYTES at a time however much a block expands"""
+    decompressor = None
+    for block in blocks:
+        if decompressor is None:
+            decompressor = zlib.decompressobj(_window_bits(encoding, block))
+        while True:
+            try:
+                data = decompressor.decompress(block, READ_BLOCK_BYTES)
+            except zlib.error:
+                raise MultipartError('Invalid form encoding.',
+                                     'Corrupt {0} content'.format(encoding))
+            if data:
+                yield data
+            block = decompressor.unconsumed_tail
+            # A full block may leave more output to come even with no input left
+            if not block and len(data) < READ_BLOCK_BYTES:
+                break
+    if decompressor is None or not decompressor.eof:
+        raise MultipartError('Invalid form encoding.',
+                             'Incomplete {0} content'.format(encoding))
+
+
+def _window_bits(encoding, first_block):
+    if encoding == 'gzip':
+        return 16 + zlib.MAX_WBITS
+    # deflate should have a zlib header but some clients send raw deflate
+    if len(first_block) >= 2 and first_block[0] & 0x0f == 8 and \
+            (first_block[0] * 256 + first_block[1]) % 31 == 0:
+        return zlib.MAX_WBITS
+    return -zlib.MAX_WBITS
+
+
+# ------------------------------------------------------------------------------
+class _DecodedStream(object):
+    """A stream of the decompressed content of encoded blocks that refuses to
+    produce more than max_size bytes"""
+
+    def __init__(self, blocks, encoding, max_size=None):
+        self._blocks = _decode(blocks, encoding)
+        self._max_size = max_size
+        self.size = 0
+
+    def read(self, size=-1):
+        """Return the next block, of at most READ_BLOCK_BYTES, or b'' at the end"""
+        block = next(self._blocks, b'')
+        self.size += len(block)
+        if self._max_size is not None and self.size > self._max_size:
+            raise PartTooLarge('Request is too large.',
+                               'Maximum size of a decompressed request is {0} '
+                               'bytes'.format(self._max_size))
+        return block
+
+
+class _BodyReader(object):
+    """Buffered reader over the request body that never reads beyond
+    the declared content length"""
+
+    def __init__(self, stream, length):
+        self._stream = stream
+        self._remaining = length
+        self._buffer = b''
+
+    def _fill(self):
+        """Read another block into the buffer. Returns False at the end of the body"""
+        if self._remaining == 0:
+            return False
+        size = READ_BLOCK_BYTES if self._remaining < 0 else min(READ_BLOCK_BYTES,
+                                                                  self._remaining)
+        block = self._stream.read(size)
+        if not block:
+            self._remaining = 0
+            return False
+        if self._remaining > 0:
+            self._remaining -= len(block)
+        self._buffer += block
+        return True
+
+    def iter_blocks(self):
+        """Yield the rest of the body in blocks"""
+        while self._buffer or self._fill():
+            block, self._buffer = self._buffer, b''
+            yield block
+
+    def read_all(self, limit):
+        """Read the whole body. Returns None if it is longer than limit"""
+        while len(self._buffer) <= limit and self._fill():
+            pass
+        if len(self._buffer) > limit:
+            return None
+        body, self._buffer = self._buffer, b''
+        return body
+
+    def read_exact(self, size):
+        while len(self._buffer) < size and self._fill():
+            pass
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def read_until(self, marker, limit):
+        """Return everything up to marker and consume the marker. Returns None if
+        the marker is not found within limit bytes"""
+        while True:
+            index = self._buffer.find(marker)
+            if index >= 0:
+                data = self._buffer[:index]
+                self._buffer = self._buffer[index + len(marker):]
+                return data
+            if len(self._buffer) > limit or not self._fill():
+                return None
+
+    def skip_until(self, marker):
+        for _ in self.iter_until(marker):
+            pass
+
+    def iter_until(self, marker):
+        """Yield the data up to marker in blocks then consume the marker.
+        Raises MultipartError if the body ends before marker is found"""
+        while True:
+            index = self._buffer.find(marker)
+            if index >= 0:
+                data = self._buffer[:index]
+                self._buffer = self._buffer[index + len(marker):]
+                if data:
+                    yield data
+                return
+            # Keep enough back to match a marker split across blocks
+            keep = len(marker) - 1
+            if len(self._buffer) > keep:
+                data = self._buffer[:len(self._buffer) - keep]
+                self._buffer = self._buffer[len(self._buffer) - keep:]
+                yield data
+            if not self._fill():
+                raise MultipartError('Invalid form encoding.', 'Unexpected end of form data')
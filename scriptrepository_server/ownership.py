@@ -0,0 +1,56 @@
+"""An index of the owner, i.e. the author of the last commit, of every path
+in a repository. It answers the question asked by each removal request
+without walking the history.
+
+The index is stored in the git directory of the clone and kept up to date
+from the new commits as HEAD moves, see historyindex.
+"""
+from .historyindex import HistoryIndex, get_index
+
+# Name of the file holding the index within the git directory
+INDEX_FILENAME = 'scriptrepository-owners.json'
+# Marks the author line of each commit in the log output
+_AUTHOR_MARK = '\x1f'
+
+
+def get_ownership_index(git_repo):
+    """Return the OwnershipIndex for the given repository, creating it
+    if required"""
+    return get_index(OwnershipIndex, git_repo)
+
+
+# ------------------------------------------------------------------------------
+class OwnershipIndex(HistoryIndex):
+    """Maps each path to the 'author <email>' of the last commit touching it"""
+
+    FILENAME = INDEX_FILENAME
+    DESCRIPTION = 'ownership index'
+    ENTRIES_KEY = 'owners'
+
+    def owner(self, path):
+        """Return the owner of the given repository path or an empty string
+        if it has never existed. The index is brought up to date first if it
+        no longer describes HEAD, e.g. a refresh after a commit failed"""
+        with self._lock:
+            self._reload_if_changed()
+            if self._entries is None or self._head != self.git_repo.current_head():
+                self._refresh()
+            return self._entries.get(path, '')
+
+    # ------------------------------------------------------------------------
+    def _apply_log(self, entries, revisions):
+        """Read the log for revisions, newest first, and record the most
+        recent author of each path that appears"""
+        output = self.git_repo.git("log", ["--no-renames", "--name-only", "-z",
+                                           "--format=" + _AUTHOR_MARK + "%an <%ae>",
+                                           revisions])
+        seen = set()
+        author = None
+        for entry in output.split('\0'):
+            # The first path of each commit follows a newline
+            entry = entry.lstrip('\n')
+            if entry.startswith(_AUTHOR_MARK):
+                author = entry[len(_AUTHOR_MARK):]
+            elif entry and entry not in seen:
+                seen.add(entry)
+                entries[entry] = author
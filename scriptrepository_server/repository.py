@@ -4,65 +4,203 @@ out to the shell git command.
 The support is limited to the following abilities:
  - pull/push
  - commit
+
+Every git command is run with the repository root as its working directory
+so the process-wide working directory is never changed. Threads and processes
+sharing a clone are serialised by a lock per repository, see repository_lock.
 """
+from collections import OrderedDict
 from contextlib import contextmanager
+import hashlib
+import logging
 import os
+import random
 import subprocess as subp
+import threading
 import time
 
+from . import metrics, tracing
+from .gitobjects import ObjectStore, identity, read_config_value, read_ref
+from .locking import RepositoryLock
+from .manifest import get_manifest
+from .ownership import get_ownership_index
+
+# Name of the directory, within the git directory, holding the repository lock
+LOCK_DIRNAME = 'scriptrepository-lock'
+
+# Format of the published date of a file
+PUBLISHED_DATE_FORMAT = "%Y-%b-%d %H:%M:%S"
+# Number of recently uploaded contents whose blob ids are remembered
+BLOB_CACHE_SIZE = 1024
+# Loose objects younger than this are kept by maintenance, see GitRepository.maintain
+PRUNE_EXPIRE = '1.hour.ago'
+# Most times a push is attempted while the remote keeps moving on
+PUSH_ATTEMPTS = 5
+# Limits of the delay before retrying a rejected push, which doubles each time
+PUSH_BACKOFF_SECS = 0.05
+PUSH_BACKOFF_MAX_SECS = 2.0
+
+# Long-lived repository objects, keyed by (real path, remote, branch, bare)
+_REPOSITORIES = dict()
+_REPOSITORIES_LOCK = threading.Lock()
+# Locks guarding each clone, keyed by the real path of the repository root
+_REPOSITORY_LOCKS = dict()
+_REPOSITORY_LOCKS_LOCK = threading.Lock()
+# Blob ids of recently uploaded content, keyed by (content sha1, size)
+_BLOB_IDS = OrderedDict()
+_BLOB_IDS_LOCK = threading.Lock()
+
 
 # ------------------------------------------------------------------------------
 # Helper Functions
 # ------------------------------------------------------------------------------
-def _git(cmd, args, username=None, email=None):
-    args.insert(0, cmd)
+def _git(root, cmd, args, username=None, email=None, input=None):
+    """Run a git command against the repository at root. The process
+    working directory is never changed so this is safe to call from
+    several threads"""
+    start = time.monotonic()
+    try:
+        with tracing.span('git', command=cmd, args=list(args)):
+            return _shellcmd("git", _git_args(cmd, args, username, email), cwd=root,
+                             input=input)
+    finally:
+        metrics.observe('scriptrepository_git_seconds', time.monotonic() - start, command=cmd)
+
+
+def _git_args(cmd, args, username=None, email=None):
+    """Return the arguments to git for the given command"""
+    args = [cmd] + list(args)
     if username is not None and email is not None:
         config = ['-c', 'user.name="{0}"'.format(username),
                   '-c', 'user.email="{0}"'.format(email)]
         config.extend(args)
         args = config
-
-    return _shellcmd("git", args)
+    return args
 
 
-def _shellcmd(cmd, args=[]):
-    """Use subprocess to call a given command.
+def _shellcmd(cmd, args=[], cwd=None, input=None):
+    """Use subprocess to call a given command. Any input is passed to stdin.
     Return stdout/stderr as a str object if an error occurred
     """
     cmd = [cmd]
     cmd.extend(args)
+    stdin = subp.PIPE if input is not None else None
     try:
-        p = subp.Popen(cmd, stdout=subp.PIPE, stderr=subp.PIPE)
+        p = subp.Popen(cmd, stdin=stdin, stdout=subp.PIPE, stderr=subp.PIPE, cwd=cwd)
     except ValueError as err:
         raise RuntimeError(err)
-    stdout, stderr = p.communicate()
+    stdout, stderr = p.communicate(input)
     if p.returncode == 0:
         return str(stdout, encoding='utf-8')
     else:
         raise RuntimeError(stdout + stderr)
 
 
-@contextmanager
-def transaction(git_repo):
-    dir_on_enter = os.getcwd()
-    os.chdir(git_repo.root)
-    git_repo.begin()
-    try:
-        yield None
-    except Exception as exc:
-        git_repo.rollback()
-        os.chdir(dir_on_enter)
-        raise exc
+def open_repository(path, remote='origin', branch='master'):
+    """Return the GitRepository backend appropriate for the clone at path:
+    a BareGitRepository for a bare clone, or a NativeGitRepository if its
+    config sets scriptrepository.nativeObjects, otherwise a GitRepository. The same
+    object is returned each time the clone is opened. Its state only changes
+    while the repository lock is held so it is safe to share between threads"""
+    bare = not os.path.exists(os.path.join(path, '.git')) and \
+        os.path.isfile(os.path.join(path, 'HEAD'))
+    key = (os.path.realpath(path), remote, branch, bare)
+    with _REPOSITORIES_LOCK:
+        repo = _REPOSITORIES.get(key)
+        if repo is None or not os.path.exists(path):
+            repo_type = GitRepository
+            if bare:
+                native = read_config_value(path, 'scriptrepository', 'nativeObjects')
+                repo_type = NativeGitRepository if native == 'true' else BareGitRepository
+            repo = repo_type(path, remote, branch)
+            _REPOSITORIES[key] = repo
+    return repo
+
+
+def repository_lock(root):
+    """Return the lock that guards the clone at root. Anything that modifies
+    the clone, e.g. a sync or a commit, must hold this lock. It is shared by
+    every thread and process using the clone.
+    """
+    key = os.path.realpath(root)
+    with _REPOSITORY_LOCKS_LOCK:
+        lock = _REPOSITORY_LOCKS.get(key)
+        if lock is None:
+            lock = RepositoryLock(os.path.join(_git_dir(root), LOCK_DIRNAME))
+            _REPOSITORY_LOCKS[key] = lock
+    return lock
+
+
+def _git_dir(root):
+    """Return the git directory of the clone at root"""
+    dot_git = os.path.join(root, '.git')
+    return dot_git if os.path.isdir(dot_git) else root
+
+
+def blob_id(content_sha1, size, filepath):
+    """Return the id git gives the blob holding the content of filepath,
+    whose SHA-1 and size are already known. Content seen recently is answered
+    from a cache without reading the file again."""
+    key = (content_sha1, size)
+    with _BLOB_IDS_LOCK:
+        blob = _BLOB_IDS.get(key)
+        if blob is not None:
+            _BLOB_IDS.move_to_end(key)
+            return blob
+    digest = hashlib.sha1('blob {0}\0'.format(size).encode('ascii'))
+    with open(filepath, 'rb') as content:
+        for block in iter(lambda: content.read(64*1024), b''):
+            digest.update(block)
+    blob = digest.hexdigest()
+    with _BLOB_IDS_LOCK:
+        _BLOB_IDS[key] = blob
+        if len(_BLOB_IDS) > BLOB_CACHE_SIZE:
+            _BLOB_IDS.popitem(last=False)
+    return blob
+
+
+def format_published_date(timestamp):
+    """Return the published date for a file modified at the given time"""
+    # The original code added 2 minutes to the modification date of the file
+    # so we preserve this behaviour here
+    return time.strftime(PUBLISHED_DATE_FORMAT, time.gmtime(int(timestamp) + 120))
+
+
+def push_backoff(retry):
+    """Return the number of seconds to wait before the given retry of a push,
+    counting from 1. The delay is drawn at random up to a limit that doubles
+    with each retry so that competing publishers do not retry in step"""
+    return random.uniform(0, min(PUSH_BACKOFF_MAX_SECS, PUSH_BACKOFF_SECS * 2 ** (retry - 1)))
+
+
+def record_push(attempts=None):
+    """Count a retry of a push, or a push that succeeded after attempts"""
+    if attempts is None:
+        metrics.increment('scriptrepository_push_retries_total')
     else:
-        os.chdir(dir_on_enter)
+        metrics.increment('scriptrepository_pushes_total', attempts=attempts)
+
+
+def _is_push_rejected(err):
+    """Return True if the error from a push indicates that the remote
+    has moved on, i.e. the push was not a fast-forward"""
+    output = err.args[0] if err.args else b''
+    if isinstance(output, str):
+        output = output.encode('utf-8')
+    return b'[rejected]' in output or b'non-fast-forward' in output
 
 
 @contextmanager
-def dir_change(newdir):
-    dir_on_enter = os.getcwd()
-    os.chdir(newdir)
-    yield None
-    os.chdir(dir_on_enter)
+def transaction(git_repo):
+    """Holds the repository lock for the duration of the block and rolls
+    back to the starting commit if an exception is raised"""
+    with git_repo.lock:
+        git_repo.begin()
+        try:
+            yield None
+        except Exception as exc:
+            git_repo.rollback()
+            raise exc
 
 
 # ------------------------------------------------------------------------------
@@ -77,47 +215,116 @@ class GitRepository(object):
             raise ValueError('Unable to find git repository at "{0}". '
                              'It must be have been cloned first.'.format(path))
         self.root = path
+        # Directory that uploaded files are written to before being committed
+        self.worktree = path
+        self.git_dir = _git_dir(path)
+        # The commit that changes are made on top of
+        self.ref = 'HEAD'
         self.remote = remote
         self.branch = branch
+        self.lock = repository_lock(path)
+
+    def git(self, cmd, args, **kwargs):
+        """Run a git command against this repository"""
+        return _git(self.root, cmd, args, **kwargs)
+
+    @property
+    def owners(self):
+        """The OwnershipIndex of this repository"""
+        return get_ownership_index(self)
+
+    @property
+    def manifest(self):
+        """The Manifest of this repository"""
+        return get_manifest(self)
+
+    def tracked_head(self):
+        """Return the commit of the remote branch as last fetched. Raises
+        RuntimeError if the clone does not track it"""
+        return _git(self.root, "rev-parse",
+                    ["--verify", "-q", self.remote + "/" + self.branch]).rstrip()
+
+    def warm(self):
+        """Check the clone and build its indexes ahead of the first request.
+          :returns The commit of the remote branch
+        """
+        head = self.tracked_head()
+        with self.lock:
+            self._refresh_indexes()
+        return head
 
     def begin(self):
         """Capture the current state so that we can rollback"""
-        self._sha1_at_begin = _git("rev-parse", ["HEAD"]).rstrip()
+        self._sha1_at_begin = _git(self.root, "rev-parse", ["HEAD"]).rstrip()
 
     def rollback(self):
         self.reset(self._sha1_at_begin)
 
-    def commit_and_push(self, commit, add_changes=True):
+    def commit_and_push(self, commit, add_changes=True, on_committed=None):
         """This method is transactional. Any failure results in everything
-        being rolled back
+        being rolled back. If given, on_committed is called once the commit
+        exists locally, before the push.
         """
         with transaction(self):
-            if add_changes:
-                pub_date = self._published_date(commit.filelist[0])
-                self.add(commit.filelist)
-            else:
-                self.remove(commit.filelist)
-                pub_date = ''
-            self.commit(commit.author, commit.email,
-                        commit.committer, commit.comment)
-            self.push(self.remote, self.branch)
+            with metrics.timed("commit"):
+                if add_changes:
+                    pub_date = self._published_date(commit.filelist[0])
+                    self.add(commit.filelist)
+                else:
+                    self.remove(commit.filelist)
+                    pub_date = ''
+                self.commit(commit.author, commit.email,
+                            commit.committer, commit.comment)
+            if on_committed is not None:
+                on_committed()
+            with metrics.timed("push"):
+                self.push_with_rebase(commit.author, commit.email)
+        self._refresh_indexes()
 
         return pub_date
 
+    def commit_all_and_push(self, commits, on_committed=None):
+        """Create a chain of commits, one per GitCommitInfo, and send them
+        to the remote with a single push. Like commit_and_push any failure
+        rolls back every commit in the chain.
+          :param commits A list of GitCommitInfo objects, applied in order
+          :param on_committed An optional callable run before the push
+          :returns A dictionary mapping each added file to its published date
+        """
+        pub_dates = dict()
+        with transaction(self):
+            with metrics.timed("commit"):
+                for commit in commits:
+                    if commit.add:
+                        for filepath in commit.filelist:
+                            pub_dates[filepath] = self._published_date(filepath)
+                        self.add(commit.filelist)
+                    else:
+                        self.remove(commit.filelist)
+                    self.commit(commit.author, commit.email,
+                                commit.committer, commit.comment)
+            if on_committed is not None:
+                on_committed()
+            with metrics.timed("push"):
+                self.push_with_rebase(commits[-1].author, commits[-1].email)
+        self._refresh_indexes()
+
+        return pub_dates
+
     def reset(self, sha1):
         """Performs a hard reset to the given treeish reference"""
-        return _git("reset", args=["--hard", sha1])
+        return _git(self.root, "reset", args=["--hard", sha1])
 
     def add(self, filelist):
-        _git("add", filelist)
+        _git(self.root, "add", filelist)
 
     def remove(self, filelist):
-        _git("rm", filelist)
+        _git(self.root, "rm", filelist)
 
     def user_can_delete(self, filename, author, mail):
-        with dir_change(self.root):
-            file_owner = _git("log", ['-1', '--format=%an <%ae>', '--', filename]).rstrip()
-            req_user = '{0} <{1}>'.format(author, mail)
+        with self.lock:
+            file_owner = self.owners.owner(self._repo_path(filename))
+        req_user = '{0} <{1}>'.format(author, mail)
         return (req_user == file_owner)
 
     def commit(self, author, email, committer, msg):
@@ -127,39 +334,368 @@ class GitRepository(object):
         # is fed through separately to subprocess.Popen
         msg = '-m {0}'.format(msg)
 
-        _git('commit', [author_info, msg], username=author, email=email)
+        _git(self.root, 'commit', [author_info, msg], username=author, email=email)
 
     def sync_with_remote(self):
         """After this method call the local repository will match the remote"""
-        with dir_change(self.root):
+        with self.lock, metrics.timed("sync"):
             self.reset(self.remote + "/" + self.branch)
             # Update
             self.pull(rebase=True)
+            self._refresh_indexes()
 
-    def pull(self, rebase=True):
-        args = ["--rebase"] if rebase else []
-        _git("pull", args)
+    def pull(self, rebase=True, username=None, email=None):
+        """Pull from the remote. Rebasing rewrites the local commits so the
+        committer identity is given as it is for a commit. A failed rebase is
+        aborted to leave the clone ready for a rollback"""
+        if not rebase:
+            _git(self.root, "pull", [])
+            return
+        try:
+            _git(self.root, "pull", ["--rebase"], username=username, email=email)
+        except RuntimeError:
+            try:
+                _git(self.root, "rebase", ["--abort"])
+            except RuntimeError:
+                # No rebase was in progress
+                pass
+            raise
 
     def push(self, remote, branch):
-        _git("push", [remote, branch])
+        _git(self.root, "push", [remote, branch])
+
+    def push_with_rebase(self, username=None, email=None):
+        """Push to the remote branch. If the push is rejected because the
+        remote has moved on then rebase the local commits onto it, as the
+        given committer, and try again, up to PUSH_ATTEMPTS times in all,
+        after a randomised delay that grows with each retry
+        """
+        for attempt in range(1, PUSH_ATTEMPTS + 1):
+            try:
+                self.push(self.remote, self.branch)
+            except RuntimeError as err:
+                if not _is_push_rejected(err) or attempt == PUSH_ATTEMPTS:
+                    raise
+                record_push()
+                delay = push_backoff(attempt)
+                logging.getLogger(__name__).debug("Push rejected, rebasing onto remote "
+                                                  "after %.3fs", delay)
+                time.sleep(delay)
+                self._rebase_onto_remote(username, email)
+            else:
+                record_push(attempts=attempt)
+                return
+
+    def _rebase_onto_remote(self, username=None, email=None):
+        """Fetch the remote branch and replay the local commits on top of it"""
+        self.pull(rebase=True, username=username, email=email)
+
+    def _refresh_indexes(self):
+        """Keep the ownership index and manifest in step with new commits. A
+        failure here is not fatal as both are brought up to date next time"""
+        for name, index in (("ownership index", self.owners), ("manifest", self.manifest)):
+            try:
+                with metrics.timed("index"):
+                    index.refresh()
+            except RuntimeError as exc:
+                logging.getLogger(__name__).warning("Unable to update %s: %s", name, exc)
+
+    def maintain(self):
+        """Repack every object into one pack, prune unreachable objects
+        older than PRUNE_EXPIRE, pack the refs and write a commit-graph. The
+        caller must hold the lock"""
+        with metrics.timed("maintenance"):
+            _git(self.root, "repack", ["-A", "-d", "-q"])
+            _git(self.root, "prune", ["--expire=" + PRUNE_EXPIRE])
+            _git(self.root, "pack-refs", ["--all"])
+            _git(self.root, "commit-graph", ["write", "--reachable"])
+
+    def _repo_path(self, filepath):
+        """Return the path of a file in the working tree relative to the repository root"""
+        path = os.path.relpath(filepath, self.worktree).replace(os.sep, '/')
+        if path.startswith('../'):
+            raise RuntimeError("'{0}' is outside of the working tree".format(filepath))
+        return path
+
+    def published_date_if_unchanged(self, filepath, blob):
+        """Return the date that filepath was published if its content at
+        self.ref is the given blob, otherwise None. The manifest answers
+        without running git unless it is behind self.ref"""
+        path = self._repo_path(filepath)
+        head, entries = self.manifest.snapshot()
+        if head is None or head != self.current_head():
+            return self._published_date_from_git(path, blob)
+        entry = entries.get(path)
+        if entry is None or entry[0] != blob:
+            return None
+        return format_published_date(entry[2])
+
+    def current_head(self):
+        """Return the commit at self.ref, read without running git if possible"""
+        head = read_ref(self.git_dir, self.ref)
+        if head is None:
+            head = _git(self.root, "rev-parse", [self.ref]).rstrip()
+        return head
+
+    def _published_date_from_git(self, path, blob):
+        try:
+            current = _git(self.root, "rev-parse",
+                           ["--verify", "-q", "{0}:{1}".format(self.ref, path)]).rstrip()
+        except RuntimeError:
+            # Not in the repository
+            return None
+        if current != blob:
+            return None
+        committed = _git(self.root, "log", ["-1", "--format=%ct", self.ref, "--", path])
+        return format_published_date(committed.strip())
 
     def _published_date(self, filepath):
-        timeformat = "%Y-%b-%d %H:%M:%S"
-        stat = os.stat(filepath)
-        modified_time = int(stat.st_mtime)
-        # The original code added 2 minutes to the modification date of the file
-        # so we preserve this behaviour here
-        return time.strftime(timeformat, time.gmtime(modified_time + 120))
+        return format_published_date(os.stat(filepath).st_mtime)
+
+
+class BareGitRepository(GitRepository):
+    """Models a bare clone. Commits are built with plumbing commands that
+    touch only the trees along the path of each changed file, so the cost of
+    a commit does not grow with the number of files in the repository.
+
+    Uploaded files are written to a staging directory inside the clone and
+    removed once they have been committed. The branch ref is the only state
+    changed by a commit so a rollback simply moves it back.
+    """
+
+    STAGING_DIR = 'upload-staging'
+
+    def __init__(self, path, remote='origin', branch='master'):
+        super(BareGitRepository, self).__init__(path, remote, branch)
+        self.worktree = os.path.join(path, self.STAGING_DIR)
+        self.ref = 'refs/heads/' + branch
+        self._pending = []
+
+    def begin(self):
+        self._sha1_at_begin = _git(self.root, "rev-parse", [self.ref]).rstrip()
+
+    def tracked_head(self):
+        """Return the commit of the branch, which a bare clone fetches directly"""
+        return _git(self.root, "rev-parse", ["--verify", "-q", self.ref]).rstrip()
+
+    def commit_and_push(self, commit, add_changes=True, on_committed=None):
+        commit.add = add_changes
+        pub_dates = self.commit_all_and_push([commit], on_committed)
+        return pub_dates.get(commit.filelist[0], '')
+
+    def commit_all_and_push(self, commits, on_committed=None):
+        pub_dates = dict()
+        try:
+            with transaction(self):
+                self._pending = []
+                with metrics.timed("commit"):
+                    for commit in commits:
+                        if commit.add:
+                            for filepath in commit.filelist:
+                                pub_dates[filepath] = self._published_date(filepath)
+                        self._pending.append((commit, self._stage(commit)))
+                    self._commit_pending()
+                if on_committed is not None:
+                    on_committed()
+                with metrics.timed("push"):
+                    self.push_with_rebase(commits[-1].author, commits[-1].email)
+        finally:
+            self._pending = []
+            self._clear_staged(commits)
+        self._refresh_indexes()
+
+        return pub_dates
+
+    def reset(self, sha1):
+        """Moves the branch to the given commit"""
+        return _git(self.root, "update-ref", [self.ref, sha1])
+
+    def sync_with_remote(self):
+        """After this method call the local branch will match the remote"""
+        with self.lock, metrics.timed("sync"):
+            _git(self.root, "fetch", [self.remote, "+{0}:{0}".format(self.ref)])
+            self._refresh_indexes()
+
+    def _rebase_onto_remote(self, username=None, email=None):
+        """Fetch and recreate the pending commits on top of the new tip. They
+        keep the identities they were first made with"""
+        self.sync_with_remote()
+        self._commit_pending()
+
+    # ------------------------------------------------------------------------
+    def _stage(self, commit):
+        """Write the blobs for a commit to the object database.
+          :returns A list of (path, blob sha1) pairs with a sha1 of None for removals
+        """
+        edits = []
+        for filepath in commit.filelist:
+            if commit.add:
+                blob = _git(self.root, "hash-object", ["-w", "--", filepath]).rstrip()
+            else:
+                blob = None
+            edits.append((self._repo_path(filepath), blob))
+        return edits
+
+    def _clear_staged(self, commits):
+        for commit in commits:
+            if not commit.add:
+                continue
+            for filepath in commit.filelist:
+                try:
+                    os.remove(filepath)
+                except OSError:
+                    pass
+
+    def _commit_pending(self):
+        """Create the chain of pending commits on top of the current branch tip"""
+        parent = _git(self.root, "rev-parse", [self.ref]).rstrip()
+        for commit, edits in self._pending:
+            parent_tree = _git(self.root, "rev-parse", [parent + "^{tree}"]).rstrip()
+            tree = parent_tree
+            for path, blob in edits:
+                tree = self._update_tree(tree, path.split('/'), blob)
+                if tree is None:
+                    tree = _git(self.root, "mktree", [], input=b'').rstrip()
+            if tree == parent_tree:
+                raise RuntimeError("nothing to commit, tree unchanged")
+            sha1 = _git(self.root, "commit-tree", [tree, "-p", parent, "-m", commit.comment],
+                        username=commit.author, email=commit.email).rstrip()
+            _git(self.root, "update-ref", [self.ref, sha1, parent])
+            parent = sha1
+
+    def _update_tree(self, tree, parts, blob):
+        """Return the sha1 of a copy of tree with the entry at the path given
+        by parts set to blob, or removed if blob is None. Returns None if the
+        resulting tree is empty."""
+        entries = self._read_tree(tree) if tree is not None else dict()
+        name = parts[0]
+        existing = entries.get(name)
+        if len(parts) == 1:
+            if existing is not None and existing[1] == 'tree':
+                raise RuntimeError("Cannot replace directory '{0}' with a file".format(name))
+            if blob is None:
+                if existing is None:
+                    raise RuntimeError("pathspec '{0}' did not match any files".format(name))
+                del entries[name]
+            else:
+                mode = existing[0] if existing is not None else '100644'
+                entries[name] = (mode, 'blob', blob)
+        else:
+            if existing is not None and existing[1] != 'tree':
+                raise RuntimeError("'{0}' is a file not a directory".format(name))
+            subtree = self._update_tree(existing[2] if existing is not None else None,
+                                        parts[1:], blob)
+            if subtree is None:
+                entries.pop(name, None)
+            else:
+                entries[name] = ('040000', 'tree', subtree)
+        if not entries:
+            return None
+        return self._write_tree(entries)
+
+    def _write_tree(self, entries):
+        """Return the sha1 of a tree with the given entries"""
+        listing = b''.join('{0} {1} {2}\t{3}\0'.format(mode, kind, sha1, entry).encode('utf-8')
+                           for entry, (mode, kind, sha1) in entries.items())
+        return _git(self.root, "mktree", ["-z"], input=listing).rstrip()
+
+    def _read_tree(self, tree):
+        """Return the entries of a single tree as a dictionary of
+        name: (mode, type, sha1)"""
+        entries = dict()
+        for line in _git(self.root, "ls-tree", ["-z", tree]).split('\0'):
+            if not line:
+                continue
+            info, name = line.split('\t', 1)
+            mode, kind, sha1 = info.split()
+            entries[name] = (mode, kind, sha1)
+        return entries
+
+
+class NativeGitRepository(BareGitRepository):
+    """A bare clone whose objects and refs are read and written in Python, see
+    gitobjects. Only fetching, pushing and reading the history run git, so a
+    commit spawns no processes. Enabled for a bare clone with
+    git config scriptrepository.nativeObjects true
+    """
+
+    def __init__(self, path, remote='origin', branch='master'):
+        super(NativeGitRepository, self).__init__(path, remote, branch)
+        self.objects = ObjectStore(self.git_dir)
+
+    def begin(self):
+        self._sha1_at_begin = self.tracked_head()
+
+    def tracked_head(self):
+        head = self.objects.read_ref(self.ref)
+        if head is None:
+            raise RuntimeError("Unable to find ref '{0}'".format(self.ref))
+        return head
+
+    def reset(self, sha1):
+        self.objects.update_ref(self.ref, sha1, message='reset: moving to ' + sha1)
+
+    def maintain(self):
+        super(NativeGitRepository, self).maintain()
+        # Stop reading from the packs that have been replaced
+        self.objects.refresh_packs()
+
+    def _published_date_from_git(self, path, blob):
+        if self.objects.lookup_path(self.tracked_head(), path) != blob:
+            return None
+        committed = _git(self.root, "log", ["-1", "--format=%ct", self.ref, "--", path])
+        return format_published_date(committed.strip())
+
+    # ------------------------------------------------------------------------
+    def _stage(self, commit):
+        edits = []
+        for filepath in commit.filelist:
+            blob = None
+            if commit.add:
+                with open(filepath, 'rb') as content:
+                    blob = self.objects.write_stream('blob', content,
+                                                     os.fstat(content.fileno()).st_size)
+            edits.append((self._repo_path(filepath), blob))
+        return edits
+
+    def _commit_pending(self):
+        parent = self.tracked_head()
+        for commit, edits in self._pending:
+            parent_tree = self.objects.tree_of(parent)
+            tree = parent_tree
+            for path, blob in edits:
+                tree = self._update_tree(tree, path.split('/'), blob)
+                if tree is None:
+                    tree = self.objects.write_tree(dict())
+            if tree == parent_tree:
+                raise RuntimeError("nothing to commit, tree unchanged")
+            # As commit-tree run with the author as user.name and user.email
+            committer = identity(commit.author, commit.email, 'committer')
+            sha1 = self.objects.write_commit(tree, [parent],
+                                             identity(commit.author, commit.email, 'author'),
+                                             committer, commit.comment)
+            self.objects.update_ref(self.ref, sha1, parent, committer,
+                                    'commit: ' + commit.comment.split('\n', 1)[0])
+            parent = sha1
+
+    def _write_tree(self, entries):
+        return self.objects.write_tree(entries)
+
+    def _read_tree(self, tree):
+        return self.objects.read_tree(tree)
 
 
 class GitCommitInfo(object):
     """Models a git commit"""
 
     def __init__(self, author, email, comment, filelist,
-                 committer=None, add=True):
+                 committer=None, add=True, existing_dates=None):
         self.author = author
         self.committer = committer if committer is not None else author
         self.email = email
         self.comment = comment
         self.filelist = filelist
         self.add = add
+        # Uploaded files that are already committed with the same content,
+        # mapped to their published dates. They are not in filelist
+        self.existing_dates = existing_dates if existing_dates is not None else dict()
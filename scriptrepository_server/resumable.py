@@ -0,0 +1,216 @@
+"""Resumable uploads for files too large to send in a single request, or
+over a connection that may drop. The file is sent in chunks:
+
+  1. POST ?upload=start with the author, mail, comment and path fields of an
+     upload plus the filename and size of the file. The 201 response gives
+     the ID of the new upload
+  2. PUT ?upload=<id>&offset=<n> for each chunk, with the chunk as the body
+     and its SHA-1 in a Chunk-SHA1 header. A chunk must start where the last
+     one ended, otherwise it is refused with 409 and the offset to resume from
+  3. GET ?upload=<id> reports the offset reached, to resume an upload after a
+     dropped connection
+  4. POST ?upload=<id> once every chunk is in. The file is then committed as
+     if it had been sent in a single upload form
+
+The chunks are appended to a file in the uploads directory, which is shared
+by the worker processes. An upload that is not touched for
+UPLOAD_EXPIRY_SECS is removed when the next upload starts or the next chunk
+of any upload arrives.
+"""
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+import uuid
+
+from .base import ScriptUploadForm
+from .errors import BadRequestException, ConflictException, NotFoundException
+from .multipart import READ_BLOCK_BYTES, SPOOL_PREFIX, SpooledFileField
+
+# Largest file that may be uploaded in chunks
+MAX_UPLOAD_BYTES = 64*1024*1024
+# Largest chunk accepted in a single request
+MAX_CHUNK_BYTES = 1*1024*1024
+# Uploads are removed after going this many seconds without a chunk
+UPLOAD_EXPIRY_SECS = 24*60*60
+# Default location of the uploads in progress
+DEFAULT_UPLOADS_DIR = os.path.join(tempfile.gettempdir(), 'scriptrepository-uploads')
+
+# Fields given when an upload is started
+_START_FIELDS = ("author", "mail", "comment", "path", "filename", "size")
+
+
+# ------------------------------------------------------------------------------
+class UploadStore(object):
+    """Keeps the uploads in progress in a directory"""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def start(self, request_fields):
+        """Start an upload described by the fields of a start request
+          :returns The new Upload
+          :raises BadRequestException if a field is missing or invalid
+        """
+        missing = [name for name in _START_FIELDS if name not in request_fields]
+        invalid = [name for name in _START_FIELDS if name in request_fields and
+                   not _valid_start_field(name, request_fields[name].value)]
+        if missing or invalid:
+            detail = []
+            if missing:
+                detail.append('Missing fields: ' + ','.join(missing))
+            if invalid:
+                detail.append('Invalid fields: ' + ','.join(invalid))
+            raise BadRequestException('Incomplete form information supplied.', "\n".join(detail))
+        info = {name: request_fields[name].value for name in _START_FIELDS}
+        info['size'] = int(info['size'])
+        if info['size'] > MAX_UPLOAD_BYTES:
+            raise BadRequestException("File is too large.",
+                                      "Maximum filesize is {0} bytes".format(MAX_UPLOAD_BYTES))
+        os.makedirs(self.directory, exist_ok=True)
+        self.expire()
+        upload = Upload(self, uuid.uuid4().hex, info)
+        open(upload.data_path, 'wb').close()
+        tmp_filename = upload.info_path + '.tmp'
+        with open(tmp_filename, 'w') as info_file:
+            json.dump(info, info_file)
+        os.replace(tmp_filename, upload.info_path)
+        return upload
+
+    def load(self, upload_id):
+        """Return the Upload with the given ID
+          :raises NotFoundException if it is unknown or has expired
+        """
+        if upload_id.isalnum():
+            try:
+                with open(os.path.join(self.directory, upload_id + '.json'), 'r') as info_file:
+                    return Upload(self, upload_id, json.load(info_file))
+            except (OSError, ValueError):
+                pass
+        raise NotFoundException("Unknown upload.",
+                                "The upload does not exist or has expired")
+
+    def expire(self, max_age=UPLOAD_EXPIRY_SECS):
+        """Remove uploads that have not received a chunk for max_age seconds"""
+        oldest = time.time() - max_age
+        try:
+            entries = list(os.scandir(self.directory))
+        except OSError:
+            return
+        for entry in entries:
+            try:
+                if entry.name.endswith('.part') and entry.stat().st_mtime < oldest:
+                    Upload(self, entry.name[:-len('.part')], None).discard()
+            except OSError:
+                pass
+
+
+class Upload(object):
+    """A file being received in chunks"""
+
+    def __init__(self, store, upload_id, info):
+        self.store = store
+        self.upload_id = upload_id
+        self.info = info
+        self.data_path = os.path.join(store.directory, upload_id + '.part')
+        self.info_path = os.path.join(store.directory, upload_id + '.json')
+
+    @property
+    def size(self):
+        return self.info['size']
+
+    @property
+    def offset(self):
+        """Number of bytes received so far"""
+        try:
+            return os.stat(self.data_path).st_size
+        except OSError:
+            raise NotFoundException("Unknown upload.",
+                                    "The upload does not exist or has expired")
+
+    def status(self):
+        return dict(upload=self.upload_id, offset=self.offset, size=self.size)
+
+    def append(self, offset, stream, length, sha1):
+        """Append length bytes read from stream, which must have the given
+        SHA-1, at offset. A chunk that is not whole is discarded.
+          :returns The offset reached
+        """
+        if length > MAX_CHUNK_BYTES:
+            raise BadRequestException("Chunk is too large.",
+                                      "Maximum chunk size is {0} bytes".format(MAX_CHUNK_BYTES))
+        try:
+            data = open(self.data_path, 'r+b')
+        except OSError:
+            raise NotFoundException("Unknown upload.",
+                                    "The upload does not exist or has expired")
+        with data:
+            # Closing the file releases the lock
+            fcntl.flock(data, fcntl.LOCK_EX)
+            received = os.fstat(data.fileno()).st_size
+            if offset != received:
+                raise ConflictException("Chunk out of order.",
+                                        "The upload continues from offset {0}".format(received))
+            if received + length > self.size:
+                raise BadRequestException("Chunk is too large.",
+                                          "The file is {0} bytes".format(self.size))
+            data.seek(received)
+            try:
+                _copy_chunk(stream, data, length, sha1)
+            except BaseException:
+                data.truncate(received)
+                raise
+        return received + length
+
+    def form(self):
+        """Return a ScriptUploadForm for the complete file. The form has its
+        own link to the content so the upload can be retried if the commit
+        fails, until it is discarded"""
+        received = self.offset
+        if received != self.size:
+            raise BadRequestException("Upload is incomplete.",
+                                      "{0} of {1} bytes have been received".format(received,
+                                                                                   self.size))
+        spooled = os.path.join(self.store.directory, SPOOL_PREFIX + uuid.uuid4().hex)
+        try:
+            os.link(self.data_path, spooled)
+        except OSError:
+            # The filesystem does not support hard links
+            shutil.copyfile(self.data_path, spooled)
+        fileitem = SpooledFileField("file", self.info['filename'], path=spooled)
+        return ScriptUploadForm(self.info['author'], self.info['mail'], self.info['comment'],
+                                self.info['path'], fileitem)
+
+    def discard(self):
+        for path in (self.data_path, self.info_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def _copy_chunk(stream, data, length, sha1):
+    digest, remaining = hashlib.sha1(), length
+    while remaining > 0:
+        block = stream.read(min(READ_BLOCK_BYTES, remaining))
+        if not block:
+            break
+        data.write(block)
+        digest.update(block)
+        remaining -= len(block)
+    if remaining > 0 or digest.hexdigest() != sha1.lower():
+        raise BadRequestException("Chunk is corrupt.",
+                                  "The chunk does not match its Chunk-SHA1 header")
+
+
+def _valid_start_field(name, value):
+    if value is None:
+        return False
+    if name == "size":
+        return value.isdigit() and int(value) > 0
+    if name == "filename":
+        return value != '' and os.path.basename(value) not in ('', '.', '..')
+    return ScriptUploadForm.validate_field(name, value)
@@ -0,0 +1,86 @@
+"""Keeps local clones up to date with their remote in the background so that
+requests do not need to fetch from the remote before every change.
+
+The time of the last successful sync of each clone is recorded so that
+a request can skip the sync if the clone is fresh enough. A push that is
+rejected because the clone was behind falls back to an inline rebase, see
+GitRepository.push_with_rebase.
+"""
+import logging
+import os
+import threading
+import time
+
+from .repository import open_repository
+
+# Monotonic time of the last sync for each repository, keyed by real path
+_LAST_SYNC = dict()
+# One daemon per repository root
+_SYNC_DAEMONS = dict()
+_SYNC_LOCK = threading.Lock()
+
+
+def mark_synced(root):
+    """Record that the clone at root has just been synchronised with its remote"""
+    with _SYNC_LOCK:
+        _LAST_SYNC[os.path.realpath(root)] = time.monotonic()
+
+
+def sync_age(root):
+    """Return the number of seconds since the clone at root was last
+    synchronised, or None if it has never been synchronised by this process"""
+    with _SYNC_LOCK:
+        last_sync = _LAST_SYNC.get(os.path.realpath(root))
+    return None if last_sync is None else time.monotonic() - last_sync
+
+
+def sync_if_stale(git_repo, max_age):
+    """Synchronise git_repo with its remote unless it was synchronised less
+    than max_age seconds ago. The caller must hold git_repo.lock.
+      :returns True if a sync was performed
+    """
+    age = sync_age(git_repo.root)
+    if age is not None and age < max_age:
+        logging.getLogger(__name__).debug("Clone synced %.1fs ago, skipping sync", age)
+        return False
+    git_repo.sync_with_remote()
+    mark_synced(git_repo.root)
+    return True
+
+
+def start_sync_daemon(root, interval):
+    """Start a RemoteSyncDaemon for the repository at root if one is not
+    already running and return it"""
+    key = os.path.realpath(root)
+    with _SYNC_LOCK:
+        daemon = _SYNC_DAEMONS.get(key)
+        if daemon is None or not daemon.is_alive():
+            daemon = RemoteSyncDaemon(open_repository(root), interval)
+            _SYNC_DAEMONS[key] = daemon
+            daemon.start()
+    return daemon
+
+
+# ------------------------------------------------------------------------------
+class RemoteSyncDaemon(threading.Thread):
+    """Synchronises a clone with its remote every interval seconds"""
+
+    def __init__(self, git_repo, interval):
+        super(RemoteSyncDaemon, self).__init__(name="sync-" + git_repo.root, daemon=True)
+        self.git_repo = git_repo
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def run(self):
+        log = logging.getLogger(__name__)
+        while not self._stopped.is_set():
+            try:
+                with self.git_repo.lock:
+                    self.git_repo.sync_with_remote()
+                    mark_synced(self.git_repo.root)
+            except Exception as exc:
+                log.warning("Background sync of '%s' failed: %s", self.git_repo.root, exc)
+            self._stopped.wait(self.interval)
+
+    def stop(self):
+        self._stopped.set()
@@ -0,0 +1,130 @@
+"""Opt-in tracing of individual requests.
+
+A traced request records a tree of spans: the handler, each stage of the
+update, each wait for the repository lock and every git command with its
+arguments, duration and, if it failed, its output. Requests are traced with
+the probability given by SCRIPT_REPOSITORY_TRACE_SAMPLE. Once a traced
+request has finished its trace is kept if it was slow or failed, in a ring
+buffer holding the most recent TRACE_BUFFER_SIZE traces of the process.
+
+The current span is held in a context variable so it follows the request
+into worker threads started with asyncio.to_thread. When a request is not
+traced the only cost of a span is reading that variable.
+"""
+from collections import deque
+from contextlib import contextmanager
+import contextvars
+import os
+import random
+import threading
+import time
+
+# Number of slow or failed traces kept by each process
+TRACE_BUFFER_SIZE = 50
+# A traced request taking at least this many seconds is kept
+DEFAULT_SLOW_SECS = 1.0
+# Longest error message recorded against a span
+MAX_ERROR_CHARS = 4000
+
+_CURRENT = contextvars.ContextVar('scriptrepository_trace_span', default=None)
+
+_TRACES = deque(maxlen=TRACE_BUFFER_SIZE)
+_TRACES_LOCK = threading.Lock()
+
+
+def begin(name, sample_rate, **attrs):
+    """Start tracing the current request with probability sample_rate.
+    Returns the root Span, named after the handler, to be passed to end or
+    None if the request is not traced"""
+    if not sample_rate or random.random() >= sample_rate:
+        return None
+    root = Span(name, attrs)
+    _CURRENT.set(root)
+    return root
+
+
+def end(root, status, slow_secs=DEFAULT_SLOW_SECS):
+    """Finish the trace started by begin. It is kept if the request took at
+    least slow_secs or its status code is a server error"""
+    if root is None:
+        return
+    root.finish()
+    # Possibly from another thread than begin, so the context is not reset
+    _CURRENT.set(None)
+    root.attrs['status'] = status
+    if root.duration >= slow_secs or status >= 500:
+        with _TRACES_LOCK:
+            _TRACES.append(root)
+
+
+@contextmanager
+def span(name, **attrs):
+    """Record the block as a child of the current span, if there is one"""
+    parent = _CURRENT.get()
+    if parent is None:
+        yield None
+        return
+    child = Span(name, attrs, parent.origin)
+    parent.children.append(child)
+    token = _CURRENT.set(child)
+    try:
+        yield child
+    except BaseException as exc:
+        child.error = _describe(exc)
+        raise
+    finally:
+        child.finish()
+        _CURRENT.reset(token)
+
+
+def recent():
+    """Return the kept traces of this process as dictionaries, newest first"""
+    with _TRACES_LOCK:
+        traces = list(_TRACES)
+    return [root.as_dict() for root in reversed(traces)]
+
+
+def clear():
+    with _TRACES_LOCK:
+        _TRACES.clear()
+
+
+# ------------------------------------------------------------------------------
+class Span(object):
+    """A timed operation with the operations it performed as children"""
+
+    def __init__(self, name, attrs, origin=None):
+        self.name = name
+        self.attrs = attrs
+        self.start = time.monotonic()
+        # The start of the trace, that every offset is measured from
+        self.origin = origin if origin is not None else self.start
+        self.is_root = origin is None
+        self.wall_time = time.time()
+        self.pid = os.getpid()
+        self.duration = None
+        self.error = None
+        self.children = []
+
+    def finish(self):
+        self.duration = time.monotonic() - self.start
+
+    def as_dict(self):
+        span = dict(name=self.name, offset=round(self.start - self.origin, 6),
+                    duration=None if self.duration is None else round(self.duration, 6),
+                    children=[child.as_dict() for child in list(self.children)])
+        if self.attrs:
+            span['attrs'] = dict(self.attrs)
+        if self.error is not None:
+            span['error'] = self.error
+        if self.is_root:
+            span.update(pid=self.pid, time=self.wall_time)
+        return span
+
+
+def _describe(exc):
+    """Return the message of an exception, decoding the output of git"""
+    detail = exc.args[0] if len(exc.args) == 1 else exc
+    if isinstance(detail, bytes):
+        detail = detail.decode('utf-8', 'replace')
+    return '{0}: {1}'.format(type(exc).__name__, detail)[:MAX_ERROR_CHARS]
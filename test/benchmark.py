@@ -0,0 +1,314 @@
+"""Load test and benchmark for the upload server.
+
+A bare repository stands in for the central remote, as in test_server.py,
+and is filled with a realistic number of files and commits. The server's
+clone of it is then driven through the WSGI application by a number of
+concurrent clients sending a mix of uploads and removals.
+
+The latency percentiles, throughput and number of git subprocesses per
+request are printed and saved as JSON so that runs can be compared, e.g.
+
+    python test/benchmark.py --requests 200 --concurrency 8 --output before.json
+"""
+import argparse
+import datetime
+import io
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import subprocess as subp
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from scriptrepository_server import metrics
+from scriptrepository_server.app import application
+
+AUTHOR = 'Bench Marker'
+EMAIL = 'bench.marker@domain.com'
+BOUNDARY = 'benchboundary'
+FOLDERS = ('./', './muon', './diffraction', './reflectometry/tools', './sans/reduction')
+
+
+# ------------------------------------------------------------------------------
+# Repository setup
+# ------------------------------------------------------------------------------
+def setup_repositories(workdir, nfiles, ncommits, bare_clone):
+    """Create a bare remote holding nfiles spread across ncommits and a clone
+    of it for the server. Returns the path of the clone."""
+    remote = os.path.join(workdir, 'remote.git')
+    seed = os.path.join(workdir, 'seed')
+    clone = os.path.join(workdir, 'clone')
+    _git(workdir, 'init', '--bare', '-b', 'master', remote)
+    _git(workdir, 'clone', remote, seed)
+    per_commit = max(1, nfiles // max(1, ncommits))
+    for commit in range(max(1, ncommits)):
+        for index in range(commit * per_commit, min(nfiles, (commit + 1) * per_commit)):
+            path = os.path.join(seed, FOLDERS[index % len(FOLDERS)], 'seed{0}.py'.format(index))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as script:
+                script.write(_script_content(index))
+        _git(seed, 'add', '-A')
+        _git(seed, '-c', 'user.name=Seeder', '-c', 'user.email=seeder@domain.com',
+             'commit', '-q', '--allow-empty', '-m', 'Seed commit {0}'.format(commit))
+    _git(seed, 'push', '-q', 'origin', 'master')
+    shutil.rmtree(seed)
+    if bare_clone:
+        _git(workdir, 'clone', '-q', '--bare', remote, clone)
+    else:
+        _git(workdir, 'clone', '-q', '-b', 'master', remote, clone)
+    return clone
+
+
+def _git(cwd, *args):
+    subp.check_output(['git'] + list(args), cwd=cwd, stderr=subp.STDOUT)
+
+
+def _script_content(seed):
+    return '# Generated for the benchmark\ndef run():\n    return {0}\n'.format(seed) * 20
+
+
+# ------------------------------------------------------------------------------
+# Load generation
+# ------------------------------------------------------------------------------
+class Workload(object):
+    """Hands out requests to the clients: removals of files uploaded earlier in
+    the run, in the given proportion, and otherwise uploads of new or changed
+    files"""
+
+    def __init__(self, nrequests, remove_ratio, seed):
+        self.remaining = nrequests
+        self.remove_ratio = remove_ratio
+        self.random = random.Random(seed)
+        self.uploaded = []
+        self.next_index = 0
+        self._lock = threading.Lock()
+
+    def next(self):
+        """Return (kind, payload) or None when the run is over. The payload of an
+        upload is (fields, filename, content) and of a removal its fields"""
+        with self._lock:
+            if self.remaining == 0:
+                return None
+            self.remaining -= 1
+            fields = dict(author=AUTHOR, mail=EMAIL)
+            if self.uploaded and self.random.random() < self.remove_ratio:
+                path = self.uploaded.pop(self.random.randrange(len(self.uploaded)))
+                fields.update(comment='Removed file', file_n=path)
+                return 'remove', fields
+            index = self.next_index
+            self.next_index += 1
+            folder = FOLDERS[index % len(FOLDERS)]
+            fields.update(comment='Benchmark upload {0}'.format(index), path=folder)
+            filename = 'bench{0}.py'.format(index)
+            return 'upload', (fields, filename, _script_content(index + 1000000))
+
+    def uploaded_ok(self, fields, filename):
+        with self._lock:
+            self.uploaded.append(os.path.normpath(os.path.join(fields['path'], filename)))
+
+
+def multipart_body(fields, filename=None, content=None):
+    parts = []
+    for name, value in fields.items():
+        parts.append('--{0}\r\nContent-Disposition: form-data; name="{1}"'
+                     '\r\n\r\n{2}\r\n'.format(BOUNDARY, name, value).encode('utf-8'))
+    if filename is not None:
+        parts.append('--{0}\r\nContent-Disposition: form-data; name="file"; '
+                     'filename="{1}"\r\n\r\n'.format(BOUNDARY, filename).encode('utf-8') +
+                     content.encode('utf-8') + b'\r\n')
+    parts.append('--{0}--\r\n'.format(BOUNDARY).encode('utf-8'))
+    return b''.join(parts)
+
+
+def send(settings, body):
+    """POST body to the application and return the status code"""
+    environ = dict(settings)
+    environ.update({'REQUEST_METHOD': 'POST', 'QUERY_STRING': '',
+                    'CONTENT_TYPE': 'multipart/form-data; boundary=' + BOUNDARY,
+                    'CONTENT_LENGTH': str(len(body)),
+                    'wsgi.input': io.BytesIO(body), 'wsgi.errors': sys.stderr})
+    status = []
+    application(environ, lambda code, headers: status.append(code))
+    return int(status[0].split()[0])
+
+
+def client(settings, workload, results):
+    while True:
+        request = workload.next()
+        if request is None:
+            return
+        kind, payload = request
+        if kind == 'upload':
+            fields, filename, content = payload
+            body = multipart_body(fields, filename, content)
+        else:
+            body = multipart_body(payload)
+        start = time.monotonic()
+        code = send(settings, body)
+        results.append((kind, code, time.monotonic() - start))
+        if kind == 'upload' and code == 200:
+            workload.uploaded_ok(fields, filename)
+
+
+# ------------------------------------------------------------------------------
+# Reporting
+# ------------------------------------------------------------------------------
+def percentile(values, fraction):
+    """Nearest-rank percentile of values"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, int(math.ceil(fraction * len(ordered))))
+    return ordered[rank - 1]
+
+
+def latency_summary(latencies):
+    return dict(count=len(latencies),
+                p50=percentile(latencies, 0.50), p95=percentile(latencies, 0.95),
+                p99=percentile(latencies, 0.99),
+                mean=sum(latencies) / len(latencies) if latencies else None,
+                max=max(latencies) if latencies else None)
+
+
+def git_command_counts(before, after):
+    """Return the number of each git subcommand run between two snapshots"""
+    counts = dict()
+    for key, histogram in after['histograms'].items():
+        name, _, label = key.partition('\t')
+        if name != 'scriptrepository_git_seconds':
+            continue
+        previous = before['histograms'].get(key, dict(count=0))['count']
+        if histogram['count'] > previous:
+            counts[label.partition('=')[2]] = histogram['count'] - previous
+    return counts
+
+
+def stage_seconds(before, after):
+    totals = dict()
+    for key, histogram in after['histograms'].items():
+        name, _, label = key.partition('\t')
+        if name != 'scriptrepository_stage_seconds':
+            continue
+        previous = before['histograms'].get(key, dict(sum=0.0))['sum']
+        totals[label.partition('=')[2]] = histogram['sum'] - previous
+    return totals
+
+
+def run(args):
+    workdir = args.workdir or tempfile.mkdtemp(prefix='scriptrepository-bench-')
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        print("Creating remote with {0} files in {1} commits under {2}".format(
+            args.files, args.commits, workdir))
+        clone = setup_repositories(workdir, args.files, args.commits, args.bare)
+        settings = {'SCRIPT_REPOSITORY_PATH': clone,
+                    'SCRIPT_REPOSITORY_METRICS_DIR': os.path.join(workdir, 'metrics'),
+                    'SCRIPT_REPOSITORY_JOBS_DIR': os.path.join(workdir, 'jobs'),
+                    'SCRIPT_REPOSITORY_SPOOL_DIR': workdir}
+        for name in ('GROUP_COMMIT_WINDOW', 'SYNC_MAX_AGE', 'LOCK_TIMEOUT'):
+            value = getattr(args, name.lower())
+            if value is not None:
+                settings['SCRIPT_REPOSITORY_' + name] = str(value)
+
+        workload = Workload(args.requests, args.remove_ratio, args.seed)
+        results = []
+        before = metrics.registry().snapshot()
+        start = time.monotonic()
+        clients = [threading.Thread(target=client, args=(settings, workload, results))
+                   for _ in range(args.concurrency)]
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+        elapsed = time.monotonic() - start
+        after = metrics.registry().snapshot()
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    statuses = dict()
+    for _, code, _ in results:
+        statuses[str(code)] = statuses.get(str(code), 0) + 1
+    succeeded = [result for result in results if result[1] == 200]
+    git_counts = git_command_counts(before, after)
+    report = dict(
+        date=datetime.datetime.utcnow().isoformat() + 'Z',
+        config=dict(files=args.files, commits=args.commits, requests=args.requests,
+                    concurrency=args.concurrency, remove_ratio=args.remove_ratio,
+                    bare=args.bare, group_commit_window=args.group_commit_window,
+                    sync_max_age=args.sync_max_age, lock_timeout=args.lock_timeout,
+                    seed=args.seed),
+        environment=dict(python=platform.python_version(), platform=platform.platform(),
+                         git=subp.check_output(['git', '--version']).decode().strip()),
+        elapsed_seconds=elapsed,
+        statuses=statuses,
+        requests_per_second=len(succeeded) / elapsed if elapsed else None,
+        uploads_per_second=len([r for r in succeeded if r[0] == 'upload']) / elapsed
+        if elapsed else None,
+        latency=dict(all=latency_summary([r[2] for r in results]),
+                     upload=latency_summary([r[2] for r in results if r[0] == 'upload']),
+                     remove=latency_summary([r[2] for r in results if r[0] == 'remove'])),
+        git_commands=git_counts,
+        git_commands_per_request=sum(git_counts.values()) / len(results) if results else None,
+        stage_seconds=stage_seconds(before, after))
+    return report
+
+
+def print_report(report):
+    print("{0} requests in {1:.2f}s, statuses {2}".format(
+        sum(report['statuses'].values()), report['elapsed_seconds'], report['statuses']))
+    print("  {0:.2f} requests/s, {1:.2f} uploads/s".format(report['requests_per_second'] or 0,
+                                                        report['uploads_per_second'] or 0))
+    for kind, summary in report['latency'].items():
+        if summary['count']:
+            print("  {0:<7} p50 {1:.3f}s  p95 {2:.3f}s  p99 {3:.3f}s  ({4} requests)".format(
+                kind, summary['p50'], summary['p95'], summary['p99'], summary['count']))
+    print("  {0:.1f} git commands per request: {1}".format(
+        report['git_commands_per_request'] or 0,
+        ', '.join('{0}={1}'.format(cmd, count)
+                  for cmd, count in sorted(report['git_commands'].items()))))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=500,
+                        help='number of files in the remote before the run')
+    parser.add_argument('--commits', type=int, default=50,
+                        help='number of commits the files are spread across')
+    parser.add_argument('--requests', type=int, default=100,
+                        help='total number of requests to send')
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='number of clients sending requests at once')
+    parser.add_argument('--remove-ratio', type=float, default=0.2,
+                        help='fraction of requests that remove an earlier upload')
+    parser.add_argument('--bare', action='store_true',
+                        help='give the server a bare clone')
+    parser.add_argument('--group-commit-window', type=float,
+                        help='enable group commits with this window in seconds')
+    parser.add_argument('--sync-max-age', type=float,
+                        help='skip syncs of a clone younger than this many seconds')
+    parser.add_argument('--lock-timeout', type=float,
+                        help='refuse requests waiting longer than this for the lock')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the request mix')
+    parser.add_argument('--workdir', help='directory for the repositories, '
+                                          'a temporary directory by default')
+    parser.add_argument('--keep', action='store_true', help='keep the repositories')
+    parser.add_argument('--output', help='file to save the results to as JSON')
+    args = parser.parse_args(argv)
+
+    report = run(args)
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+        print("Results saved to {0}".format(args.output))
+
+
+if __name__ == "__main__":
+    main()
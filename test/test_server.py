@@ -1,17 +1,36 @@
+import asyncio
 import datetime
+import fcntl
+import gzip
+import hashlib
+import io
 import json
 import logging
 import os
 import shutil
 import subprocess as subp
 import sys
+import tarfile
 import tempfile
+import threading
+import time
 import unittest
+import unittest.mock
 from webtest import TestApp
 
 # Our application
 sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
-from scriptrepository_server.app import application, initialise_logging
+from scriptrepository_server.app import application, create_application, initialise_logging
+from scriptrepository_server import asgi, logs, metrics, tracing
+from scriptrepository_server.admission import get_admission_controller
+from scriptrepository_server.base import MAX_BULK_FILES
+from scriptrepository_server.errors import InternalServerError
+from scriptrepository_server.groupcommit import GroupCommitter
+from scriptrepository_server.idempotency import IdempotencyStore
+from scriptrepository_server.jobs import QUEUED, Job, JobStore
+from scriptrepository_server.maintenance import maintain_if_due
+from scriptrepository_server.ownership import OwnershipIndex
+from scriptrepository_server.repository import GitCommitInfo, GitRepository, open_repository
 
 # Local server
 TEST_APP = None
@@ -219,6 +238,917 @@ class ScriptUploadServerTest(unittest.TestCase):
             remote_content = remote_file_handle.read()
         self.assertEqual(SCRIPT_CONTENT, remote_content)
 
+    def test_spooled_upload_is_moved_into_place_keeping_file_mode(self):
+        # Commit an executable script
+        repo_file = os.path.join(TEMP_GIT_REPO_PATH, "muon", "userscript.py")
+        os.mkdir(os.path.dirname(repo_file))
+        with open(repo_file, 'w') as userscript:
+            userscript.write("foo")
+        os.chmod(repo_file, 0o755)
+        author = 'Joe Bloggs'
+        mail = 'first.last@domain.com'
+        subp.check_output(f'cd {TEMP_GIT_REPO_PATH}; git add .; '
+                          f'git -c user.name="{author}" -c user.email={mail} commit -m"Added new file"; '
+                          f'git push origin master', stderr=subp.STDOUT, shell=True)
+
+        spool_dir = tempfile.mkdtemp()
+        extra_environ = {"SCRIPT_REPOSITORY_PATH": TEMP_GIT_REPO_PATH,
+                         "SCRIPT_REPOSITORY_SPOOL_DIR": spool_dir}
+        data = dict(author=author, mail=mail, comment='Updated file', path='./muon')
+        content = SCRIPT_CONTENT * 10000
+        response = TEST_APP.post('/', extra_environ=extra_environ, params=data,
+                                 upload_files=[("file", "userscript.py", content.encode('utf-8'))],
+                                 status='*')
+
+        self.assertEqual('200 OK', response.status)
+        # The spooled file was moved rather than copied out of the spool
+        self.assertEqual([], os.listdir(spool_dir))
+        shutil.rmtree(spool_dir)
+        with open(repo_file, 'r') as repo_file_handle:
+            self.assertEqual(content, repo_file_handle.read())
+        self.assertEqual(0o755, os.stat(repo_file).st_mode & 0o777)
+        tree = subp.check_output(f"git -C {TEMP_GIT_REMOTE_PATH} ls-tree master muon/userscript.py",
+                                 stderr=subp.STDOUT, shell=True)
+        self.assertTrue(str(tree, encoding='utf-8').startswith('100755 blob'))
+
+    def test_upload_identical_to_committed_file_succeeds_without_commit(self):
+        extra_environ = {"SCRIPT_REPOSITORY_PATH": TEMP_GIT_REPO_PATH}
+        data = dict(author='Joe Bloggs', mail='first.last@domain.com', comment='Added new file', path='./muon')
+        responses = []
+        for _ in range(2):
+            responses.append(TEST_APP.post('/', extra_environ=extra_environ, params=data,
+                                           upload_files=[("file", "userscript.py",
+                                                          SCRIPT_CONTENT.encode('utf-8'))],
+                                           status='*'))
+
+        self.assertEqual('200 OK', responses[1].status)
+        first_pub_date = json.loads(responses[0].body.decode('utf-8'))['pub_date']
+        self.check_replied_content(expected_json=dict(message='success', detail='',
+                                                      pub_date=first_pub_date, shell=''),
+                                   actual_str=responses[1].body)
+        # Only the first upload was committed
+        ncommits = subp.check_output(f"git -C {TEMP_GIT_REMOTE_PATH} rev-list --count master",
+                                     stderr=subp.STDOUT, shell=True)
+        self.assertEqual(2, int(ncommits))
+
+        # The check is answered from the manifest without running git
+        blob = subp.check_output(f"git -C {TEMP_GIT_REPO_PATH} rev-parse HEAD:muon/userscript.py",
+                                 stderr=subp.STDOUT, shell=True)
+        repo_file = os.path.join(TEMP_GIT_REPO_PATH, "muon", "userscript.py")
+        with unittest.mock.patch('scriptrepository_server.repository._git',
+                                 side_effect=AssertionError):
+            git_repo = open_repository(TEMP_GIT_REPO_PATH)
+            self.assertEqual(first_pub_date, git_repo.published_date_if_unchanged(
+                repo_file, str(blob.rstrip(), encoding='utf-8')))
+            self.assertIsNone(git_repo.published_date_if_unchanged(repo_file, '0' * 40))
+
+    def test_retry_with_idempotency_key_replays_response_without_git_work(self):
+        idempotency_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, idempotency_dir)
+        extra_environ = {"SCRIPT_REPOSITORY_PATH": TEMP_GIT_REPO_PATH,
+                         "SCRIPT_REPOSITORY_IDEMPOTENCY_DIR": idempotency_dir}
+        data = dict(author='Joe Bloggs', mail='first.last@domain.com', comment='Added new file', path='./')
+
+        def post(comment):
+            return TEST_APP.post('/', extra_environ=extra_environ,
+                                 params=dict(data, comment=comment),
+                                 headers={'Idempotency-Key': 'upload-1'},
+                                 upload_files=[("file", "userscript.py",
+                                                SCRIPT_CONTENT.encode('utf-8'))],
+                                 status='*')
+
+        first = post('Added new file')
+        self.assertEqual('200 OK', first.status)
+        with unittest.mock.patch('scriptrepository_server.app.update_central_repo') as update:
+            retry = post('Added new file')
+            update.assert_not_called()
+        self.assertEqual('200 OK', retry.status)
+        self.assertEqual(first.body, retry.body)
+        self.assertEqual('true', retry.headers['Idempotent-Replayed'])
+        # The key cannot be reused for a different change
+        reused = post('Another comment')
+        self.assertEqual('400 Bad Request', reused.status)
+        self.assertEqual('Idempotency key reused.', json.loads(reused.body)['message'])
+
+    def test_expiring_idempotency_keys_keeps_key_files_that_are_held(self):
+        idempotency_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, idempotency_dir)
+        store = IdempotencyStore(idempotency_dir)
+        claim = store.acquire('upload-1', 'repo', 'fingerprint')
+        old_response = os.path.join(idempotency_dir, 'old.json')
+        with open(old_response, 'w') as stored_file:
+            stored_file.write('{}')
+        lock_filename = os.path.join(idempotency_dir, claim.name + '.lock')
+        long_ago = time.time() - 7200
+        for filename in (old_response, lock_filename):
+            os.utime(filename, (long_ago, long_ago))
+
+        store.expire(max_age=3600)
+        self.assertFalse(os.path.exists(old_response))
+        self.assertTrue(os.path.exists(lock_filename))
+        claim.release()
+        store.expire(max_age=3600)
+        self.assertFalse(os.path.exists(lock_filename))
+        # The key can still be claimed
+        claim = store.acquire('upload-1', 'repo', 'fingerprint')
+        self.assertIsNone(claim.response)
+        self.assertTrue(os.path.exists(lock_filename))
+        claim.release()
+
+    def test_resumable_upload_of_large_file_in_chunks_is_committed(self):
+        uploads_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, uploads_dir)
+        extra_environ = {"SCRIPT_REPOSITORY_PATH": TEMP_GIT_REPO_PATH,
+                         "SCRIPT_REPOSITORY_UPLOADS_DIR": uploads_dir}
+        content = (SCRIPT_CONTENT * 40000).encode('utf-8')[:1536*1024]
+        data = dict(author='Joe Bloggs', mail='first.last@domain.com', comment='Added large file',
+                    path='./muon', filename='large.py', size=str(len(content)))
+        started = TEST_APP.post('/?upload=start', extra_environ=extra_environ, params=data,
+                                status='*')
+        self.assertEqual('201 Created', started.status)
+        upload_id = json.loads(started.body)['upload']
+
+        def put(offset, chunk, sha1=None):
+            return TEST_APP.put(f'/?upload={upload_id}&offset={offset}', params=chunk,
+                                extra_environ=extra_environ, status='*',
+                                headers={'Chunk-SHA1': sha1 or hashlib.sha1(chunk).hexdigest(),
+                                         'Content-Type': 'application/octet-stream'})
+
+        # An upload abandoned long ago is cleared out when a chunk arrives
+        abandoned = [os.path.join(uploads_dir, 'abandoned' + ext) for ext in ('.part', '.json')]
+        long_ago = time.time() - 2 * 24 * 60 * 60
+        for filename in abandoned:
+            open(filename, 'w').close()
+            os.utime(filename, (long_ago, long_ago))
+
+        first, second = content[:1024*1024], content[1024*1024:]
+        self.assertEqual('200 OK', put(0, first).status)
+        self.assertFalse(any(os.path.exists(filename) for filename in abandoned))
+        # A chunk must start where the last ended and match its hash
+        self.assertEqual('409 Conflict', put(0, second).status)
+        self.assertEqual('400 Bad Request', put(len(first), second, sha1='0' * 40).status)
+        status = TEST_APP.get(f'/?upload={upload_id}', extra_environ=extra_environ)
+        self.assertEqual(len(first), json.loads(status.body)['offset'])
+        self.assertEqual('200 OK', put(len(first), second).status)
+
+        response = TEST_APP.post(f'/?upload={upload_id}', extra_environ=extra_environ,
+                                 status='*')
+        self.assertEqual('200 OK', response.status)
+        self.assertEqual('success', json.loads(response.body)['message'])
+        with open(os.path.join(TEMP_GIT_REPO_PATH, 'muon', 'large.py'), 'rb') as committed:
+            self.assertEqual(content, committed.read())
+        # The upload is gone once committed
+        self.assertEqual([], os.listdir(uploads_dir))
+        self.assertEqual('404 Not Found',
+                         TEST_APP.get(f'/?upload={upload_id}', extra_environ=extra_environ,
+                                      status='*').status)
+
+    def test_gzip_request_body_is_accepted_and_bomb_is_refused(self):
+        extra_environ = {"SCRIPT_REPOSITORY_PATH": TEMP_GIT_REPO_PATH}
+        fields = dict(author='Joe Bloggs', mail='first.last@domain.com', comment='Added new file',
+                      path='./')
+        headers = {'Content-Type': 'multipart/form-data; boundary=testboundary',
+                   'Content-Encoding': 'gzip'}
+        body = gzip.compress(self._multipart_body(fields, 'userscript.py',
+                                                  SCRIPT_CONTENT.encode('utf-8')))
+        response = TEST_APP.post('/', body, headers=headers, extra_environ=extra_environ,
+                                 status='*')
+        self.assertEqual('200 OK', response.status)
+        with open(os.path.join(TEMP_GIT_REPO_PATH, "userscript.py"), 'r') as userscript:
+            self.assertEqual(SCRIPT_CONTENT, userscript.read())
+
+        # 64MB of zeros compresses to well under the limit on the request size
+        bomb = gzip.compress(self._multipart_body(fields, 'bomb.py', bytes(64*1024*1024)))
+        self.assertLess(len(bomb), 1024*1024)
+        response = TEST_APP.post('/', bomb, headers=headers, extra_environ=extra_environ,
+                                 status='*')
+        self.assertEqual('400 Bad Request', response.status)
+        self.assertEqual('File is too large.', json.loads(response.body)['message'])
+        self.assertFalse(os.path.exists(os.path.join(TEMP_GIT_REPO_PATH, "bomb.py")))
+
+        # Responses are compressed for clients that ask. TestApp would decode them
+        environ = {"REQUEST_METHOD": "GET", "QUERY_STRING": "metrics=1",
+                   "HTTP_ACCEPT_ENCODING": "deflate, gzip;q=0.5", "wsgi.errors": sys.stderr}
+        headers = []
+        body = application(environ, lambda status, response_headers: headers.extend(response_headers))
+        self.assertIn(('Content-Encoding', 'gzip'), headers)
+        self.assertIn(b'scriptrepository_requests_total', gzip.decompress(body[0]))
+
+    def test_log_records_are_written_as_json_by_background_thread_with_request_id(self):
+        stream = io.StringIO()
+        pipeline = logs.LogPipeline(stream, 'json', logs.parse_sample_rates('debug=0'))
+        log = logging.getLogger('scriptrepository_unittest_logs')
+        log.propagate = False
+        log.setLevel(logging.DEBUG)
+        log.addHandler(pipeline.handler)
+        self.addCleanup(log.removeHandler, pipeline.handler)
+        request_id, token = logs.begin_request('abc-123')
+        try:
+            log.info("Wrote %s bytes", 42)
+            log.debug("Sampled out %s", object())
+        finally:
+            logs.end_request(token)
+        pipeline.stop()
+
+        records = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual(1, len(records))
+        self.assertEqual('Wrote 42 bytes', records[0]['message'])
+        self.assertEqual('abc-123', records[0]['request_id'])
+        self.assertEqual('INFO', records[0]['level'])
+        # The request ID is returned to the client
+        response = TEST_APP.get('/?manifest=1', headers={'X-Request-ID': 'abc-123'},
+                                extra_environ={"SCRIPT_REPOSITORY_PATH": TEMP_GIT_REPO_PATH})
+        self.assertEqual('abc-123', response.headers['X-Request-ID'])
+
+    def test_bulk_upload_of_several_files_produces_single_commit(self):
+        extra_environ = {"SCRIPT_REPOSITORY_PATH": TEMP_GIT_REPO_PATH}
+        data = dict(author='Joe Bloggs', mail='first.last@domain.com', comment='Added package', path='./muon')
+        files = [("file", "script{}.py".format(i), SCRIPT_CONTENT.encode('utf-8')) for i in range(3)]
+        response = TEST_APP.post('/', extra_environ=extra_environ, params=data,
+                                 upload_files=files, status='*')
+
+        self.assertEqual('200 OK', response.status)
+        body = json.loads(response.body.decode('utf-8'))
+        self.assertEqual('success', body['message'])
+        self.assertEqual(['muon/script0.py', 'muon/script1.py', 'muon/script2.py'],
+                         [result['path'] for result in body['files']])
+        self.assertEqual(['committed'] * 3, [result['status'] for result in body['files']])
+        ncommits = subp.check_output(f"git -C {TEMP_GIT_REMOTE_PATH} rev-list --count master",
+                                     stderr=subp.STDOUT, shell=True)
+        self.assertEqual(2, int(ncommits))
+
+    def test_bulk_upload_of_too_many_files_is_refused_while_parsing(self):
+        spool_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spool_dir)
+        extra_environ = {"SCRIPT_REPOSITORY_PATH": TEMP_GIT_REPO_PATH,
+                         "SCRIPT_REPOSITORY_SPOOL_DIR": spool_dir}
+        fields = dict(author='Joe Bloggs', mail='first.last@domain.com', comment='Added package',
+                      path='./muon')
+        body = self._multipart_body(fields, 'script.py', b'')
+        part = body[body.index(b'--testboundary\r\nContent-Disposition: form-data; name="file"'):
+                    body.index(b'--testboundary--')]
+        body = body.replace(part, part * 1000)
+        headers = {'Content-Type': 'multipart/form-data; boundary=testboundary'}
+        # Parsing stops before a file is spooled for every part
+        with unittest.mock.patch('tempfile.mkstemp', wraps=tempfile.mkstemp) as spooled:
+            response = TEST_APP.post('/', body, headers=headers, extra_environ=extra_environ,
+                                     status='*')
+        self.assertEqual(MAX_BULK_FILES, spooled.call_count)
+        self.assertEqual('400 Bad Request', response.status)
+        self.assertEqual('Too many files.', json.loads(response.body)['message'])
+        self.assertEqual([], os.listdir(spool_dir))
+
+    def test_bulk_upload_of_archive_keeps_folders_and_rejects_traversal(self):
+        extra_environ = {"SCRIPT_REPOSITORY_PATH": TEMP_GIT_REPO_PATH}
+        data = dict(author='Joe Bloggs', mail='first.last@domain.com', comment='Added package', path='./muon')
+
+        def tar_of(*names):
+            archive = io.BytesIO()
+            with tarfile.open(fileobj=archive, mode='w:gz') as tar:
+                for name in names:
+                    content = SCRIPT_CONTENT.encode('utf-8')
+                    info = tarfile.TarInfo(name)
+                    info.size = len(content)
+                    tar.addfile(info, io.BytesIO(content))
+            return archive.getvalue()
+
+        response = TEST_APP.post('/', extra_environ=extra_environ, params=data,
+                                 upload_files=[("archive", "package.tar.gz",
+                                                tar_of("../outside.py"))],
+                                 status='*')
+        self.assertEqual('400 Bad Request', response.status)
+        self.assertEqual('Invalid archive.', json.loads(response.body.decode('utf-8'))['message'])
+
+        response = TEST_APP.post('/', extra_environ=extra_environ, params=data,
+                                 upload_files=[("archive", "package.tar.gz",
+                                                tar_of("package/a.py", "package/sub/b.py"))],
+                                 status='*')
+        self.assertEqual('200 OK', response.status)
+        body = json.loads(response.body.decode('utf-8'))
+        self.assertEqual(['muon/package/a.py', 'muon/package/sub/b.py'],
+                         [result['path'] for result in body['files']])
+        self.assertTrue(os.path.exists(os.path.join(TEMP_GIT_REPO_PATH, "muon", "package",
+                                                    "sub", "b.py")))
+        self.assertFalse(os.path.exists(os.path.join(TEMP_GIT_REPO_PATH, "outside.py")))
+
+    def test_concurrent_uploads_with_group_commit_produce_single_commit(self):
+        extra_environ = {"SCRIPT_REPOSITORY_PATH": TEMP_GIT_REPO_PATH,
+                         "SCRIPT_REPOSITORY_GROUP_COMMIT_WINDOW": "0.5"}
+        nuploads = 5
+        responses = [None] * nuploads
+
+        def upload(index):
+            data = dict(author='Joe Bloggs', mail='first.last@domain.com',
+                        comment='Added file {}'.format(index), path='./muon')
+            responses[index] = TEST_APP.post('/', extra_environ=extra_environ, params=data,
+                                             upload_files=[("file", "script{}.py".format(index),
+                                                            SCRIPT_CONTENT.encode('utf-8'))],
+                                             status='*')
+
+        threads = [threading.Thread(target=upload, args=(i,)) for i in range(nuploads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for response in responses:
+            self.check_replied_content(expected_json=dict(message='success', detail='',
+                                                          pub_date=self._now_as_str(), shell=''),
+                                       actual_str=response.body)
+        # A single commit on top of the initial one
+        ncommits = subp.check_output(f"git -C {TEMP_GIT_REMOTE_PATH} rev-list --count master",
+                                     stderr=subp.STDOUT, shell=True)
+        self.assertEqual(2, int(ncommits))
+        for i in range(nuploads):
+            self.assertTrue(os.path.exists(os.path.join(TEMP_GIT_REPO_PATH, "muon",
+                                                        "script{}.py".format(i))))
+
+    def test_group_commit_holds_back_second_change_to_same_path(self):
+        extra_environ = {"SCRIPT_REPOSITORY_PATH": TEMP_GIT_REPO_PATH,
+                         "SCRIPT_REPOSITORY_GROUP_COMMIT_WINDOW": "1"}
+        uploads = [('Alice', 'alice@domain.com', 'x.py'), ('Carol', 'carol@domain.com', 'y.py'),
+                   ('Alice', 'alice@domain.com', 'x.py')]
+        responses = [None] * len(uploads)
+
+        def upload(index):
+            author, mail, filename = uploads[index]
+            data = dict(author=author, mail=mail, comment='Added file', path='./')
+            responses[index] = TEST_APP.post('/', extra_environ=extra_environ, params=data,
+                                             upload_files=[("file", filename,
+                                                            SCRIPT_CONTENT.encode('utf-8'))],
+                                             status='*')
+
+        threads = []
+        for index in range(len(uploads)):
+            threads.append(threading.Thread(target=upload, args=(index,)))
+            threads[-1].start()
+            # Keep the order of arrival within the window
+            time.sleep(0.1)
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(['200 OK'] * 3, [response.status for response in responses])
+        # The repeated upload is found to be unchanged in the next batch
+        authors = subp.check_output(f"git -C {TEMP_GIT_REMOTE_PATH} log --format=%an master",
+                                    stderr=subp.STDOUT, shell=True)
+        self.assertEqual(['Carol', 'Alice', GIT_USERNAME], authors.decode('utf-8').split())
+
+    def test_group_commit_fails_queued_changes_if_leader_cannot_take_lock(self):
+        git_repo = open_repository(TEMP_GIT_REPO_PATH)
+        unchanged = GitCommitInfo('Joe Bloggs', 'first.last@domain.com', 'Unchanged', [],
+                                  existing_dates={'userscript.py': '2020-Jan-01 00:00:00'})
+        committer = GroupCommitter(git_repo, 0, lambda *args: unchanged, 'mantid-publisher')
+        results = dict()
+
+        def submit(name):
+            try:
+                results[name] = committer.submit(unittest.mock.MagicMock(), io.StringIO())
+            except Exception as exc:
+                results[name] = exc
+
+        in_acquire, fail_acquire = threading.Event(), threading.Event()
+
+        def broken_acquire(timeout=None):
+            in_acquire.set()
+            fail_acquire.wait()
+            raise OSError("flock failed")
+
+        with unittest.mock.patch.object(git_repo.lock, 'acquire', side_effect=broken_acquire):
+            leader = threading.Thread(target=submit, args=('leader',))
+            leader.start()
+            in_acquire.wait()
+            follower = threading.Thread(target=submit, args=('follower',))
+            follower.start()
+            while not committer._queue[1:]:
+                time.sleep(0.01)
+            fail_acquire.set()
+            leader.join(10)
+            follower.join(10)
+        self.assertIsInstance(results['leader'], OSError)
+        self.assertIsInstance(results['follower'], InternalServerError)
+        # The next change leads a batch of its own
+        submit('next')
+        self.assertEqual('2020-Jan-01 00:00:00', results['next'])
+
+    def test_upload_to_stale_clone_rebases_when_push_is_rejected(self):
+        extra_environ = {"SCRIPT_REPOSITORY_PATH": TEMP_GIT_REPO_PATH,
+                         "SCRIPT_REPOSITORY_SYNC_MAX_AGE": "3600"}
+        data = dict(author='Joe Bloggs', mail='first.last@domain.com', comment='Added new file', path='./')
+        TEST_APP.post('/', extra_environ=extra_environ, params=data,
+                      upload_files=[("file", "first.py", SCRIPT_CONTENT.encode('utf-8'))])
+        # Another publisher moves the remote on behind our back
+        other_clone = tempfile.mkdtemp()
+        subp.check_output(f"git clone -b master {TEMP_GIT_REMOTE_PATH} {other_clone}; cd {other_clone}; "
+                          f"echo bar > other.py; git add other.py; "
+                          f"git -c user.name='{GIT_USERNAME}' -c user.email={GIT_EMAIL} commit -m'Other'; "
+                          f"git push origin HEAD:master", stderr=subp.STDOUT, shell=True)
+        shutil.rmtree(other_clone)
+
+        response = TEST_APP.post('/', extra_environ=extra_environ, params=data,
+                                 upload_files=[("file", "second.py", SCRIPT_CONTENT.encode('utf-8'))],
+                                 status='*')
+        self.check_replied_content(expected_json=dict(message='success', detail='',
+                                                      pub_date=self._now_as_str(), shell=''),
+                                   actual_str=response.body)
+        remote_files = subp.check_output(f"git -C {TEMP_GIT_REMOTE_PATH} ls-tree --name-only master",
+                                         stderr=subp.STDOUT, shell=True)
+        self.assertEqual(["README.md", "first.py", "other.py", "second.py"],
+                         str(remote_files, encoding='utf-8').split())
+
+    def test_push_rejected_repeatedly_is_retried_until_it_succeeds(self):
+        extra_environ = {"SCRIPT_REPOSITORY_PATH": TEMP_GIT_REPO_PATH}
+        push = GitRepository.push
+        rejections = []
+
+        def contended_push(repo, remote, branch):
+            # Another publisher gets in first twice
+            if len(rejections) < 2:
+                rejections.append(branch)
+                raise RuntimeError(b" ! [rejected]        master -> master (fetch first)")
+            return push(repo, remote, branch)
+
+        before = metrics.registry().snapshot()['counters']
+        data = dict(author='Joe Bloggs', mail='first.last@domain.com', comment='Added new file', path='./')
+        with unittest.mock.patch.object(GitRepository, 'push', contended_push):
+            response = TEST_APP.post('/', extra_environ=extra_environ, params=data,
+                                     upload_files=[("file", "userscript.py", SCRIPT_CONTENT.encode('utf-8'))])
+        self.assertEqual('200 OK', response.status)
+        after = metrics.registry().snapshot()['counters']
+        for key, increase in (("scriptrepository_push_retries_total", 2),
+                              ("scriptrepository_pushes_total\tattempts=3", 1)):
+            self.assertEqual(before.get(key, 0) + increase, after[key])
+        remote_files = subp.check_output(f"git -C {TEMP_GIT_REMOTE_PATH} ls-tree --name-only master",
+                                         stderr=subp.STDOUT, shell=True)
+        self.assertIn("userscript.py", str(remote_files, encoding='utf-8').split())
+
+    def test_many_concurrent_uploads_all_succeed(self):
+        extra_environ = {"SCRIPT_REPOSITORY_PATH": TEMP_GIT_REPO_PATH}
+        nuploads = 16
+        responses = [None] * nuploads
+        start_dir = os.getcwd()
+
+        def upload(index):
+            data = dict(author='Joe Bloggs', mail='first.last@domain.com',
+                        comment='Added file {}'.format(index), path='./muon')
+            responses[index] = TEST_APP.post('/', extra_environ=extra_environ, params=data,
+                                             upload_files=[("file", "script{}.py".format(index),
+                                                            SCRIPT_CONTENT.encode('utf-8'))],
+                                             status='*')
+
+        threads = [threading.Thread(target=upload, args=(i,)) for i in range(nuploads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(start_dir, os.getcwd())
+        self.assertEqual(['200 OK'] * nuploads, [response.status for response in responses])
+        ncommits = subp.check_output(f"git -C {TEMP_GIT_REMOTE_PATH} rev-list --count master",
+                                     stderr=subp.STDOUT, shell=True)
+        self.assertEqual(nuploads + 1, int(ncommits))
+        remote_files = subp.check_output(f"git -C {TEMP_GIT_REMOTE_PATH} ls-tree --name-only "
+                                         "master muon/", stderr=subp.STDOUT, shell=True)
+        self.assertEqual(sorted("muon/script{}.py".format(i) for i in range(nuploads)),
+                         sorted(str(remote_files, encoding='utf-8').split()))
+
+    def test_upload_and_remove_using_bare_clone(self):
+        bare_clone = tempfile.mkdtemp()
+        subp.check_output(f"git clone --bare {TEMP_GIT_REMOTE_PATH} {bare_clone}",
+                          stderr=subp.STDOUT, shell=True)
+        extra_environ = {"SCRIPT_REPOSITORY_PATH": bare_clone}
+        try:
+            data = dict(author='Joe Bloggs', mail='first.last@domain.com', comment='Added new file',
+                        path='./muon/nested')
+            response = TEST_APP.post('/', extra_environ=extra_environ, params=data,
+                                     upload_files=[("file", "userscript.py",
+                                                    SCRIPT_CONTENT.encode('utf-8'))],
+                                     status='*')
+            self.check_replied_content(expected_json=dict(message='success', detail='',
+                                                          pub_date=self._now_as_str(), shell=''),
+                                       actual_str=response.body)
+            content = subp.check_output(f"git -C {TEMP_GIT_REMOTE_PATH} show "
+                                        "master:muon/nested/userscript.py",
+                                        stderr=subp.STDOUT, shell=True)
+            self.assertEqual(SCRIPT_CONTENT, str(content, encoding='utf-8'))
+
+            data = dict(author='Jenny Bloggs', mail='j.b@testdomain.com', comment='Removed file',
+                        file_n='muon/nested/userscript.py')
+            response = TEST_APP.post('/', extra_environ=extra_environ, params=data, status='*')
+            self.assertEqual('400 Bad Request', response.status)
+
+            data.update(author='Joe Bloggs', mail='first.last@domain.com')
+            response = TEST_APP.post('/', extra_environ=extra_environ, params=data, status='*')
+            self.check_replied_content(expected_json=dict(message='success', detail='',
+                                                          pub_date='', shell=''),
+                                       actual_str=response.body)
+            remote_files = subp.check_output(f"git -C {TEMP_GIT_REMOTE_PATH} ls-tree -r "
+                                             "--name-only master", stderr=subp.STDOUT, shell=True)
+            self.assertEqual(["README.md"], str(remote_files, encoding='utf-8').split())
+        finally:
+            shutil.rmtree(bare_clone)
+
+    def test_native_object_writer_produces_same_commits_as_git(self):
+        remotes, clones = [TEMP_GIT_REMOTE_PATH, tempfile.mkdtemp()], [tempfile.mkdtemp(), tempfile.mkdtemp()]
+        self.addCleanup(shutil.rmtree, remotes[1])
+        for clone in clones:
+            self.addCleanup(shutil.rmtree, clone)
+        subp.check_output(f"git clone -q --bare {TEMP_GIT_REMOTE_PATH} {remotes[1]}", shell=True)
+        for remote, clone in zip(remotes, clones):
+            subp.check_output(f"git clone -q --bare {remote} {clone}", shell=True)
+        subp.check_output(f"git -C {clones[1]} config scriptrepository.nativeObjects true", shell=True)
+        subp.check_output(f"git -C {clones[1]} config core.logAllRefUpdates true", shell=True)
+        self.assertEqual('NativeGitRepository', type(open_repository(clones[1])).__name__)
+
+        changes = [(dict(author='Joe Bloggs', mail='first.last@domain.com', comment='Added new file',
+                         path='./muon/nested'), "userscript.py"),
+                   (dict(author='Joe Bloggs', mail='first.last@domain.com', comment='Added another',
+                         path='./'), "second.py"),
+                   (dict(author='Joe Bloggs', mail='first.last@domain.com', comment='Removed file',
+                         file_n='muon/nested/userscript.py'), None)]
+        dates = {"GIT_AUTHOR_DATE": "1700000000 +0000", "GIT_COMMITTER_DATE": "1700000000 +0000"}
+        with unittest.mock.patch.dict(os.environ, dates):
+            for data, filename in changes:
+                heads = []
+                for remote, clone in zip(remotes, clones):
+                    upload_files = [("file", filename, SCRIPT_CONTENT.encode('utf-8'))] if filename else []
+                    response = TEST_APP.post('/', extra_environ={"SCRIPT_REPOSITORY_PATH": clone},
+                                             params=data, upload_files=upload_files)
+                    self.assertEqual('200 OK', response.status)
+                    heads.append(subp.check_output(f"git -C {remote} rev-parse master", shell=True))
+                self.assertEqual(heads[0], heads[1])
+        subp.check_output(f"git -C {clones[1]} fsck --strict", stderr=subp.STDOUT, shell=True)
+        reflog = subp.check_output(f"git -C {clones[1]} reflog show --format=%gs master", shell=True)
+        self.assertEqual(["commit: Removed file", "commit: Added another", "commit: Added new file"],
+                         str(reflog, encoding='utf-8').splitlines()[:3])
+
+        # A failed update leaves the ref unlocked
+        objects = open_repository(clones[1]).objects
+        head = objects.read_ref('refs/heads/master')
+        with unittest.mock.patch('os.replace', side_effect=OSError("disk full")):
+            self.assertRaises(OSError, objects.update_ref, 'refs/heads/master', FIRST_COMMIT, head)
+        self.assertFalse(os.path.exists(os.path.join(clones[1], 'refs', 'heads', 'master.lock')))
+        objects.update_ref('refs/heads/master', FIRST_COMMIT, head)
+        self.assertEqual(FIRST_COMMIT, objects.read_ref('refs/heads/master'))
+
+        # Large blobs are hashed and compressed a block at a time
+        large = os.urandom(300 * 1024)
+        stream = io.BytesIO(large)
+        with unittest.mock.patch.object(stream, 'read', wraps=stream.read) as read:
+            blob = objects.write_stream('blob', stream, len(large))
+        self.assertLessEqual(max(call.args[0] for call in read.call_args_list), 64 * 1024)
+        self.assertEqual(hashlib.sha1(b'blob %d\0' % len(large) + large).hexdigest(), blob)
+        self.assertEqual(large, subp.check_output(f"git -C {clones[1]} cat-file blob {blob}",
+                                                  shell=True))
+        self.assertEqual([], [name for name in os.listdir(os.path.join(clones[1], 'objects'))
+                              if name.startswith('tmp_obj_')])
+
+    def test_ownership_index_tracks_commits_made_by_server(self):
+        extra_environ = {"SCRIPT_REPOSITORY_PATH": TEMP_GIT_REPO_PATH}
+        data = dict(author='Joe Bloggs', mail='first.last@domain.com', comment='Added new file',
+                    path='./muon')
+        TEST_APP.post('/', extra_environ=extra_environ, params=data,
+                      upload_files=[("file", "userscript.py", SCRIPT_CONTENT.encode('utf-8'))])
+
+        index_file = os.path.join(TEMP_GIT_REPO_PATH, ".git", "scriptrepository-owners.json")
+        with open(index_file, 'r') as index_handle:
+            index = json.load(index_handle)
+        head = subp.check_output(f"git -C {TEMP_GIT_REPO_PATH} rev-parse HEAD",
+                                 stderr=subp.STDOUT, shell=True)
+        self.assertEqual(str(head.rstrip(), encoding='utf-8'), index["head"])
+        self.assertEqual({"README.md": f"{GIT_USERNAME} <{GIT_EMAIL}>",
+                          "muon/userscript.py": "Joe Bloggs <first.last@domain.com>"},
+                         index["owners"])
+
+        # Another worker answers from the stored index and rereads it once it changes
+        other_worker = OwnershipIndex(open_repository(TEMP_GIT_REPO_PATH))
+        with unittest.mock.patch.object(GitRepository, 'git', side_effect=AssertionError):
+            self.assertEqual("", other_worker.owner("other.py"))
+        data['author'] = 'Jane Bloggs'
+        data['path'] = './'
+        TEST_APP.post('/', extra_environ=extra_environ, params=data,
+                      upload_files=[("file", "other.py", SCRIPT_CONTENT.encode('utf-8'))])
+        with unittest.mock.patch.object(GitRepository, 'git', side_effect=AssertionError):
+            self.assertEqual("Joe Bloggs <first.last@domain.com>",
+                             other_worker.owner("muon/userscript.py"))
+            self.assertEqual("Jane Bloggs <first.last@domain.com>", other_worker.owner("other.py"))
+
+        # A commit made outside the server is picked up before answering
+        subp.check_output(f"cd {TEMP_GIT_REPO_PATH}; echo bar > other.py; "
+                          f"git -c user.name='Jenny Bloggs' -c user.email=j.b@domain.com "
+                          f"commit -am'Changed other'", stderr=subp.STDOUT, shell=True)
+        self.assertEqual("Jenny Bloggs <j.b@domain.com>", other_worker.owner("other.py"))
+
+    def test_manifest_lists_files_and_returns_304_until_head_moves(self):
+        extra_environ = {"SCRIPT_REPOSITORY_PATH": TEMP_GIT_REPO_PATH}
+        data = dict(author='Joe Bloggs', mail='first.last@domain.com', comment='Added new file', path='./muon')
+        TEST_APP.post('/', extra_environ=extra_environ, params=data,
+                      upload_files=[("file", "userscript.py", SCRIPT_CONTENT.encode('utf-8'))])
+
+        response = TEST_APP.get('/?manifest=1', extra_environ=extra_environ)
+        manifest = json.loads(response.body.decode('utf-8'))
+        files = {entry['path']: entry for entry in manifest['files']}
+        self.assertEqual(['README.md', 'muon/userscript.py'], sorted(files))
+        blob = subp.check_output(f"git -C {TEMP_GIT_REPO_PATH} rev-parse HEAD:muon/userscript.py",
+                                 stderr=subp.STDOUT, shell=True)
+        self.assertEqual(str(blob.rstrip(), encoding='utf-8'), files['muon/userscript.py']['blob'])
+        self.assertEqual('Joe Bloggs <first.last@domain.com>', files['muon/userscript.py']['author'])
+        etag = response.headers['ETag']
+
+        response = TEST_APP.get('/?manifest=1', extra_environ=extra_environ,
+                                headers={'If-None-Match': etag}, status='*')
+        self.assertEqual('304 Not Modified', response.status)
+
+        data['path'] = './'
+        TEST_APP.post('/', extra_environ=extra_environ, params=data,
+                      upload_files=[("file", "second.py", SCRIPT_CONTENT.encode('utf-8'))])
+        response = TEST_APP.get('/?manifest=1', extra_environ=extra_environ,
+                                headers={'If-None-Match': etag}, status='*')
+        self.assertEqual('200 OK', response.status)
+        self.assertNotEqual(etag, response.headers['ETag'])
+        manifest = json.loads(response.body.decode('utf-8'))
+        self.assertIn('second.py', [entry['path'] for entry in manifest['files']])
+
+    def test_metrics_endpoint_merges_workers_and_times_each_stage(self):
+        metrics_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, metrics_dir)
+        # Figures saved by another worker
+        other_worker = {"counters": {"scriptrepository_requests_total\tcode=200\tmethod=POST": 5},
+                        "histograms": {}}
+        with open(os.path.join(metrics_dir, "1-0.json"), 'w') as other_file:
+            json.dump(other_worker, other_file)
+        # and by one that is still running, which keeps its lock file locked
+        live_worker = {"counters": {"scriptrepository_requests_total\tcode=200\tmethod=POST": 7},
+                       "histograms": {}}
+        with open(os.path.join(metrics_dir, "2-0.json"), 'w') as live_file:
+            json.dump(live_worker, live_file)
+        live_lock = os.open(os.path.join(metrics_dir, "2-0.alive"), os.O_CREAT | os.O_RDWR)
+        fcntl.flock(live_lock, fcntl.LOCK_EX)
+        extra_environ = {"SCRIPT_REPOSITORY_PATH": TEMP_GIT_REPO_PATH,
+                         "SCRIPT_REPOSITORY_METRICS_DIR": metrics_dir}
+        data = dict(author='Joe Bloggs', mail='first.last@domain.com', comment='Added new file', path='./')
+        TEST_APP.post('/', extra_environ=extra_environ, params=data,
+                      upload_files=[("file", "userscript.py", SCRIPT_CONTENT.encode('utf-8'))])
+
+        response = TEST_APP.get('/?metrics=1', extra_environ=extra_environ)
+        self.assertTrue(response.content_type.startswith('text/plain'))
+        lines = response.body.decode('utf-8').splitlines()
+        counts = dict(line.rsplit(' ', 1) for line in lines if not line.startswith('#'))
+        # Earlier tests have also been counted by this process
+        this_worker = metrics.registry().snapshot()['counters']
+        self.assertEqual(12 + this_worker["scriptrepository_requests_total\tcode=200\tmethod=POST"],
+                         int(counts['scriptrepository_requests_total{code="200",method="POST"}']))
+        for stage in ("parse", "sync", "write", "commit", "push"):
+            self.assertGreaterEqual(
+                int(counts['scriptrepository_stage_seconds_count{{stage="{}"}}'.format(stage)]), 1)
+        self.assertGreaterEqual(int(counts['scriptrepository_git_seconds_count{command="push"}']), 1)
+        self.assertIn('scriptrepository_lock_wait_seconds_bucket{le="+Inf"}', counts)
+
+        # The figures of the workers that have exited are folded into one file
+        def posts_counted():
+            lines = TEST_APP.get('/?metrics=1', extra_environ=extra_environ).body.decode('utf-8')
+            return [line for line in lines.splitlines()
+                    if line.startswith('scriptrepository_requests_total{code="200",method="POST"}')]
+
+        self.assertFalse(os.path.exists(os.path.join(metrics_dir, "1-0.json")))
+        self.assertTrue(os.path.exists(os.path.join(metrics_dir, "2-0.json")))
+        self.assertTrue(os.path.exists(os.path.join(metrics_dir, "aggregate.json")))
+        counted = posts_counted()
+        os.close(live_lock)
+        self.assertEqual(counted, posts_counted())
+        self.assertEqual(sorted(["aggregate.json", "guard", metrics.registry().worker_id + ".json",
+                                 metrics.registry().worker_id + ".alive"]),
+                         sorted(os.listdir(metrics_dir)))
+        # A worker writes its figures at most once an interval
+        with unittest.mock.patch.object(metrics.Registry, '_write') as write:
+            metrics.flush(metrics_dir)
+            metrics.flush(metrics_dir)
+            self.assertNotIn(unittest.mock.call(metrics_dir), write.call_args_list)
+            time.sleep(metrics.FLUSH_INTERVAL_SECS + 0.5)
+            self.assertEqual([unittest.mock.call(metrics_dir)],
+                             [call for call in write.call_args_list if call.args == (metrics_dir,)])
+
+    def test_maintenance_repacks_idle_clone_and_metrics_report_object_counts(self):
+        extra_environ = {"SCRIPT_REPOSITORY_PATH": TEMP_GIT_REPO_PATH}
+        data = dict(author='Joe Bloggs', mail='first.last@domain.com', comment='Added new file', path='./')
+        TEST_APP.post('/', extra_environ=extra_environ, params=data,
+                      upload_files=[("file", "userscript.py", SCRIPT_CONTENT.encode('utf-8'))])
+
+        def gauges():
+            lines = TEST_APP.get('/?metrics=1', extra_environ=extra_environ).body.decode('utf-8')
+            label = '{{repository="{}"}}'.format(TEMP_GIT_REPO_PATH)
+            return {line.split(label)[0]: int(line.rsplit(' ', 1)[1])
+                    for line in lines.splitlines() if label in line}
+
+        self.assertGreater(gauges()['scriptrepository_loose_objects'], 0)
+        git_repo = open_repository(TEMP_GIT_REPO_PATH)
+        # Never while an upload holds the lock
+        holder_ready, release_holder = threading.Event(), threading.Event()
+
+        def hold_lock():
+            with git_repo.lock:
+                holder_ready.set()
+                release_holder.wait()
+
+        holder = threading.Thread(target=hold_lock)
+        holder.start()
+        holder_ready.wait()
+        try:
+            self.assertFalse(maintain_if_due(git_repo, interval=0, idle_secs=0))
+        finally:
+            release_holder.set()
+            holder.join()
+
+        self.assertTrue(maintain_if_due(git_repo, interval=0, idle_secs=0))
+        self.assertEqual(dict(scriptrepository_loose_objects=0, scriptrepository_packs=1,
+                              scriptrepository_packed_objects=6), gauges())
+        self.assertTrue(os.path.exists(os.path.join(git_repo.git_dir, "objects", "info",
+                                                    "commit-graph")))
+        # Not due again until the interval has passed
+        self.assertFalse(maintain_if_due(git_repo, interval=3600, idle_secs=0))
+
+    def test_slow_traced_request_is_kept_with_its_git_commands(self):
+        tracing.clear()
+        extra_environ = {"SCRIPT_REPOSITORY_PATH": TEMP_GIT_REPO_PATH,
+                         "SCRIPT_REPOSITORY_TRACE_SAMPLE": "0"}
+        data = dict(author='Joe Bloggs', mail='first.last@domain.com', comment='Added new file', path='./')
+        TEST_APP.post('/', extra_environ=extra_environ, params=data,
+                      upload_files=[("file", "untraced.py", SCRIPT_CONTENT.encode('utf-8'))])
+        # Traces are only for admin requests, and there are none without a token
+        self.assertEqual('403 Forbidden',
+                         TEST_APP.get('/?traces=1', extra_environ=extra_environ,
+                                      status='*').status)
+        extra_environ["SCRIPT_REPOSITORY_ADMIN_TOKEN"] = "s3cret"
+        self.assertEqual('403 Forbidden',
+                         TEST_APP.get('/?traces=1', extra_environ=extra_environ,
+                                      headers={'Authorization': 'Bearer guess'},
+                                      status='*').status)
+        # Every traced request counts as slow
+        extra_environ.update({"SCRIPT_REPOSITORY_TRACE_SAMPLE": "1",
+                              "SCRIPT_REPOSITORY_TRACE_SLOW": "0"})
+        TEST_APP.post('/', extra_environ=extra_environ, params=data,
+                      upload_files=[("file", "traced.py", SCRIPT_CONTENT.encode('utf-8'))])
+
+        response = TEST_APP.get('/?traces=1', extra_environ=extra_environ,
+                                headers={'Authorization': 'Bearer s3cret'})
+        traces = json.loads(response.body.decode('utf-8'))['traces']
+        # The GET itself is only kept once it has finished
+        self.assertEqual(1, len(traces))
+        trace = traces[0]
+        self.assertEqual('handle_post', trace['name'])
+        self.assertEqual(200, trace['attrs']['status'])
+        update = [span for span in trace['children'] if span['name'] == 'update_central_repo'][0]
+
+        def descendants(span):
+            for child in span['children']:
+                yield child
+                yield from descendants(child)
+
+        names = [span['name'] for span in descendants(update)]
+        for name in ('lock_wait', 'sync', 'write', 'commit', 'push'):
+            self.assertIn(name, names)
+        pushes = [span for span in descendants(update)
+                  if span['name'] == 'git' and span['attrs']['command'] == 'push']
+        self.assertEqual(1, len(pushes))
+        self.assertGreaterEqual(pushes[0]['duration'], 0)
+
+    def test_application_factory_validates_settings_and_warms_clone(self):
+        with self.assertRaises(ValueError):
+            create_application({"SCRIPT_REPOSITORY_PATH": TEMP_GIT_REPO_PATH,
+                                "SCRIPT_REPOSITORY_LOCK_TIMEOUT": "soon"})
+        with self.assertRaises(ValueError):
+            create_application({"SCRIPT_REPOSITORY_PATH": TEMP_GIT_REPO_PATH + "_missing"})
+
+        app = TestApp(create_application({"SCRIPT_REPOSITORY_PATH": TEMP_GIT_REPO_PATH,
+                                          "SCRIPT_REPOSITORY_LOCK_TIMEOUT": 30,
+                                          "SCRIPT_REPOSITORY_PATH_DEBUG": None}))
+        # The manifest is built before the first request
+        head, _ = open_repository(TEMP_GIT_REPO_PATH).manifest.snapshot()
+        self.assertEqual(FIRST_COMMIT, head)
+        data = dict(author='Joe Bloggs', mail='first.last@domain.com', comment='Added new file', path='./')
+        response = app.post('/', params=data,
+                            upload_files=[("file", "userscript.py", SCRIPT_CONTENT.encode('utf-8'))])
+        self.assertEqual('200 OK', response.status)
+
+    def test_async_upload_returns_202_and_job_reaches_pushed(self):
+        jobs_dir = tempfile.mkdtemp()
+        extra_environ = {"SCRIPT_REPOSITORY_PATH": TEMP_GIT_REPO_PATH,
+                         "SCRIPT_REPOSITORY_JOBS_DIR": jobs_dir}
+        try:
+            data = dict(author='Joe Bloggs', mail='first.last@domain.com',
+                        comment='Added new file', path='./muon')
+            response = TEST_APP.post('/?async=1', extra_environ=extra_environ, params=data,
+                                     upload_files=[("file", "userscript.py",
+                                                    SCRIPT_CONTENT.encode('utf-8'))],
+                                     status='*')
+            self.assertEqual('202 Accepted', response.status)
+            job_id = json.loads(response.body)['job']
+
+            deadline = time.monotonic() + 30
+            while True:
+                status = TEST_APP.get('/?job=' + job_id, extra_environ=extra_environ)
+                status_json = json.loads(status.body)
+                if status_json['message'] in ('pushed', 'failed') or time.monotonic() > deadline:
+                    break
+                time.sleep(0.05)
+            self.check_replied_content(expected_json=dict(message='pushed', detail='',
+                                                          pub_date=self._now_as_str(), shell='',
+                                                          job=job_id),
+                                       actual_str=status.body)
+            content = subp.check_output(f"git -C {TEMP_GIT_REMOTE_PATH} show "
+                                        "master:muon/userscript.py",
+                                        stderr=subp.STDOUT, shell=True)
+            self.assertEqual(SCRIPT_CONTENT, str(content, encoding='utf-8'))
+
+            response = TEST_APP.get('/?job=0123abcd', extra_environ=extra_environ,
+                                    expect_errors=True)
+            self.assertEqual('404 Not Found', response.status)
+        finally:
+            shutil.rmtree(jobs_dir)
+
+    def test_jobs_left_queued_by_a_dead_worker_are_failed_when_a_runner_starts(self):
+        jobs_dir = tempfile.mkdtemp()
+        extra_environ = {"SCRIPT_REPOSITORY_PATH": TEMP_GIT_REPO_PATH,
+                         "SCRIPT_REPOSITORY_JOBS_DIR": jobs_dir}
+        try:
+            # A worker whose process has died and one that is still running
+            store = JobStore(jobs_dir)
+            Job(store, 'deadjob', 'deadrunner').update(QUEUED)
+            Job(store, 'livejob', 'liverunner').update(QUEUED)
+            with open(store.runner_filename('liverunner'), 'w') as live_runner:
+                fcntl.flock(live_runner, fcntl.LOCK_EX)
+                data = dict(author='Joe Bloggs', mail='first.last@domain.com',
+                            comment='Added new file', path='./muon')
+                response = TEST_APP.post('/?async=1', extra_environ=extra_environ, params=data,
+                                         upload_files=[("file", "userscript.py",
+                                                        SCRIPT_CONTENT.encode('utf-8'))],
+                                         status='*')
+                self.assertEqual('202 Accepted', response.status)
+
+                status = json.loads(TEST_APP.get('/?job=deadjob',
+                                                 extra_environ=extra_environ).body)
+                self.assertEqual('failed', status['message'])
+                status = json.loads(TEST_APP.get('/?job=livejob',
+                                                 extra_environ=extra_environ).body)
+                self.assertEqual('queued', status['message'])
+            # Wait for the new job to finish before the clone is removed
+            job_id = json.loads(response.body)['job']
+            deadline = time.monotonic() + 30
+            while store.load(job_id)['state'] not in ('pushed', 'failed') and \
+                    time.monotonic() < deadline:
+                time.sleep(0.05)
+            self.assertEqual('pushed', store.load(job_id)['state'])
+        finally:
+            shutil.rmtree(jobs_dir)
+
+    def test_concurrent_uploads_through_asgi_application(self):
+        nuploads = 10
+        os.environ["SCRIPT_REPOSITORY_PATH"] = TEMP_GIT_REPO_PATH
+        try:
+            results = asyncio.run(self._asgi_uploads(nuploads))
+        finally:
+            del os.environ["SCRIPT_REPOSITORY_PATH"]
+
+        for status, body in results:
+            self.assertEqual(200, status)
+            self.check_replied_content(expected_json=dict(message='success', detail='',
+                                                          pub_date=self._now_as_str(), shell=''),
+                                       actual_str=body)
+        remote_files = subp.check_output(f"git -C {TEMP_GIT_REMOTE_PATH} ls-tree --name-only "
+                                         "master muon/", stderr=subp.STDOUT, shell=True)
+        self.assertEqual(sorted("muon/script{}.py".format(i) for i in range(nuploads)),
+                         sorted(str(remote_files, encoding='utf-8').split()))
+
+    def test_asgi_upload_whose_rebase_conflicts_leaves_clone_usable(self):
+        push = GitRepository.push
+        conflicts = []
+
+        def push_after_conflicting_change(repo, remote, branch):
+            # Another publisher gets in first with a different version of the file
+            if not conflicts:
+                other_clone = tempfile.mkdtemp()
+                subp.check_output(f"git clone -b master {TEMP_GIT_REMOTE_PATH} {other_clone}; "
+                                  f"cd {other_clone}; mkdir muon; echo bar > muon/script0.py; "
+                                  f"git add muon; git -c user.name='{GIT_USERNAME}' "
+                                  f"-c user.email={GIT_EMAIL} commit -m'Other'; "
+                                  f"git push origin HEAD:master", stderr=subp.STDOUT, shell=True)
+                shutil.rmtree(other_clone)
+                conflicts.append(branch)
+            return push(repo, remote, branch)
+
+        os.environ["SCRIPT_REPOSITORY_PATH"] = TEMP_GIT_REPO_PATH
+        try:
+            with unittest.mock.patch.object(GitRepository, 'push', push_after_conflicting_change):
+                results = asyncio.run(self._asgi_uploads(1))
+            self.assertEqual(500, results[0][0])
+            self.assertFalse(os.path.exists(os.path.join(TEMP_GIT_REPO_PATH, ".git", "rebase-merge")))
+            results = asyncio.run(self._asgi_uploads(1))
+        finally:
+            del os.environ["SCRIPT_REPOSITORY_PATH"]
+        self.assertEqual(200, results[0][0])
+        content = subp.check_output(f"git -C {TEMP_GIT_REMOTE_PATH} show master:muon/script0.py",
+                                    stderr=subp.STDOUT, shell=True)
+        self.assertEqual(SCRIPT_CONTENT, str(content, encoding='utf-8'))
+
     # ---------------- Failure cases ---------------------
 
     def test_app_returns_405_for_non_POST_requests(self):
@@ -283,6 +1213,142 @@ class ScriptUploadServerTest(unittest.TestCase):
         }
         self.check_response(expected=expected_resp, actual=response)
 
+    def test_oversized_request_is_rejected_before_reading_body(self):
+        class UnreadableInput(object):
+            def read(self, *args):
+                raise AssertionError("Request body should not be read")
+
+        environ = {"REQUEST_METHOD": "POST", "QUERY_STRING": "",
+                   "CONTENT_TYPE": "multipart/form-data; boundary=xyz",
+                   "CONTENT_LENGTH": str(10*1024*1024),
+                   "SCRIPT_REPOSITORY_PATH": TEMP_GIT_REPO_PATH,
+                   "wsgi.input": UnreadableInput(), "wsgi.errors": sys.stderr}
+        status = []
+        body = application(environ, lambda code, headers: status.append(code))
+        self.assertEqual(['400 Bad Request'], status)
+        self.check_replied_content(expected_json=dict(message='File is too large.',
+                                                      detail='Maximum filesize is 1048576 bytes',
+                                                      pub_date='', shell=''), actual_str=body[0])
+
+    def test_upload_waiting_too_long_for_lock_held_by_other_process_returns_503(self):
+        holder_code = ("import sys; from scriptrepository_server.repository import repository_lock; "
+                       "lock = repository_lock(sys.argv[1]); lock.acquire(); "
+                       "print('held', flush=True); sys.stdin.read(); lock.release()")
+        holder = subp.Popen([sys.executable, "-c", holder_code, TEMP_GIT_REPO_PATH],
+                            stdin=subp.PIPE, stdout=subp.PIPE,
+                            cwd=os.path.join(os.path.dirname(__file__), ".."))
+        try:
+            self.assertEqual(b"held\n", holder.stdout.readline())
+            extra_environ = {"SCRIPT_REPOSITORY_PATH": TEMP_GIT_REPO_PATH,
+                             "SCRIPT_REPOSITORY_LOCK_TIMEOUT": "0.2"}
+            data = dict(author='Joe Bloggs', mail='first.last@domain.com',
+                        comment='Added new file', path='./')
+            response = TEST_APP.post('/', extra_environ=extra_environ, params=data,
+                                     upload_files=[("file", "userscript.py",
+                                                    SCRIPT_CONTENT.encode('utf-8'))],
+                                     status='*')
+        finally:
+            holder.communicate()
+
+        self.assertEqual('503 Service Unavailable', response.status)
+        self.assertEqual('1', response.headers['Retry-After'])
+        self.assertEqual('Server busy.', json.loads(response.body.decode('utf-8'))['message'])
+        self.assertFalse(os.path.exists(os.path.join(TEMP_GIT_REPO_PATH, "userscript.py")))
+        # Once the lock is free the upload goes through
+        response = TEST_APP.post('/', extra_environ=extra_environ, params=data,
+                                 upload_files=[("file", "userscript.py",
+                                                SCRIPT_CONTENT.encode('utf-8'))],
+                                 status='*')
+        self.assertEqual('200 OK', response.status)
+
+    def test_changes_beyond_in_flight_limit_are_refused_with_503_and_large_ones_first(self):
+        extra_environ = {"SCRIPT_REPOSITORY_PATH": TEMP_GIT_REPO_PATH,
+                         "SCRIPT_REPOSITORY_MAX_IN_FLIGHT": "2",
+                         "SCRIPT_REPOSITORY_LARGE_UPLOAD_BYTES": "4096"}
+        controller = get_admission_controller(TEMP_GIT_REPO_PATH)
+        data = dict(author='Joe Bloggs', mail='first.last@domain.com', comment='Added new file', path='./')
+        responses = dict()
+
+        def upload(filename, content=SCRIPT_CONTENT):
+            return TEST_APP.post('/', extra_environ=extra_environ, params=data,
+                                 upload_files=[("file", filename, content.encode('utf-8'))],
+                                 status='*')
+
+        def upload_in_thread(filename):
+            thread = threading.Thread(target=lambda: responses.update({filename: upload(filename)}))
+            thread.start()
+            return thread
+
+        def wait_for_in_flight(count):
+            deadline = time.monotonic() + 10
+            while controller.in_flight != count and time.monotonic() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(count, controller.in_flight)
+
+        # Keep the admitted uploads waiting for the lock
+        git_repo = open_repository(TEMP_GIT_REPO_PATH)
+        holder_ready, release_holder = threading.Event(), threading.Event()
+
+        def hold_lock():
+            with git_repo.lock:
+                holder_ready.set()
+                release_holder.wait()
+
+        holder = threading.Thread(target=hold_lock)
+        holder.start()
+        holder_ready.wait()
+        try:
+            threads = [upload_in_thread("first.py")]
+            wait_for_in_flight(1)
+            # Large uploads may only take half of the places
+            response = upload("large.py", "#" * 8192)
+            self.assertEqual('503 Service Unavailable', response.status)
+            self.assertGreaterEqual(int(response.headers['Retry-After']), 1)
+            threads.append(upload_in_thread("second.py"))
+            wait_for_in_flight(2)
+            self.assertEqual('503 Service Unavailable', upload("third.py").status)
+        finally:
+            release_holder.set()
+            holder.join()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual('200 OK', responses["first.py"].status)
+        self.assertEqual('200 OK', responses["second.py"].status)
+        self.assertEqual(0, controller.in_flight)
+        self.assertEqual('200 OK', upload("large.py", "#" * 8192).status)
+
+    def test_places_held_by_another_worker_count_and_are_freed_when_it_dies(self):
+        extra_environ = {"SCRIPT_REPOSITORY_PATH": TEMP_GIT_REPO_PATH,
+                         "SCRIPT_REPOSITORY_MAX_IN_FLIGHT": "1"}
+        controller = get_admission_controller(TEMP_GIT_REPO_PATH)
+        data = dict(author='Joe Bloggs', mail='first.last@domain.com', comment='Added new file', path='./')
+
+        def upload():
+            return TEST_APP.post('/', extra_environ=extra_environ, params=data,
+                                 upload_files=[("file", "userscript.py", SCRIPT_CONTENT.encode('utf-8'))],
+                                 status='*')
+
+        # A place taken by another worker is a file it keeps locked
+        os.makedirs(controller.directory, exist_ok=True)
+        place = os.path.join(controller.directory, "place-otherworker")
+        fd = os.open(place, os.O_CREAT | os.O_RDWR, 0o644)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            self.assertEqual(1, controller.in_flight)
+            self.assertEqual('503 Service Unavailable', upload().status)
+        finally:
+            # The worker dies
+            os.close(fd)
+        self.assertEqual('200 OK', upload().status)
+        self.assertFalse(os.path.exists(place))
+        self.assertEqual(0, controller.in_flight)
+
+        # The limits must be whole numbers
+        with self.assertRaises(ValueError):
+            create_application({"SCRIPT_REPOSITORY_PATH": TEMP_GIT_REPO_PATH,
+                                "SCRIPT_REPOSITORY_MAX_IN_FLIGHT": "2.5"})
+
     def test_app_returns_400_trying_to_remove_file_by_different_author(self):
         # Commit test file
         repo_file = os.path.join(TEMP_GIT_REPO_PATH, "muon", "userscript.py")
@@ -335,6 +1401,39 @@ class ScriptUploadServerTest(unittest.TestCase):
     # Helpers
     # -------------------------------------------------------------------------------------------
 
+    async def _asgi_uploads(self, nuploads):
+        async def upload(index):
+            fields = dict(author='Joe Bloggs', mail='first.last@domain.com',
+                          comment='Added file {}'.format(index), path='./muon')
+            body = self._multipart_body(fields, "script{}.py".format(index),
+                                        SCRIPT_CONTENT.encode('utf-8'))
+            scope = {'type': 'http', 'method': 'POST', 'query_string': b'',
+                     'headers': [(b'content-type', b'multipart/form-data; boundary=testboundary'),
+                                 (b'content-length', str(len(body)).encode())]}
+            messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+            sent = []
+
+            async def receive():
+                return messages.pop(0)
+
+            async def send(message):
+                sent.append(message)
+
+            await asgi.application(scope, receive, send)
+            return sent[0]['status'], sent[1]['body']
+
+        return await asyncio.gather(*(upload(i) for i in range(nuploads)))
+
+    def _multipart_body(self, fields, filename, content):
+        parts = []
+        for name, value in fields.items():
+            parts.append(f'--testboundary\r\nContent-Disposition: form-data; name="{name}"'
+                         f'\r\n\r\n{value}\r\n'.encode('utf-8'))
+        parts.append(f'--testboundary\r\nContent-Disposition: form-data; name="file"; '
+                     f'filename="{filename}"\r\n\r\n'.encode('utf-8') + content + b'\r\n')
+        parts.append(b'--testboundary--\r\n')
+        return b''.join(parts)
+
     def check_response(self, expected, actual):
         self.assertEqual(expected['status'], actual.status)
         self.assertEqual(expected['content-type'], actual.content_type)